@@ -0,0 +1,196 @@
+"""Recall-vs-memory report of the collection profiles (see etl/profiles.py).
+
+Every profile gets its own collection with the same vectors. The exact top 10 of each query (brute force on the
+full-size float32 vectors) is compared with what search_documents returns with the search params of the profile.
+Reduced dimensions are emulated by truncating and renormalizing the vectors, which is what the embedding API does
+for text-embedding-3 models - so use real embeddings for those profiles, truncated random vectors are meaningless.
+
+    cd src
+    # vectors of the document collection, on a local Qdrant server (quantization and HNSW only exist in server mode)
+    python -m bench.collection_profiles --qdrant-url http://localhost --source-collection documents
+    # or the embedded shards of an ingestion run, or synthetic clustered vectors
+    python -m bench.collection_profiles --qdrant-url http://localhost --shards ../data/embedded
+    python -m bench.collection_profiles --qdrant-url http://localhost --points 100000 --dim 3072
+
+Qdrant in memory (the default) ignores quantization and HNSW, so its recall is always 1.0.
+"""
+
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+from qdrant_client.http.models import CollectionStatus
+
+from bench.ingest_retrieval import _git_commit, _percentiles
+from etl.profiles import CollectionProfile, all_profiles
+from etl.qdrant import QdrantClient, create_db_collection, search_documents, upsert_embeddings
+from etl.shards import ShardReader
+from util.util import PROJECT_ROOT
+
+logger = logging.getLogger("AInstein")
+
+TOP_K = 10
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def synthetic_vectors(points: int, dim: int, clusters: int = 100, seed: int = 0) -> np.ndarray:
+    """Clustered unit vectors - closer to real embeddings than uniformly random ones"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    vectors = centers[rng.integers(0, clusters, points)] + 0.5 * rng.standard_normal((points, dim), dtype=np.float32)
+    return _normalize(vectors).astype(np.float32)
+
+
+def load_vectors(args, q_client: QdrantClient) -> np.ndarray:
+    if args.shards:
+        return np.concatenate([np.asarray(vectors) for _, vectors in ShardReader(args.shards).iter_shards()])
+    if args.source_collection:
+        vectors, offset = [], None
+        while True:
+            records, offset = q_client.scroll(
+                args.source_collection, limit=1_000, offset=offset, with_payload=False, with_vectors=True
+            )
+            vectors.extend(record.vector for record in records)
+            if offset is None or len(vectors) >= args.points:
+                break
+        return np.asarray(vectors[: args.points], dtype=np.float32)
+    return synthetic_vectors(args.points, args.dim)
+
+
+def _wait_until_indexed(q_client: QdrantClient, collection_name: str, timeout: float = 600):
+    deadline = time.monotonic() + timeout
+    while q_client.get_collection(collection_name).status != CollectionStatus.GREEN:
+        if time.monotonic() > deadline:
+            logger.warning("Collection %s is still not indexed after %ss", collection_name, timeout)
+            return
+        time.sleep(0.5)
+
+
+def evaluate_profile(
+    q_client: QdrantClient, profile: CollectionProfile, vectors: np.ndarray, queries: np.ndarray, truth: np.ndarray
+) -> dict:
+    """recall@10, query latency and estimated memory of one profile"""
+    dim = profile.dimensions or vectors.shape[1]
+    if dim > vectors.shape[1]:
+        raise ValueError(f"Profile {profile.name} needs {dim} dimensions, the vectors only have {vectors.shape[1]}")
+    profile_vectors = _normalize(vectors[:, :dim])
+    profile_queries = _normalize(queries[:, :dim])
+
+    collection_name = f"bench_profile_{profile.name}"
+    create_db_collection(q_client, collection_name, dim, profile)
+    start = time.perf_counter()
+    upsert_embeddings(
+        q_client, collection_name, [{} for _ in range(len(vectors))], profile_vectors, ids=list(range(len(vectors)))
+    )
+    _wait_until_indexed(q_client, collection_name)
+    load_seconds = time.perf_counter() - start
+
+    recalls, latencies = [], []
+    for query, expected in zip(profile_queries, truth):
+        start = time.perf_counter()
+        points = search_documents(q_client, collection_name, query.tolist(), search_params=profile.search_params())
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len({point.id for point in points} & set(expected.tolist())) / TOP_K)
+    q_client.delete_collection(collection_name)
+
+    return {
+        "dimensions": dim,
+        "quantization": profile.quantization,
+        "on_disk": profile.on_disk,
+        f"recall@{TOP_K}": float(np.mean(recalls)),
+        "load_seconds": load_seconds,
+        **profile.estimated_memory(len(vectors), dim),
+        **_percentiles(latencies),
+    }
+
+
+def print_report(results: dict):
+    print(f"{'profile':16} {'dims':>6} {'quant':>7} {'recall@10':>10} {'RAM MB':>10} {'disk MB':>10} {'p50 ms':>8} {'p95 ms':>8}")
+    for name, result in results.items():
+        print(
+            f"{name:16} {result['dimensions']:6d} {result['quantization'] or '-':>7} {result['recall@10']:10.3f} "
+            f"{result['ram_bytes'] / 2**20:10.1f} {result['disk_bytes'] / 2**20:10.1f} "
+            f"{result['p50_ms']:8.2f} {result['p95_ms']:8.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", help="profiles to compare, default: all (built-in and from config)")
+    parser.add_argument("--config", help="config file with qdrant.profiles, default: config/config.yml if it exists")
+    parser.add_argument("--shards", help="read the vectors from the embedded shards in this directory")
+    parser.add_argument("--source-collection", help="read the vectors from this Qdrant collection")
+    parser.add_argument("--points", type=int, default=20_000, help="number of (synthetic) vectors")
+    parser.add_argument("--dim", type=int, default=1536, help="dimensions of the synthetic vectors")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--qdrant-path", help="use Qdrant in path mode instead of in memory")
+    parser.add_argument("--qdrant-url", help="use a (local) Qdrant server instead of in memory")
+    parser.add_argument("--output", help="json file for the results, default: bench_results/profiles-<timestamp>.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    qdrant_config = {}
+    config_file = Path(args.config) if args.config else PROJECT_ROOT / "config" / "config.yml"
+    if args.config or config_file.exists():
+        from util.util import load_config
+
+        qdrant_config = load_config(config_file).get("qdrant", {})
+    profiles = all_profiles(qdrant_config)
+    if args.profiles:
+        profiles = {name: profiles[name] for name in args.profiles}
+
+    if args.qdrant_url:
+        q_client = QdrantClient(url=args.qdrant_url)
+    elif args.qdrant_path:
+        q_client = QdrantClient(path=args.qdrant_path)
+    else:
+        logger.warning("Qdrant in memory ignores quantization and HNSW settings, use --qdrant-url for real numbers")
+        q_client = QdrantClient(":memory:")
+
+    vectors = _normalize(load_vectors(args, q_client)).astype(np.float32)
+    rng = np.random.default_rng(1)
+    # queries close to, but not equal to stored vectors
+    queries = vectors[rng.integers(0, len(vectors), args.queries)]
+    queries = _normalize(queries + 0.1 * rng.standard_normal(queries.shape, dtype=np.float32) / np.sqrt(vectors.shape[1]))
+    # the exact top k on the full vectors is the reference for every profile
+    truth = np.argsort(-(queries @ vectors.T), axis=1)[:, :TOP_K]
+    logger.info("%s vectors with %s dimensions, %s queries", len(vectors), vectors.shape[1], len(queries))
+
+    results = {}
+    for name, profile in profiles.items():
+        if (profile.dimensions or 0) > vectors.shape[1]:
+            logger.info("Skipping profile %s, it needs more dimensions than the vectors have", name)
+            continue
+        results[name] = evaluate_profile(q_client, profile, vectors, queries, truth)
+        logger.info("%s: %s", name, results[name])
+    q_client.close()
+    print_report(results)
+
+    output = Path(args.output or PROJECT_ROOT / "bench_results" / f"profiles-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "commit": _git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "points": len(vectors),
+                "dim": int(vectors.shape[1]),
+                "profiles": results,
+            },
+            f,
+            indent=4,
+        )
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
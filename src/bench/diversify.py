@@ -0,0 +1,104 @@
+"""Latency of the diversified search (etl/diversify.py), search and diversification together, next to the plain
+search of the same candidates.
+
+The collection holds synthetic points in groups of near-duplicates, like overlapping chunks of the same page. Qdrant
+runs in memory, where diversified_search() fetches the candidates with their vectors and runs MMR with NumPy, or
+against a server with --qdrant-url (>= 1.15), where it runs MMR on the server.
+
+    cd src
+    python -m bench.diversify
+    python -m bench.diversify --candidates 50 100 200 --dims 1536 3072 --k 10 --qdrant-url http://localhost:6333
+"""
+
+import argparse
+import logging
+import time
+import uuid
+
+import numpy as np
+from qdrant_client import QdrantClient
+
+from etl.diversify import diversified_search
+from etl.qdrant import create_db_collection, search_documents
+
+logger = logging.getLogger("AInstein")
+
+
+def _timed(function, repeats: int) -> dict:
+    function()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def create_collection(q_client: QdrantClient, collection_name: str, points: int, dim: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    base = rng.standard_normal((points // 4 + 1, dim), dtype=np.float32)
+    vectors = np.repeat(base, 4, axis=0)[:points] + 0.05 * rng.standard_normal((points, dim), dtype=np.float32)
+    create_db_collection(q_client, collection_name, dim)
+    q_client.upload_collection(
+        collection_name,
+        vectors=vectors,
+        payload=({"content": f"chunk {index}", "source": "bench.pdf", "page": index} for index in range(points)),
+        ids=(str(uuid.uuid4()) for _ in range(points)),
+        wait=True,
+    )
+
+
+def bench_diversified_search(
+    q_client: QdrantClient, collection_name: str, dim: int, candidates: int, k: int, repeats: int, seed: int = 1
+) -> dict:
+    embedded_question = np.random.default_rng(seed).standard_normal(dim, dtype=np.float32).tolist()
+
+    def search(with_vectors: bool):
+        return lambda: search_documents(
+            q_client, collection_name, embedded_question, limit=candidates, with_vectors=with_vectors
+        )
+
+    result = _timed(
+        lambda: diversified_search(q_client, collection_name, embedded_question, k=k, candidates=candidates), repeats
+    )
+    result["search_p50_ms"] = _timed(search(False), repeats)["p50_ms"]
+    result["vectors_p50_ms"] = _timed(search(True), repeats)["p50_ms"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=5000)
+    parser.add_argument("--candidates", type=int, nargs="+", default=[20, 50, 100, 200])
+    parser.add_argument("--dims", type=int, nargs="+", default=[1536, 3072])
+    parser.add_argument("--k", type=int, default=10, help="chunks to select")
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--qdrant-url", default=None, help="benchmark a Qdrant server instead of the local mode")
+    args = parser.parse_args()
+
+    q_client = QdrantClient(url=args.qdrant_url) if args.qdrant_url else QdrantClient(":memory:")
+    collection_name = "bench_diversify"
+
+    print(
+        f"{'candidates':>10} {'dim':>6} {'k':>4} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'search p50 ms':>13} {'+vectors p50 ms':>15}"
+    )
+    try:
+        for dim in args.dims:
+            create_collection(q_client, collection_name, args.points, dim)
+            for candidates in args.candidates:
+                result = bench_diversified_search(q_client, collection_name, dim, candidates, args.k, args.repeats)
+                print(
+                    f"{candidates:10d} {dim:6d} {args.k:4d} {result['p50_ms']:8.3f} {result['p99_ms']:8.3f} "
+                    f"{result['search_p50_ms']:13.3f} {result['vectors_p50_ms']:15.3f}"
+                )
+    finally:
+        q_client.delete_collection(collection_name)
+
+
+if __name__ == "__main__":
+    main()
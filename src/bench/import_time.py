@@ -0,0 +1,120 @@
+"""Import time of the etl, llm and util modules, measured with `python -X importtime` in a fresh interpreter each.
+
+These modules are imported by the CLI tools, the ingestion workers and the UIs, so importing them has to stay cheap:
+langchain, qdrant_client, pypdf & co. take seconds to import and are only loaded where they are used.
+The check fails (exit code 1) if one of the lightweight modules pulls in a heavy dependency at import time,
+or takes longer than the budget, so a new top-level import is caught before it slows everything down again.
+
+    cd src
+    python -m bench.import_time
+    python -m bench.import_time --budget-ms 150 --top 5 llm.embed etl.ingest
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+SRC_DIR = Path(__file__).parent.parent
+
+# modules that must not import any of HEAVY_PACKAGES at import time
+LIGHT_MODULES = [
+    "util.util",
+    "util.tracing",
+    "etl.model",
+    "etl.manifest",
+    "etl.shards",
+    "etl.sparse",
+    "etl.profiles",
+    "etl.diversify",
+    "etl.page_cache",
+    "etl.work_queue",
+    "llm.tokens",
+    "llm.context",
+    "llm.streaming",
+    "llm.embedders",
+    "llm.embed_cache",
+    "llm.embed_scheduler",
+    "llm.query_batcher",
+    "llm.embed",
+    "llm.chat",
+]
+
+HEAVY_PACKAGES = {
+    "langchain",
+    "langchain_community",
+    "langchain_core",
+    "langchain_openai",
+    "openai",
+    "qdrant_client",
+    "pypdf",
+    "omegaconf",
+    "sentence_transformers",
+    "torch",
+    "streamlit",
+}
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int]]:
+    """The (module, self us, cumulative us) entries of the -X importtime output"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        entries.append((name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def measure(module: str, repeats: int = 3) -> dict:
+    """Import the module in a new interpreter (best of repeats), returns its cumulative time and all imported modules"""
+    env = {**os.environ, "PYTHONPATH": str(SRC_DIR)}
+    best = None
+    for _ in range(repeats):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+            cwd=SRC_DIR,
+            env=env,
+        )
+        if process.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{process.stderr.splitlines()[-1]}")
+        entries = parse_importtime(process.stderr)
+        cumulative_us = next(cumulative for name, _, cumulative in reversed(entries) if name == module)
+        if best is None or cumulative_us < best["cumulative_us"]:
+            best = {"module": module, "cumulative_us": cumulative_us, "entries": entries}
+    best["heavy"] = sorted({name.split(".")[0] for name, _, _ in best["entries"]} & HEAVY_PACKAGES)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=LIGHT_MODULES, help="modules to measure, default: the light ones")
+    parser.add_argument("--budget-ms", type=float, default=200, help="maximum import time of a light module")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--top", type=int, default=0, help="also list the slowest imports (self time) of each module")
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'module':<22} {'import ms':>10}  heavy imports")
+    for module in args.modules:
+        result = measure(module, args.repeats)
+        milliseconds = result["cumulative_us"] / 1000
+        print(f"{module:<22} {milliseconds:10.1f}  {', '.join(result['heavy']) or '-'}")
+        for name, self_us, _ in sorted(result["entries"], key=lambda entry: -entry[1])[: args.top]:
+            print(f"{'':<22} {self_us / 1000:10.1f}  {name}")
+        if module in LIGHT_MODULES:
+            if result["heavy"]:
+                failures.append(f"{module} imports {', '.join(result['heavy'])}")
+            if milliseconds > args.budget_ms:
+                failures.append(f"{module} takes {milliseconds:.0f} ms, budget {args.budget_ms:.0f} ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Offline benchmark for ingestion throughput and retrieval latency.
+
+Everything runs locally: the corpus is synthetic text, embeddings come from a deterministic hashing embedder and
+Qdrant runs in memory (or in path mode with --qdrant-path, or against a local server with --qdrant-url).
+The results are written as json, so two runs (e.g. before and after a change) can be compared:
+
+    cd src
+    python -m bench.ingest_retrieval --output ../bench_results/before.json
+    python -m bench.ingest_retrieval --output ../bench_results/after.json
+    python -m bench.ingest_retrieval --compare ../bench_results/before.json ../bench_results/after.json
+"""
+
+import argparse
+import json
+import logging
+import random
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document as LangchainPage
+
+from etl.ingest import documents_from_chunks
+from etl.qdrant import QdrantClient, create_db_collection, search_documents, upsert_embeddings
+from etl.shards import ShardReader, ShardWriter
+from llm.embed_scheduler import EmbeddingScheduler
+from llm.embedders import HashingEmbedder
+from util.util import PROJECT_ROOT
+
+logger = logging.getLogger("AInstein")
+
+WORDS = (
+    "pump valve pressure sensor motor controller firmware update error code manual installation maintenance "
+    "temperature voltage current safety warning calibration filter cartridge replace cycle interval schedule "
+    "the a of to and in is for with on by this that be are from as at or"
+).split()
+
+
+def synthetic_pages(n_files: int, pages_per_file: int, words_per_page: int, seed: int = 0) -> list[LangchainPage]:
+    """Pages of random words (with some part numbers), shaped like the output of PyPDFLoader"""
+    rng = random.Random(seed)
+    pages = []
+    for file_number in range(n_files):
+        for page_number in range(pages_per_file):
+            words = [
+                rng.choice(WORDS) if rng.random() > 0.02 else f"PN-{rng.randint(1000, 9999)}"
+                for _ in range(words_per_page)
+            ]
+            pages.append(
+                LangchainPage(
+                    page_content=" ".join(words),
+                    metadata={"source": f"synthetic/manual_{file_number:04d}.pdf", "page": page_number},
+                )
+            )
+    return pages
+
+
+def _timed(stage: str, results: dict, items: int, start: float):
+    seconds = time.perf_counter() - start
+    results[stage] = {"items": items, "seconds": seconds, "items_per_s": items / seconds if seconds else None}
+    logger.info("%s: %s items in %.2fs", stage, items, seconds)
+
+
+def _new_client(args, collection_name: str, dim: int) -> QdrantClient:
+    if args.qdrant_url:
+        q_client = QdrantClient(url=args.qdrant_url)
+    elif args.qdrant_path:
+        q_client = QdrantClient(path=args.qdrant_path)
+    else:
+        q_client = QdrantClient(":memory:")
+    if q_client.collection_exists(collection_name):
+        q_client.delete_collection(collection_name)
+    create_db_collection(q_client, collection_name, dim)
+    return q_client
+
+
+def bench_ingestion(args) -> dict:
+    """chunks/sec of each ingestion stage on a synthetic corpus"""
+    results = {}
+    pages = synthetic_pages(args.files, args.pages_per_file, args.words_per_page)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+
+    start = time.perf_counter()
+    documents = documents_from_chunks(text_splitter.split_documents(pages))
+    _timed("split", results, len(documents), start)
+
+    embedder = HashingEmbedder(args.dim)
+    scheduler = EmbeddingScheduler(embedder, requests_per_minute=None, tokens_per_minute=None)
+    start = time.perf_counter()
+    embeddings = scheduler.embed([document.content for document in documents])
+    _timed("embed", results, len(documents), start)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        with ShardWriter(tmp_dir) as writer:
+            for document, embedding in zip(documents, embeddings):
+                document.add_embedding(embedding)
+                writer.write(document)
+        _timed("shard_write", results, len(documents), start)
+
+        q_client = _new_client(args, "bench_ingest", args.dim)
+        start = time.perf_counter()
+        for shard_documents, vectors in ShardReader(tmp_dir).iter_shards():
+            payloads = [document.payload for document in shard_documents]
+            upsert_embeddings(
+                q_client,
+                "bench_ingest",
+                payloads,
+                vectors,
+                ids=[document.point_id for document in shard_documents],
+                batch_size=args.upsert_batch_size,
+            )
+        _timed("shard_read_and_upsert", results, len(documents), start)
+        q_client.close()
+    return results
+
+
+def _percentiles(latencies: list[float]) -> dict:
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "queries": len(latencies),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(latencies_ms.mean()),
+    }
+
+
+def bench_retrieval(args) -> dict:
+    """Query latency percentiles of search_documents for collections of different sizes"""
+    results = {}
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        q_client = _new_client(args, "bench_retrieval", args.dim)
+        start = time.perf_counter()
+        for batch_start in range(0, size, 10_000):
+            count = min(10_000, size - batch_start)
+            vectors = rng.standard_normal((count, args.dim), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            payloads = [{"source": f"synthetic/{i % 1000}.pdf", "page": i % 50} for i in range(batch_start, batch_start + count)]
+            upsert_embeddings(
+                q_client,
+                "bench_retrieval",
+                payloads,
+                vectors,
+                ids=list(range(batch_start, batch_start + count)),
+                batch_size=args.upsert_batch_size,
+            )
+        load_seconds = time.perf_counter() - start
+
+        queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            search_documents(q_client, "bench_retrieval", query.tolist())
+            latencies.append(time.perf_counter() - start)
+        results[str(size)] = {"load_seconds": load_seconds, **_percentiles(latencies)}
+        logger.info("search_documents on %s points: %s", size, results[str(size)])
+        q_client.close()
+    return results
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_file: str | Path, after_file: str | Path):
+    """Print the change of every metric between two result files"""
+    with open(before_file, "r", encoding="utf-8") as f:
+        before = json.load(f)
+    with open(after_file, "r", encoding="utf-8") as f:
+        after = json.load(f)
+    print(f"{'metric':50} {'before':>12} {'after':>12} {'change':>8}")
+    for section, key in (("ingestion", "items_per_s"), ("retrieval", "p50_ms"), ("retrieval", "p95_ms"), ("retrieval", "p99_ms")):
+        for name in sorted(set(before.get(section, {})) & set(after.get(section, {}))):
+            old, new = before[section][name].get(key), after[section][name].get(key)
+            if old and new is not None:
+                print(f"{section + '/' + name + '/' + key:50} {old:12.2f} {new:12.2f} {(new - old) / old:+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=20, help="synthetic pdfs")
+    parser.add_argument("--pages-per-file", type=int, default=20)
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=256, help="embedding dimensions")
+    parser.add_argument("--upsert-batch-size", type=int, default=256)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="collection sizes")
+    parser.add_argument("--queries", type=int, default=200, help="queries per collection size")
+    parser.add_argument("--qdrant-path", help="use Qdrant in path mode instead of in memory")
+    parser.add_argument("--qdrant-url", help="use a (local) Qdrant server instead of in memory")
+    parser.add_argument("--skip-ingestion", action="store_true")
+    parser.add_argument("--skip-retrieval", action="store_true")
+    parser.add_argument("--output", help="json file for the results, default: bench_results/<timestamp>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+    }
+    if not args.skip_ingestion:
+        results["ingestion"] = bench_ingestion(args)
+    if not args.skip_retrieval:
+        results["retrieval"] = bench_retrieval(args)
+
+    output = Path(args.output or PROJECT_ROOT / "bench_results" / f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
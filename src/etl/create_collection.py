@@ -1,6 +1,12 @@
-"""Create a database ('Qdrant collection') for our chatbot."""
-
-from etl.qdrant import create_db_collection, instantiate_qclient, delete_db_collection
+"""Create a database ('Qdrant collection') for our chatbot.
+The collection is the first version behind the document_collection alias (see versions.py). An existing one is
+left alone: reindexing builds a new version next to it without downtime, with `python -m etl.ingest --rebuild`."""
+
+from etl.profiles import get_profile
+from etl.qdrant import create_db_collection, instantiate_qclient
+from etl.sparse import get_sparse_encoder
+from etl.versions import new_version_name, swap_alias
+from llm.embed import embedding_dimension, get_embedder
 from util.util import PROJECT_ROOT, load_config, logging_setup
 
 
@@ -10,14 +16,25 @@ def main():
 
     qdrant_config = config["qdrant"]
     qdrant_client = instantiate_qclient(qdrant_config["storage_path"])
+    alias = qdrant_config["document_collection"]
 
-    print("Deleting existing collection")
-    delete_db_collection(qdrant_client, qdrant_config["document_collection"])
+    if qdrant_client.collection_exists(alias):
+        print(f"Collection {alias} exists already, run `python -m etl.ingest --rebuild` to reindex it")
+        return
 
-    print("Creating new collection")
+    # the vector size comes from the embedder, so it always matches the embeddings
+    profile = get_profile(qdrant_config)
+    vectorsize = embedding_dimension(get_embedder(profile.embedder_config(config["embedder"])))
+    collection_name = new_version_name(qdrant_client, alias)
+    print(f"Creating new collection {collection_name} with vector size {vectorsize} and profile {profile.name}")
     create_db_collection(
-        qdrant_client, qdrant_config["document_collection"], qdrant_config["vectorsize"]
+        qdrant_client,
+        collection_name,
+        vectorsize,
+        profile,
+        sparse=get_sparse_encoder(qdrant_config) is not None,
     )
+    swap_alias(qdrant_client, alias, collection_name)
 
 
 if __name__ == "__main__":
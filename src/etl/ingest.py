@@ -2,51 +2,259 @@
 Because understanding this is some important, we have some tasks for you to complete.
 Some of these tasks require you to modify methods in model.py"""
 
+import argparse
 import logging
-from dataclasses import asdict
+import shutil
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterator
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
-
-from llm.embed import get_embedder
-from etl.model import Document
-from etl.qdrant import QdrantClient, instantiate_qclient, upsert_embeddings
-from etl import create_collection
+from llm.embed import embedder_id, embedding_dimension, get_cached_embedder
+from llm.embed_scheduler import EmbeddingScheduler
+from llm.tokens import count_tokens
+from etl.model import Document, LangchainDocument
+from etl.semantic_cache import SemanticCache
+from etl.shards import ShardReader, ShardWriter
+from etl.manifest import Manifest, file_hash, splitter_fingerprint, text_splitter_from_fingerprint
+from etl.page_cache import get_page_cache
+from etl.profiles import get_profile
+from etl.progress import IngestProgress
+from etl.qdrant import (
+    QdrantClient,
+    create_db_collection,
+    delete_db_collection,
+    delete_points,
+    ensure_db_collection,
+    instantiate_qclient,
+    upsert_embeddings,
+)
+from etl.sparse import SparseEncoder, get_sparse_encoder
+from etl.versions import (
+    VersionValidationError,
+    cleanup_versions,
+    current_version,
+    get_versioning_config,
+    new_version_name,
+    swap_alias,
+    validate_version,
+    version_manifest_path,
+)
+from etl.work_queue import (
+    ABANDONED,
+    DONE,
+    FAILED,
+    ProcessUnit,
+    Run,
+    WorkQueue,
+    WorkUnit,
+    drain,
+    get_work_queue_config,
+    run_worker,
+    work_queue_dir,
+)
+from util.tracing import tracer, tracing_setup
 from util.util import PROJECT_ROOT, load_config, logging_setup, delete_all_files_in_directory
 
-# TASK 2.1: Import a text parser from langchain.document_loaders.pdf
-# Check this out: https://python.langchain.com/docs/modules/data_connection/document_loaders/pdf
-from langchain.document_loaders.pdf import PyPDFLoader
+if TYPE_CHECKING:
+    from langchain.text_splitter import TextSplitter
+    from qdrant_client.http.models import SparseVector
 
 logger = logging.getLogger("AInstein")
 
 
+def default_text_splitter() -> "TextSplitter":
+    # langchain is imported on first use, it takes about a second
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter()
+
+
+def _load_pdf_pages(raw_document: Path) -> list[LangchainDocument]:
+    """Extract the text of a PDF, one document per page"""
+    # TASK 2.1: Import a text parser from langchain.document_loaders.pdf
+    # Check this out: https://python.langchain.com/docs/modules/data_connection/document_loaders/pdf
+    from langchain.document_loaders.pdf import PyPDFLoader
+
+    logger.debug("Parsing pdf at %s", raw_document)
+    # TASK 2.2: Use the text parser of your choice that you imported above to read the text from the raw_document PDF
+    pdf_loader = PyPDFLoader(str(raw_document))
+    return pdf_loader.load()
+
+
+def _parse_pdf(
+    raw_document: Path, text_splitter: "TextSplitter", page_cache_path: str | Path | None = None
+) -> list[Document]:
+    """Parse and split a single PDF into documents.
+    With a page cache (see page_cache.py), the text of a PDF that was parsed before is taken from there."""
+    if page_cache_path is None:
+        pdf_pages = _load_pdf_pages(raw_document)
+    else:
+        page_cache = get_page_cache(page_cache_path)
+        content_hash = file_hash(raw_document)
+        pdf_pages = page_cache.get(content_hash, str(raw_document))
+        if pdf_pages is None:
+            pdf_pages = _load_pdf_pages(raw_document)
+            page_cache.put(content_hash, pdf_pages)
+        else:
+            logger.debug("Took the pages of %s from the page cache", raw_document)
+    # TASK 2.3: find a method to load and chunk text in your text parser
+    return documents_from_chunks(text_splitter.split_documents(pdf_pages))
+
+
+def documents_from_chunks(chunks: list[LangchainDocument]) -> list[Document]:
+    """Turn the chunks of a text splitter into documents, numbering the chunks of each page."""
+    # TASK 2.4: You will need to add 'from_langchain_document' method to the Document class in model.py
+    chunks_per_page = defaultdict(int)
+    documents = []
+    for chunk in chunks:
+        page_number = chunk.metadata["page"]
+        document = Document.from_langchain_document(chunk, chunk=chunks_per_page[page_number])
+        # counted once here, so neither the embedding batches nor the context packing at query time need the tokenizer
+        document.tokens = count_tokens(document.content)
+        documents.append(document)
+        chunks_per_page[page_number] += 1
+    return documents
+
+
+def token_counts(documents: list[Document]) -> list[int]:
+    """The precomputed token counts of the documents, counting only those without one (e.g. from older runs)"""
+    return [document.tokens if document.tokens is not None else count_tokens(document.content) for document in documents]
+
+
+def _parse_pdf_safely(
+    raw_document: Path, text_splitter: "TextSplitter", page_cache_path: str | Path | None = None
+) -> tuple[list[Document], str | None, float]:
+    """Like _parse_pdf, but returns the error instead of raising it, so one broken PDF doesn't stop the others.
+    Also returns the parsing time, because spans recorded in the worker processes of a pool would be lost."""
+    start = time.perf_counter()
+    try:
+        return _parse_pdf(raw_document, text_splitter, page_cache_path), None, time.perf_counter() - start
+    except Exception as e:
+        return [], f"{type(e).__name__}: {e}", time.perf_counter() - start
+
+
+def _traced_parse_result(
+    raw_document: Path, documents: list[Document], error: str | None, duration: float
+) -> tuple[Path, list[Document], str | None]:
+    if tracer.enabled:
+        tracer.record("parse_pdf", duration, len(documents), raw_document.stat().st_size, failed=error is not None)
+    return raw_document, documents, error
+
+
+def iter_parsed_pdfs(
+    pdf_files: list[Path],
+    text_splitter: "TextSplitter",
+    workers: int = 1,
+    page_cache_path: str | Path | None = None,
+) -> Iterator[tuple[Path, list[Document], str | None]]:
+    """Parse PDFs in the given order and yield (pdf, documents, error) for each of them.
+    With workers > 1, the PDFs are parsed in a process pool, one whole file per task, with only a few files in flight.
+    With a page_cache_path, the extracted text is cached per file content, see page_cache.py."""
+    if workers <= 1 or len(pdf_files) <= 1:
+        for pdf_file in pdf_files:
+            yield _traced_parse_result(pdf_file, *_parse_pdf_safely(pdf_file, text_splitter, page_cache_path))
+        return
+
+    logger.info("Parsing %s pdfs with %s workers", len(pdf_files), workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # results are taken in submission order, so the output is the same as in a sequential run
+        in_flight: deque[tuple[Path, Future]] = deque()
+        for pdf_file in pdf_files:
+            in_flight.append(
+                (pdf_file, executor.submit(_parse_pdf_safely, pdf_file, text_splitter, page_cache_path))
+            )
+            if len(in_flight) >= 2 * workers:
+                pdf_file, future = in_flight.popleft()
+                yield _traced_parse_result(pdf_file, *future.result())
+        while in_flight:
+            pdf_file, future = in_flight.popleft()
+            yield _traced_parse_result(pdf_file, *future.result())
+
+
+def _write_parsed_pdfs(
+    pdf_files: list[Path],
+    text_splitter: "TextSplitter",
+    workers: int,
+    write: Callable[[Document], None],
+    progress: IngestProgress | None = None,
+    page_cache_path: str | Path | None = None,
+) -> list[Path]:
+    if progress is not None:
+        progress.set_total("parse", len(pdf_files))
+        progress.start("parse")
+    parsed = []
+    for raw_document, documents, error in iter_parsed_pdfs(pdf_files, text_splitter, workers, page_cache_path):
+        if error is not None:
+            logger.error("Skipping pdf at %s, parsing failed: %s", raw_document, error)
+        else:
+            for document in documents:
+                write(document)
+            parsed.append(raw_document)
+        if progress is not None:
+            progress.advance("parse")
+    return parsed
+
+
 def parse_documents_as_json(
     source_dir: str | Path,
     target_dir: str | Path,
-    text_splitter: TextSplitter = RecursiveCharacterTextSplitter(),
-):
-    """Parse and split documents from source_dir and save them to target_dir as jsons."""
-
-    raw_documents = Path(source_dir).glob("*.pdf")
-    for raw_document in raw_documents:
-        logger.debug("Parsing pdf at %s", raw_document)
-        # TASK 2.2: Use the text parser of your choice that you imported above to read the text from the raw_document PDF
-        pdf_loader = PyPDFLoader(str(raw_document))
-        # TASK 2.3: find a method to load and chunk text in your text parser
-        pdf_pages = pdf_loader.load_and_split(text_splitter)
-        # TASK 2.4: You will need to add 'from_langchain_document' method to the Document class in model.py
-        for page in pdf_pages:
-            document = Document.from_langchain_document(
-                page
-            ) 
-            document.save(target_dir)
+    text_splitter: "TextSplitter | None" = None,
+    pdf_files: list[Path] | None = None,
+    workers: int = 1,
+    progress: IngestProgress | None = None,
+    page_cache_path: str | Path | None = None,
+) -> list[Path]:
+    """Parse and split documents from source_dir and save them to target_dir as jsons.
+    If pdf_files is given, only these files are parsed instead of all PDFs in source_dir.
+    With workers > 1, the PDFs are parsed in a process pool, one whole file per task.
+    PDFs that fail to parse are logged and skipped. Returns the PDFs that were parsed successfully.
+    With a progress, the parsed files are counted there (see progress.py).
+    With a page_cache_path, PDFs parsed before are only re-chunked, see page_cache.py."""
+
+    raw_documents = sorted(Path(source_dir).glob("*.pdf") if pdf_files is None else pdf_files)
+    if text_splitter is None:
+        text_splitter = default_text_splitter()
+    return _write_parsed_pdfs(
+        raw_documents, text_splitter, workers, lambda document: document.save(target_dir), progress, page_cache_path
+    )
+
+
+def parse_documents_as_shards(
+    source_dir: str | Path,
+    target_dir: str | Path,
+    text_splitter: "TextSplitter | None" = None,
+    pdf_files: list[Path] | None = None,
+    workers: int = 1,
+    progress: IngestProgress | None = None,
+    page_cache_path: str | Path | None = None,
+) -> list[Path]:
+    """Like parse_documents_as_json, but writes the documents to shards (see shards.py) in target_dir."""
+
+    raw_documents = sorted(Path(source_dir).glob("*.pdf") if pdf_files is None else pdf_files)
+    if text_splitter is None:
+        text_splitter = default_text_splitter()
+    with ShardWriter(target_dir) as writer:
+        return _write_parsed_pdfs(raw_documents, text_splitter, workers, writer.write, progress, page_cache_path)
 
 
-def update_document_jsons_with_embedding(source_dir: str | Path, target_dir: str | Path, embedder):
-    """Embeds the documents and saves them to the target_dir."""
+def update_document_jsons_with_embedding(
+    source_dir: str | Path,
+    target_dir: str | Path,
+    embedder,
+    scheduler_config: dict | None = None,
+    progress: IngestProgress | None = None,
+):
+    """Embeds the documents and saves them to the target_dir.
+    The documents are embedded batch-wise by an EmbeddingScheduler and each batch is saved as soon as it is done.
+    Documents that already exist in target_dir are skipped, so calling this again after a failure only embeds the rest."""
     logger.info("Loading documents from %s", source_dir)
-    preprocessed_documents = Path(source_dir).glob("*.json")
+    preprocessed_documents = [
+        preprocessed_document
+        for preprocessed_document in sorted(Path(source_dir).glob("*.json"))
+        if not (Path(target_dir) / preprocessed_document.name).exists()
+    ]
     documents_without_embedding = [
         # TASK: Check the from_json_file method to Document class
         Document.from_json_file(preprocessed_document)
@@ -54,71 +262,537 @@ def update_document_jsons_with_embedding(source_dir: str | Path, target_dir: str
     ]
 
     document_texts = [document.content for document in documents_without_embedding]
+
+    def save_batch(indices: list[int], embeddings: list[list[float]]):
+        for index, embedding in zip(indices, embeddings):
+            document = documents_without_embedding[index]
+            document.add_embedding(embedding)
+            document.save(target_dir)
+        if progress is not None:
+            progress.advance("embed", len(indices))
+
+    if progress is not None:
+        progress.set_total("embed", len(documents_without_embedding))
+        progress.start("embed")
     # TASK 2.5: Get embeddings for document_texts
-    embeddings = embedder.embed_documents(document_texts)
-    logger.info("Embedded %s documents", len(embeddings))
+    scheduler = EmbeddingScheduler(embedder, **(scheduler_config or {}))
+    embeddings = scheduler.embed(
+        document_texts, on_batch_done=save_batch, token_counts=token_counts(documents_without_embedding)
+    )
+    logger.info("Embedded %s documents and saved them to %s", len(embeddings), target_dir)
+
 
-    logging.info("Saving documents to %s", target_dir)
-    for document, embedding in zip(documents_without_embedding, embeddings):
-        document.add_embedding(embedding)
-        document.save(target_dir)
+def _sparse_vectors(sparse_encoder: SparseEncoder | None, documents: list[Document]) -> "list[SparseVector] | None":
+    if sparse_encoder is None:
+        return None
+    with tracer.span("sparse_encode", items=len(documents)):
+        return sparse_encoder.encode_documents([document.content for document in documents])
 
 
 def upload_document_jsons_to_qdrant(
     source_dir: str | Path,
     qdrant_collection: str,
     qdrant_client: QdrantClient,
-):
-    """Uploads embedded documents (vectors) to Qdrant."""
+    upsert_config: dict | None = None,
+    sparse_encoder: SparseEncoder | None = None,
+    progress: IngestProgress | None = None,
+) -> dict[str, list[str]]:
+    """Uploads embedded documents (vectors) to Qdrant and returns the point ids per source document.
+    upsert_config is passed on to upsert_embeddings (batch_size, parallel, max_retries, wait).
+    With a sparse_encoder, the BM25 vectors for hybrid search are uploaded as well."""
     logger.info("Loading documents from %s", source_dir)
     embedded_documents = Path(source_dir).glob("*.json")
     documents = [Document.from_json_file(embedded_document) for embedded_document in embedded_documents]
 
     logger.info("Uploading %s documents to Qdrant", len(documents))
-    document_data_as_dict = [asdict(document) for document in documents]
-    embeddings = [document.pop("embedding") for document in document_data_as_dict]
+    if progress is not None:
+        progress.set_total("upload", len(documents))
+        progress.start("upload")
+    payloads = [document.payload for document in documents]
+    embeddings = [document.embedding for document in documents]
 
     # TASK 2.6: Batch upsert the embeddings to qdrant
     # Hint: check out the function upsert_embeddings in qdrant.py
-    upsert_embeddings(qdrant_client, qdrant_collection, document_data_as_dict, embeddings)
+    ids = upsert_embeddings(
+        qdrant_client,
+        qdrant_collection,
+        payloads,
+        embeddings,
+        ids=[document.point_id for document in documents],
+        sparse_vectors=_sparse_vectors(sparse_encoder, documents),
+        **(upsert_config or {}),
+    )
+    if progress is not None:
+        progress.advance("upload", len(ids))
+
+    chunk_ids = defaultdict(list)
+    for document, point_id in zip(documents, ids):
+        chunk_ids[document.source].append(point_id)
+    return dict(chunk_ids)
+
+
+def update_document_shards_with_embedding(
+    source_dir: str | Path,
+    target_dir: str | Path,
+    embedder,
+    scheduler_config: dict | None = None,
+    progress: IngestProgress | None = None,
+):
+    """Like update_document_jsons_with_embedding, but reads and writes shards (see shards.py).
+    Documents already in the finished shards of target_dir are skipped."""
+    logger.info("Loading documents from %s", source_dir)
+    already_embedded = {document.point_id for document in ShardReader(target_dir).iter_documents()}
+    documents_without_embedding = [
+        document for document in ShardReader(source_dir).iter_documents() if document.point_id not in already_embedded
+    ]
+
+    document_texts = [document.content for document in documents_without_embedding]
+    with ShardWriter(target_dir) as writer:
+
+        def save_batch(indices: list[int], embeddings: list[list[float]]):
+            for index, embedding in zip(indices, embeddings):
+                document = documents_without_embedding[index]
+                document.add_embedding(embedding)
+                writer.write(document)
+                document.embedding = []
+            if progress is not None:
+                progress.advance("embed", len(indices))
 
+        if progress is not None:
+            progress.set_total("embed", len(documents_without_embedding))
+            progress.start("embed")
+        scheduler = EmbeddingScheduler(embedder, **(scheduler_config or {}))
+        embeddings = scheduler.embed(
+            document_texts, on_batch_done=save_batch, token_counts=token_counts(documents_without_embedding)
+        )
+    logger.info("Embedded %s documents and saved them to %s", len(embeddings), target_dir)
 
-def main(text_splitter: TextSplitter = RecursiveCharacterTextSplitter()):
-    """Parse and split documents, embed them, and upload them to Qdrant."""
+
+def upload_document_shards_to_qdrant(
+    source_dir: str | Path,
+    qdrant_collection: str,
+    qdrant_client: QdrantClient,
+    upsert_config: dict | None = None,
+    sparse_encoder: SparseEncoder | None = None,
+    progress: IngestProgress | None = None,
+) -> dict[str, list[str]]:
+    """Uploads embedded documents from shards to Qdrant, one shard at a time, and returns the point ids per source document.
+    The memory-mapped vectors are handed to Qdrant as they are, without converting them to lists."""
+    reader = ShardReader(source_dir)
+    logger.info("Uploading %s documents from %s to Qdrant", len(reader), source_dir)
+    if progress is not None:
+        progress.set_total("upload", len(reader))
+        progress.start("upload")
+
+    chunk_ids = defaultdict(list)
+    for documents, vectors in reader.iter_shards():
+        payloads = [document.payload for document in documents]
+        ids = upsert_embeddings(
+            qdrant_client,
+            qdrant_collection,
+            payloads,
+            vectors,
+            ids=[document.point_id for document in documents],
+            sparse_vectors=_sparse_vectors(sparse_encoder, documents),
+            **(upsert_config or {}),
+        )
+        for document, point_id in zip(documents, ids):
+            chunk_ids[document.source].append(point_id)
+        if progress is not None:
+            progress.advance("upload", len(ids))
+    return dict(chunk_ids)
+
+
+def _page_cache_path(config: dict) -> Path | None:
+    # re-chunking takes the extracted text from here instead of parsing the PDFs again
+    if not config.get("ingest", {}).get("page_cache", True):
+        return None
+    return Path(config["paths"].get("page_cache", PROJECT_ROOT / "data" / "page_cache.sqlite"))
+
+
+def _work_unit_processor(
+    config: dict,
+    queue: WorkQueue,
+    text_splitter: "TextSplitter",
+    embedder,
+    qdrant_client: QdrantClient,
+    collection_name: str,
+    sparse_encoder: SparseEncoder | None = None,
+    progress: IngestProgress | None = None,
+) -> ProcessUnit:
+    """Processes the work units of a run (see work_queue.py): parses, embeds and uploads one PDF, continuing after
+    the last stage it finished. The parsed and embedded documents are kept as shards in the unit's directory."""
+    ingest_config = config.get("ingest", {})
+    page_cache_path = _page_cache_path(config)
+
+    def process_unit(unit: WorkUnit, checkpoint: Callable[[str], None]) -> list[str]:
+        unit_dir = queue.unit_dir(unit)
+        parsed_dir, embedded_dir = unit_dir / "parsed", unit_dir / "embedded"
+        if unit.stage is None:
+            # leftovers of an attempt that was interrupted while parsing
+            shutil.rmtree(unit_dir, ignore_errors=True)
+            with ShardWriter(parsed_dir) as writer:
+                for document in _parse_pdf(Path(unit.source), text_splitter, page_cache_path):
+                    writer.write(document)
+            checkpoint("parse")
+            if progress is not None:
+                progress.advance("parse")
+        if unit.stage == "parse":
+            # skips the documents that were embedded before an interruption
+            update_document_shards_with_embedding(
+                parsed_dir, embedded_dir, embedder=embedder, scheduler_config=ingest_config.get("embedding")
+            )
+            checkpoint("embed")
+            if progress is not None:
+                progress.advance("embed", len(ShardReader(embedded_dir)))
+        # uploading again is harmless, the point ids are deterministic
+        chunk_ids = upload_document_shards_to_qdrant(
+            embedded_dir,
+            qdrant_collection=collection_name,
+            qdrant_client=qdrant_client,
+            upsert_config=config["qdrant"].get("upsert"),
+            sparse_encoder=sparse_encoder,
+        ).get(unit.source, [])
+        if progress is not None:
+            progress.advance("upload", len(chunk_ids))
+        return chunk_ids
+
+    return process_unit
+
+
+def _resumable_run(
+    queue: WorkQueue,
+    qdrant_client: QdrantClient,
+    alias: str,
+    live_collection: str | None,
+    splitter: str,
+    embedder_name: str,
+) -> Run | None:
+    """The interrupted run of the alias, if it can be continued. A run with other settings is abandoned,
+    together with the unfinished version it was building."""
+    run = queue.unfinished_run(alias)
+    if run is None:
+        return None
+    if (run.splitter, run.embedder) == (splitter, embedder_name) and (
+        run.collection == live_collection or qdrant_client.collection_exists(run.collection)
+    ):
+        logger.info("Resuming the interrupted ingestion run %s into %s", run.id, run.collection)
+        return run
+    logger.warning("Abandoning the interrupted ingestion run %s, the settings changed since", run.id)
+    if run.collection != live_collection and qdrant_client.collection_exists(run.collection):
+        delete_db_collection(qdrant_client, run.collection)
+    queue.finish_run(run.id, ABANDONED)
+    return None
+
+
+def _run_work_queue(
+    queue: WorkQueue, run: Run, process_unit: ProcessUnit, workers: int, progress: IngestProgress | None
+) -> tuple[list[Path], dict[str, list[str]]]:
+    """Work on the units of a run until all are done or failed. Returns the ingested PDFs and their chunk ids."""
+    if progress is not None:
+        progress.set_total("parse", sum(unit.stage is None for unit in queue.units(run.id) if unit.status != DONE))
+        progress.start("parse")
+    drain(queue, run.id, process_unit, workers, progress)
+    for unit in queue.units(run.id, FAILED):
+        logger.error("Skipping %s: %s", unit.source, unit.error)
+    done = queue.units(run.id, DONE)
+    return [Path(unit.source) for unit in done], {unit.source: unit.chunk_ids for unit in done}
+
+
+def _embedding_setup(config: dict) -> tuple:
+    """The collection profile, the (cached) embedder, the BM25 encoder for hybrid search (or None), and the name
+    of this combination as it is recorded in the manifest"""
+    qdrant_config = config["qdrant"]
+    # the profile sets quantization and HNSW settings of the collection, and maybe reduced embedding dimensions
+    profile = get_profile(qdrant_config)
+    embedder_config = profile.embedder_config(config["embedder"])
+    # with hybrid search, the points also need BM25 vectors: switching it on or off rebuilds the collection
+    sparse_encoder = get_sparse_encoder(qdrant_config)
+    embedder_name = embedder_id(embedder_config) + ("+bm25" if sparse_encoder else "")
+    embedder = get_cached_embedder(
+        embedder_config, config["paths"].get("embedding_cache", PROJECT_ROOT / "data" / "embedding_cache.sqlite")
+    )
+    return profile, embedder, sparse_encoder, embedder_name
+
+
+def work(text_splitter: "TextSplitter | None" = None):
+    """Join the unfinished ingestion run of the configured collection as an extra worker, see work_queue.py.
+    By default, the chunking settings are taken from the run, e.g. the chunk size chosen in the UI.
+    Needs Qdrant in server mode (qdrant.url), the local storage can only be opened by the ingesting process."""
     config = load_config(PROJECT_ROOT / "config" / "config.yml")
     logging_setup(config)
+    qdrant_config = config["qdrant"]
+    queue_config = get_work_queue_config(config.get("ingest", {}))
+    queue = WorkQueue(work_queue_dir(config), queue_config.lease_seconds, queue_config.max_attempts)
+    run = queue.unfinished_run(qdrant_config["document_collection"])
+    if run is None:
+        logger.info("There is no unfinished ingestion run to work on")
+        return
+
+    if text_splitter is None:
+        text_splitter = text_splitter_from_fingerprint(run.splitter)
+    _, embedder, sparse_encoder, embedder_name = _embedding_setup(config)
+    if (run.splitter, run.embedder) != (splitter_fingerprint(text_splitter), embedder_name):
+        raise ValueError(f"Ingestion run {run.id} uses other chunking or embedding settings than this worker")
+    qdrant_client = instantiate_qclient(
+        qdrant_config.get("storage_path", ""),
+        qdrant_config.get("url", ""),
+        qdrant_config.get("port", 6333),
+        qdrant_config.get("api_key", ""),
+    )
+    process_unit = _work_unit_processor(
+        config, queue, text_splitter, embedder, qdrant_client, run.collection, sparse_encoder
+    )
+    completed = run_worker(queue, run.id, process_unit)
+    logger.info("Completed %s units of ingestion run %s", completed, run.id)
 
-    # wipe everything clean
+
+def main(
+    text_splitter: "TextSplitter | None" = None,
+    qdrant_client: QdrantClient | None = None,
+    progress: IngestProgress | None = None,
+    rebuild: bool = False,
+):
+    """Parse and split documents, embed them, and upload them to Qdrant.
+    Only PDFs that are new or changed since the last run (see manifest.py) are processed,
+    and the points of removed or changed PDFs are deleted from the collection.
+    Pass the qdrant_client of the UI, so the on-disk collection isn't opened twice in local mode.
+    Pass a progress to follow (or cancel) the run from another thread, see progress.py and jobs.py.
+    Full reindexes (first run, other embedder or chunking, or rebuild=True) build a new version of the collection,
+    which replaces the live one only once it is complete and validated, see versions.py.
+    With ingest.work_queue.enabled, an interrupted run continues where it stopped, see work_queue.py."""
+    config = load_config(PROJECT_ROOT / "config" / "config.yml")
+    logging_setup(config)
+    tracing_setup(config)
+    if text_splitter is None:
+        text_splitter = default_text_splitter()
+
+    with tracer.span("ingest"):
+        _ingest(config, text_splitter, qdrant_client, progress, rebuild)
+    tracer.log_summary()
+    tracer.write_prometheus()
+
+
+def _ingest(
+    config: dict,
+    text_splitter: "TextSplitter",
+    qdrant_client: QdrantClient | None,
+    progress: IngestProgress | None,
+    rebuild: bool = False,
+):
+    qdrant_config = config["qdrant"]
+    profile, embedder, sparse_encoder, embedder_name = _embedding_setup(config)
+    splitter = splitter_fingerprint(text_splitter)
+    versioning = get_versioning_config(qdrant_config)
+
+    # the preprocessed and embedded dirs only hold the documents of the current run
     delete_all_files_in_directory(config["paths"]["data"]["preprocessed"])
     delete_all_files_in_directory(config["paths"]["data"]["embedded"])
-    delete_all_files_in_directory(config["qdrant"]["storage_path"])
 
-    create_collection.main()
+    if qdrant_client is None:
+        qdrant_client = instantiate_qclient(qdrant_config["storage_path"])
+    # document_collection is the alias that is searched, see versions.py
+    alias = qdrant_config["document_collection"]
+    live_collection = current_version(qdrant_client, alias)
+    if live_collection is None and qdrant_client.collection_exists(alias):
+        # from before the versioning, replaced by the first new version
+        live_collection = alias
+    manifest_path = config["paths"].get("manifest", PROJECT_ROOT / "data" / "manifest.json")
+    manifest = Manifest.load(version_manifest_path(manifest_path, live_collection))
 
-    embedder = config["embedder"]
-    embedder = get_embedder(embedder)
+    # cached answers based on chunks that change now are invalid, see semantic_cache.py
+    answer_cache = SemanticCache(qdrant_client, config.get("semantic_cache", {}).get("collection", "answer_cache"))
 
-    qdrant_config = config["qdrant"]
-    qdrant_client = instantiate_qclient(qdrant_config["storage_path"])
+    # a different embedding model means different vectors (and maybe vector size), different chunking settings
+    # mean all new chunks: instead of changing the live collection, everything is built into a new version
+    rebuild_reason = None
+    if live_collection is None:
+        rebuild_reason = "there is no collection yet"
+    elif manifest.embedder not in (None, embedder_name):
+        rebuild_reason = f"the embedder changed from {manifest.embedder} to {embedder_name}"
+    elif manifest.entries and all(entry.splitter != splitter for entry in manifest.entries.values()):
+        rebuild_reason = "the chunking settings changed"
+    elif rebuild:
+        rebuild_reason = "a rebuild was requested"
 
-    parse_documents_as_json(
-        config["paths"]["data"]["raw"],
-        config["paths"]["data"]["preprocessed"],
-        text_splitter=text_splitter,
-    )
+    queue_config = get_work_queue_config(config.get("ingest", {}))
+    work_queue, run = None, None
+    if queue_config.enabled:
+        work_queue = WorkQueue(work_queue_dir(config), queue_config.lease_seconds, queue_config.max_attempts)
+        run = _resumable_run(work_queue, qdrant_client, alias, live_collection, splitter, embedder_name)
 
-    update_document_jsons_with_embedding(
-        config["paths"]["data"]["preprocessed"],
-        config["paths"]["data"]["embedded"],
-        embedder=embedder,
-    )
+    if run is not None and run.collection != live_collection:
+        # an interrupted rebuild continues in its version, the units that are done are kept
+        collection_name = run.collection
+        rebuild_reason = f"the rebuild of run {run.id} is resumed"
+        manifest = Manifest(version_manifest_path(manifest_path, collection_name))
+    elif rebuild_reason is not None:
+        if run is not None:
+            # an interrupted incremental run of the live version, superseded by the rebuild
+            work_queue.finish_run(run.id, ABANDONED)
+            run = None
+        collection_name = new_version_name(qdrant_client, alias)
+        logger.info("Building the new version %s of %s, because %s", collection_name, alias, rebuild_reason)
+        manifest = Manifest(version_manifest_path(manifest_path, collection_name))
+        create_db_collection(
+            qdrant_client, collection_name, embedding_dimension(embedder), profile, sparse=sparse_encoder is not None
+        )
+    else:
+        collection_name = live_collection
+        ensure_db_collection(
+            qdrant_client, collection_name, embedding_dimension(embedder), profile, sparse=sparse_encoder is not None
+        )
+    manifest.embedder = embedder_name
 
-    upload_document_jsons_to_qdrant(
-        config["paths"]["data"]["embedded"],
-        qdrant_collection=qdrant_config["document_collection"],
-        qdrant_client=qdrant_client,
+    pdf_files = sorted(Path(config["paths"]["data"]["raw"]).glob("*.pdf"))
+    with tracer.span("manifest_diff", items=len(pdf_files)):
+        diff = manifest.diff(pdf_files, splitter, embedder_name)
+    logger.info(
+        "%s new or changed documents, %s removed documents, %s stale chunks",
+        len(diff.new_or_changed), len(diff.removed), len(diff.stale_chunk_ids),
     )
 
+    stale_chunk_ids = diff.stale_chunk_ids
+    if work_queue is not None and run is None and diff.new_or_changed:
+        run = work_queue.create_run(alias, collection_name, splitter, embedder_name)
+        work_queue.sync_units(run.id, diff.new_or_changed)
+    elif run is not None:
+        work_queue.retry_failed(run.id)
+        # chunks the interrupted run uploaded for PDFs that changed again since
+        stale_chunk_ids = stale_chunk_ids + work_queue.sync_units(run.id, diff.new_or_changed)
+
+    try:
+        for source in diff.removed:
+            manifest.forget(source)
+
+        if diff.new_or_changed:
+            ingest_config = config.get("ingest", {})
+            page_cache_path = _page_cache_path(config)
+
+            if run is not None:
+                process_unit = _work_unit_processor(
+                    config, work_queue, text_splitter, embedder, qdrant_client, collection_name, sparse_encoder,
+                    progress,
+                )
+                parsed_files, chunk_ids = _run_work_queue(work_queue, run, process_unit, queue_config.workers, progress)
+            elif ingest_config.get("streaming", False):
+                from etl.pipeline import StreamingPipeline
+
+                pipeline = StreamingPipeline(
+                    embedder,
+                    qdrant_client,
+                    collection_name,
+                    text_splitter,
+                    parse_workers=ingest_config.get("parse_workers", 1),
+                    scheduler_config=ingest_config.get("embedding"),
+                    queue_size=ingest_config.get("queue_size", 8),
+                    upsert_config=qdrant_config.get("upsert"),
+                    debug_dir=ingest_config.get("debug_dir"),
+                    sparse_encoder=sparse_encoder,
+                    progress=progress,
+                    page_cache_path=page_cache_path,
+                )
+                parsed_files, chunk_ids = pipeline.run(diff.new_or_changed)
+            else:
+                # the three stages run one after another and exchange the documents through the preprocessed and
+                # embedded dirs, either as shards (the default) or as one json file per document
+                if ingest_config.get("storage_format", "shards") == "json":
+                    parse, embed, upload = (
+                        parse_documents_as_json,
+                        update_document_jsons_with_embedding,
+                        upload_document_jsons_to_qdrant,
+                    )
+                else:
+                    parse, embed, upload = (
+                        parse_documents_as_shards,
+                        update_document_shards_with_embedding,
+                        upload_document_shards_to_qdrant,
+                    )
+
+                parsed_files = parse(
+                    config["paths"]["data"]["raw"],
+                    config["paths"]["data"]["preprocessed"],
+                    text_splitter=text_splitter,
+                    pdf_files=diff.new_or_changed,
+                    workers=ingest_config.get("parse_workers", 1),
+                    progress=progress,
+                    page_cache_path=page_cache_path,
+                )
+
+                embed(
+                    config["paths"]["data"]["preprocessed"],
+                    config["paths"]["data"]["embedded"],
+                    embedder=embedder,
+                    scheduler_config=ingest_config.get("embedding"),
+                    progress=progress,
+                )
+
+                chunk_ids = upload(
+                    config["paths"]["data"]["embedded"],
+                    qdrant_collection=collection_name,
+                    qdrant_client=qdrant_client,
+                    upsert_config=qdrant_config.get("upsert"),
+                    sparse_encoder=sparse_encoder,
+                    progress=progress,
+                )
+            logger.info("Embedding cache: %s hits, %s misses", embedder.hits, embedder.misses)
+
+            for pdf_file in diff.new_or_changed:
+                if pdf_file not in parsed_files:
+                    # its old chunks and manifest entry are kept, the next run tries again
+                    continue
+                manifest.record(
+                    str(pdf_file), file_hash(pdf_file), splitter, embedder_name, chunk_ids.get(str(pdf_file), [])
+                )
+
+        # only now that the new chunks are uploaded, so changed PDFs don't vanish from the search in between.
+        # Chunks that kept their position on the page have the same (deterministic) id and were overwritten
+        current_chunk_ids = {chunk_id for entry in manifest.entries.values() for chunk_id in entry.chunk_ids}
+        deleted_chunk_ids = [chunk_id for chunk_id in stale_chunk_ids if chunk_id not in current_chunk_ids]
+        with tracer.span("delete_stale_points", items=len(deleted_chunk_ids)):
+            delete_points(qdrant_client, collection_name, deleted_chunk_ids)
+        # the overwritten chunks have new content as well
+        answer_cache.invalidate_chunks(stale_chunk_ids)
+
+        if rebuild_reason is not None:
+            with tracer.span("validate_version"):
+                validate_version(
+                    qdrant_client,
+                    collection_name,
+                    sum(len(entry.chunk_ids) for entry in manifest.entries.values()),
+                    versioning,
+                    embedder=embedder,
+                    search_params=profile.search_params(),
+                )
+    except BaseException as e:
+        if run is not None and not isinstance(e, VersionValidationError):
+            # the checkpoints and the (unfinished) version are kept for the next start
+            logger.warning("Ingestion run %s was interrupted, the next ingestion continues it", run.id)
+        elif rebuild_reason is not None:
+            # the live version stays as it is
+            logger.warning("Deleting the unfinished version %s", collection_name)
+            delete_db_collection(qdrant_client, collection_name)
+            if run is not None:
+                work_queue.finish_run(run.id, ABANDONED)
+        raise
+
+    manifest.save()
+    if rebuild_reason is not None:
+        swap_alias(qdrant_client, alias, collection_name)
+        answer_cache.clear()
+        cleanup_versions(qdrant_client, alias, versioning, manifest_path)
+    if run is not None:
+        work_queue.finish_run(run.id)
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Ingest the PDFs of paths.data.raw into Qdrant")
+    parser.add_argument("--rebuild", action="store_true", help="build a new version of the collection from scratch")
+    parser.add_argument(
+        "--worker", action="store_true", help="join the unfinished ingestion run as an extra worker, see work_queue.py"
+    )
+    args = parser.parse_args()
+    if args.worker:
+        work()
+    else:
+        main(rebuild=args.rebuild)
@@ -0,0 +1,187 @@
+"""Background jobs, e.g. an ingestion started from the UI. Running it inline would block the UI (and every other
+session of the same process) until the last point is uploaded; as a job it runs in a worker thread, while the
+UI keeps answering questions and only polls the job's progress.
+
+Jobs are recorded in a small SQLite table (status, parameters, progress, error), so their state survives reruns
+of the Streamlit script and restarts of the app. A job that was still queued or running when the process ended
+is marked as failed when the next JobRunner starts, and can be retried from there."""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from etl.progress import IngestProgress
+
+logger = logging.getLogger("AInstein")
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    status: str
+    params: dict = field(default_factory=dict)
+    progress: dict = field(default_factory=dict)
+    error: str | None = None
+    created_at: float | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    @property
+    def duration_seconds(self) -> float | None:
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class JobTable:
+    """SQLite store of the jobs and their progress"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                progress TEXT NOT NULL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at)")
+
+    def create(self, kind: str, params: dict) -> Job:
+        job = Job(id=uuid.uuid4().hex[:12], kind=kind, status=QUEUED, params=params, created_at=time.time())
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.kind, job.status, json.dumps(params), "{}", None, job.created_at, None, None),
+            )
+        return job
+
+    def update(self, job_id: str, **values):
+        """Set columns of a job, e.g. update(job_id, status=RUNNING, started_at=time.time())"""
+        if "progress" in values:
+            values["progress"] = json.dumps(values["progress"])
+        columns = ", ".join(f"{column} = ?" for column in values)
+        with self._lock:
+            self._connection.execute(f"UPDATE jobs SET {columns} WHERE id = ?", [*values.values(), job_id])
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def recent(self, kind: str | None = None, limit: int = 10) -> list[Job]:
+        """The latest jobs, newest first"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM jobs WHERE ? IS NULL OR kind = ? ORDER BY created_at DESC LIMIT ?", (kind, kind, limit)
+            ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def fail_unfinished(self, reason: str) -> int:
+        """Mark queued and running jobs as failed, e.g. those of a process that ended. Returns their number."""
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status IN (?, ?)",
+                (FAILED, reason, time.time(), QUEUED, RUNNING),
+            )
+        return cursor.rowcount
+
+    @staticmethod
+    def _job(row: tuple) -> Job:
+        job_id, kind, status, params, progress, error, created_at, started_at, finished_at = row
+        return Job(
+            job_id, kind, status, json.loads(params), json.loads(progress), error, created_at, started_at, finished_at
+        )
+
+    def close(self):
+        self._connection.close()
+
+
+class JobRunner:
+    """Runs jobs of one kind in a thread pool and keeps their state in a JobTable
+
+    Args:
+        table (JobTable): where the jobs are recorded
+        kind (str): the kind of jobs, e.g. "ingestion"
+        run_job (Callable): does the work, called with the job's params, an IngestProgress to report to and the
+            resources passed to submit as keyword arguments
+        workers (int): number of jobs running at the same time, 1 runs them one after another
+    """
+
+    def __init__(self, table: JobTable, kind: str, run_job: Callable[..., None], workers: int = 1):
+        self.table = table
+        self.kind = kind
+        self.run_job = run_job
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"job-{kind}")
+        self._progress: dict[str, IngestProgress] = {}
+        interrupted = table.fail_unfinished("Interrupted, the app was restarted while the job was running")
+        if interrupted:
+            logger.warning("Marked %s unfinished %s jobs of an earlier process as failed", interrupted, kind)
+
+    def submit(self, params: dict, **resources) -> str:
+        """Queue a job, returns its id. The params are stored with the job (so it can be retried) and must be
+        json serializable, the resources (e.g. the Qdrant client) are only passed on to run_job."""
+        job = self.table.create(self.kind, params)
+        progress = IngestProgress(on_change=lambda snapshot: self.table.update(job.id, progress=snapshot))
+        self._progress[job.id] = progress
+        self._executor.submit(self._run, job.id, params, progress, resources)
+        logger.info("Queued %s job %s", self.kind, job.id)
+        return job.id
+
+    def cancel(self, job_id: str):
+        """Request the cancellation of a job; a running job stops at its next progress update"""
+        progress = self._progress.get(job_id)
+        if progress is not None:
+            progress.cancel()
+
+    def retry(self, job_id: str, **resources) -> str:
+        """Queue a new job with the parameters of an earlier one, returns the new id"""
+        return self.submit(self.table.get(job_id).params, **resources)
+
+    def active(self) -> list[Job]:
+        """The queued and running jobs of this runner"""
+        return [job for job in self.table.recent(self.kind, limit=50) if not job.finished]
+
+    def _run(self, job_id: str, params: dict, progress: IngestProgress, resources: dict):
+        if progress.cancelled:
+            self.table.update(job_id, status=CANCELLED, finished_at=time.time())
+            return
+        self.table.update(job_id, status=RUNNING, started_at=time.time())
+        try:
+            self.run_job(params, progress, **resources)
+            status, error = SUCCEEDED, None
+        except Exception as e:
+            # the job may fail with a wrapping error (e.g. PipelineError) when it was cancelled in a worker thread
+            status, error = (CANCELLED, None) if progress.cancelled else (FAILED, f"{type(e).__name__}: {e}")
+            if status == FAILED:
+                logger.exception("%s job %s failed", self.kind, job_id)
+        finally:
+            self._progress.pop(job_id, None)
+        progress.flush()
+        self.table.update(job_id, status=status, error=error, finished_at=time.time())
+        logger.info("%s job %s %s", self.kind, job_id, status)
@@ -0,0 +1,141 @@
+"""The manifest remembers which PDFs have already been ingested and which Qdrant points belong to them.
+With it, a re-run of the ingestion only parses, embeds and uploads files that are new or changed,
+and removes the points of files that are gone - instead of wiping and rebuilding everything."""
+
+import hashlib
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+logger = logging.getLogger("AInstein")
+
+
+@dataclass
+class ManifestEntry:
+    content_hash: str
+    splitter: str
+    embedder: str
+    chunk_ids: list[str] = field(default_factory=list)
+
+
+@dataclass
+class ManifestDiff:
+    new_or_changed: list[Path]
+    removed: list[str]
+    stale_chunk_ids: list[str]
+
+
+def file_hash(file_name: str | Path) -> str:
+    """Return the sha256 hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def splitter_fingerprint(text_splitter) -> str:
+    """Return a stable string describing the settings of a text splitter.
+    If any setting changes (e.g. chunk_size), all files have to be re-chunked."""
+    settings = {
+        key: getattr(value, "__name__", value) if callable(value) else value
+        for key, value in sorted(vars(text_splitter).items())
+    }
+    settings["class"] = type(text_splitter).__name__
+    return json.dumps(settings, sort_keys=True, default=str)
+
+
+def text_splitter_from_fingerprint(fingerprint: str):
+    """Build the text splitter a fingerprint was taken of (see splitter_fingerprint), e.g. to join an ingestion
+    run that was started with other chunking settings than the defaults. Only RecursiveCharacterTextSplitters
+    that count characters can be rebuilt, anything else raises a ValueError."""
+    # langchain is imported on first use, it takes about a second
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    settings = json.loads(fingerprint)
+    splitter_class, length_function = settings.pop("class", None), settings.pop("_length_function", None)
+    if (splitter_class, length_function) != (RecursiveCharacterTextSplitter.__name__, "len"):
+        raise ValueError(f"Can't rebuild the text splitter {fingerprint}")
+    # the settings are the attributes of the splitter, the constructor takes them without the underscore
+    text_splitter = RecursiveCharacterTextSplitter(**{key.lstrip("_"): value for key, value in settings.items()})
+    if splitter_fingerprint(text_splitter) != fingerprint:
+        raise ValueError(f"Can't rebuild the text splitter {fingerprint}")
+    return text_splitter
+
+
+class Manifest:
+    """Maps every ingested PDF to (content hash, splitter settings, embedder model) and its chunk ids."""
+
+    def __init__(self, path: str | Path, embedder: str | None = None, entries: dict[str, ManifestEntry] | None = None):
+        self.path = Path(path)
+        self.embedder = embedder
+        self.entries = entries or {}
+
+    @staticmethod
+    def load(path: str | Path):
+        """Load the manifest from a json file, or start an empty one if there is none"""
+        path = Path(path)
+        if not path.exists():
+            logger.info("No manifest found at %s, starting a new one", path)
+            return Manifest(path)
+
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        entries = {source: ManifestEntry(**entry) for source, entry in data["entries"].items()}
+        return Manifest(path, embedder=data.get("embedder"), entries=entries)
+
+    def save(self):
+        """Save the manifest. It is written to a temporary file first, so a crash never leaves a broken manifest"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.path.with_suffix(self.path.suffix + ".tmp")
+        data = {
+            "embedder": self.embedder,
+            "entries": {source: asdict(entry) for source, entry in sorted(self.entries.items())},
+        }
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_file, self.path)
+
+    def clear(self):
+        self.entries = {}
+
+    def diff(self, pdf_files: list[Path], splitter: str, embedder: str) -> ManifestDiff:
+        """Compare the PDFs on disk with the manifest
+
+        Args:
+            pdf_files (List[Path]): all PDFs currently in the source directory
+            splitter (str): fingerprint of the text splitter, see splitter_fingerprint
+            embedder (str): name of the embedding model
+
+        Returns:
+            ManifestDiff: the files to (re-)ingest, the removed sources and the chunk ids that have to be deleted
+        """
+        new_or_changed = []
+        stale_chunk_ids = []
+        current_sources = set()
+        for pdf_file in pdf_files:
+            source = str(pdf_file)
+            current_sources.add(source)
+            entry = self.entries.get(source)
+            if entry is not None and entry.splitter == splitter and entry.embedder == embedder:
+                if entry.content_hash == file_hash(pdf_file):
+                    continue
+            new_or_changed.append(pdf_file)
+            if entry is not None:
+                stale_chunk_ids.extend(entry.chunk_ids)
+
+        removed = sorted(set(self.entries) - current_sources)
+        for source in removed:
+            stale_chunk_ids.extend(self.entries[source].chunk_ids)
+
+        return ManifestDiff(new_or_changed=new_or_changed, removed=removed, stale_chunk_ids=stale_chunk_ids)
+
+    def record(self, source: str, content_hash: str, splitter: str, embedder: str, chunk_ids: list[str]):
+        self.entries[source] = ManifestEntry(
+            content_hash=content_hash, splitter=splitter, embedder=embedder, chunk_ids=list(chunk_ids)
+        )
+
+    def forget(self, source: str):
+        self.entries.pop(source, None)
@@ -2,22 +2,30 @@
 It specifies key attributes of a document that we will work with, such as its content, source and page number."""
 import json
 import logging
+import uuid
 from dataclasses import asdict, dataclass, field
 from pathlib import Path
 from typing import Protocol, TypedDict
 
 logger = logging.getLogger("AInstein")
 
+# namespace for the uuid5 point ids, so the same chunk always gets the same id in Qdrant
+POINT_ID_NAMESPACE = uuid.UUID("6f1d8e2a-4b7c-5d9e-8f0a-1b2c3d4e5f60")
+
 
 class LangchainDocument(Protocol):
     page_content: str
     metadata: dict[str, str | int]
 
 
-class PayloadDict(TypedDict):
+class PayloadDict(TypedDict, total=False):
     content: str
     source: str
     page: int
+    chunk: int
+    start_index: int | None
+    tokens: int | None
+    name: str
 
 
 class ScoredPoint(Protocol):
@@ -31,16 +39,35 @@ class Document:
     source: str
     page: int
     embedding: list[float] = field(default_factory=list)
+    chunk: int = 0
+    start_index: int | None = None
+    tokens: int | None = None  # counted once at ingestion, for batching and context packing
 
     def __post_init__(self):
         self.name = Path(self.source).stem
 
+    @property
+    def point_id(self) -> str:
+        """A deterministic id for Qdrant, derived from source, page and the position of the chunk on the page.
+        Uploading the same chunk again overwrites its point instead of adding a duplicate."""
+        position = self.start_index if self.start_index is not None else f"chunk{self.chunk}"
+        return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{self.source}|{self.page}|{position}"))
+
+    @property
+    def payload(self) -> PayloadDict:
+        """The payload of the Qdrant point: all fields except the embedding, plus the name to filter on"""
+        payload = asdict(self)
+        payload.pop("embedding")
+        payload["name"] = self.name
+        return payload
+
     def add_embedding(self, embedding: list[float]):
         self.embedding = embedding
 
     @staticmethod
-    def from_langchain_document(document: LangchainDocument):
-        """Here, we extract the content, source and page from the document"""
+    def from_langchain_document(document: LangchainDocument, chunk: int = 0):
+        """Here, we extract the content, source and page from the document.
+        chunk is the number of the chunk on its page, start_index is only set if the text splitter adds it"""
         return Document(
             # TASK 2.4: Extract content, source and page from document using LangchainDocument methods
             # TASK: Extract text from document
@@ -48,7 +75,9 @@ class Document:
             # TASK: Extract source from document metadata
             source=document.metadata["source"],
             # TASK: Extract page from document metadata
-            page=document.metadata["page"]
+            page=document.metadata["page"],
+            chunk=chunk,
+            start_index=document.metadata.get("start_index"),
         )
 
     @staticmethod
@@ -69,14 +98,18 @@ class Document:
             # TASK: Extract source from scored point payload
             source=scored_point.payload["source"],
             # TASK: Extract page from scored point payload
-            page=scored_point.payload["page"]
+            page=scored_point.payload["page"],
+            chunk=scored_point.payload.get("chunk", 0),
+            start_index=scored_point.payload.get("start_index"),
+            tokens=scored_point.payload.get("tokens"),
         )
 
     def save(self, target_dir: str | Path):
         """Save the document to a json file"""
         save_location = Path(target_dir)
         save_location.mkdir(parents=True, exist_ok=True)
-        file_name = save_location / f"{self.name}_{self.page}.json"
+        # several chunks can come from the same page, so the chunk number is part of the file name
+        file_name = save_location / f"{self.name}_{self.page}_{self.chunk}.json"
         logger.debug("Saving document to %s", file_name)
 
         with open(file_name, "w", encoding="utf-8") as f:
@@ -0,0 +1,118 @@
+"""A cache of the text extracted from PDFs, so changing the chunking settings doesn't parse the PDFs again.
+Text extraction is by far the slowest CPU step of the ingestion, and its result doesn't depend on the text splitter.
+
+The pages of each PDF are stored in a local SQLite database, keyed by the sha256 of the file content and the
+parser version, as one zlib-compressed json blob per file. A re-chunking run loads the pages from here and only
+runs the text splitter. Unchanged chunks are then embedding cache hits (see llm/embed_cache.py), so only chunks
+whose text actually changed are sent to the embeddings API. The least recently used files are evicted once the
+cache holds more than max_entries of them.
+
+Each process (e.g. a parser worker) opens its own connection, see get_page_cache."""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+from etl.model import LangchainDocument
+
+logger = logging.getLogger("AInstein")
+
+
+def parser_id() -> str:
+    """Name and version of the PDF parser: a new version may extract the text differently"""
+    try:
+        return f"pypdf-{version('pypdf')}"
+    except PackageNotFoundError:
+        return "pypdf"
+
+
+class PageTextCache:
+    """SQLite store of the extracted pages of PDFs, with size-bounded LRU eviction"""
+
+    def __init__(self, path: str | Path, max_entries: int = 10_000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.parser = parser_id()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                content_hash TEXT NOT NULL,
+                parser TEXT NOT NULL,
+                pages BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (content_hash, parser)
+            ) WITHOUT ROWID"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+
+    def get(self, content_hash: str, source: str) -> list[LangchainDocument] | None:
+        """The pages of a PDF (with source set to its current path), None if it isn't cached"""
+        from langchain_core.documents import Document as LangchainPage
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT pages FROM pages WHERE content_hash = ? AND parser = ?", (content_hash, self.parser)
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE pages SET last_used = ? WHERE content_hash = ? AND parser = ?",
+                (time.time(), content_hash, self.parser),
+            )
+        return [
+            LangchainPage(page_content=text, metadata={**metadata, "source": source})
+            for text, metadata in json.loads(zlib.decompress(row[0]))
+        ]
+
+    def put(self, content_hash: str, pages: list[LangchainDocument]):
+        """Store the pages of a PDF. The source is left out, the same file may be at another path next time."""
+        data = [
+            (page.page_content, {key: value for key, value in page.metadata.items() if key != "source"})
+            for page in pages
+        ]
+        blob = zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)", (content_hash, self.parser, blob, time.time())
+            )
+            self._evict()
+
+    def _evict(self):
+        (size,) = self._connection.execute("SELECT COUNT(*) FROM pages").fetchone()
+        if size <= self.max_entries:
+            return
+        logger.debug("Evicting %s pdfs from the page cache", size - self.max_entries)
+        self._connection.execute(
+            """DELETE FROM pages WHERE (content_hash, parser) IN (
+                SELECT content_hash, parser FROM pages ORDER BY last_used LIMIT ?
+            )""",
+            (size - self.max_entries,),
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+
+_page_caches: dict[str, PageTextCache] = {}
+_page_caches_lock = threading.Lock()
+
+
+def get_page_cache(path: str | Path) -> PageTextCache:
+    """The page cache at path, opened once per process"""
+    with _page_caches_lock:
+        if str(path) not in _page_caches:
+            _page_caches[str(path)] = PageTextCache(path)
+        return _page_caches[str(path)]
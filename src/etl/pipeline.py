@@ -0,0 +1,232 @@
+"""A streaming version of the ingestion: instead of three full passes (parse -> json files -> embed -> json files -> upload),
+chunks flow through bounded queues from the PDF parser to the embedding batches to the Qdrant upserts.
+All three stages run at the same time, and memory stays constant no matter how large the corpus is.
+Writing the intermediate documents to disk is only done on request, for debugging."""
+
+import logging
+import queue
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from etl.ingest import iter_parsed_pdfs
+from etl.model import Document
+from etl.progress import IngestProgress
+from etl.qdrant import QdrantClient, upsert_embeddings
+from etl.sparse import SparseEncoder
+from llm.embed_scheduler import EmbeddingScheduler
+from llm.tokens import count_tokens
+
+if TYPE_CHECKING:
+    from langchain.text_splitter import TextSplitter
+
+logger = logging.getLogger("AInstein")
+
+_DONE = object()
+
+
+class PipelineError(RuntimeError):
+    """Raised when a stage of the streaming pipeline failed."""
+
+
+class StreamingPipeline:
+    """Runs parse -> embed -> upsert as overlapping stages connected by bounded queues"""
+
+    def __init__(
+        self,
+        embedder,
+        qdrant_client: QdrantClient,
+        qdrant_collection: str,
+        text_splitter: "TextSplitter",
+        parse_workers: int = 1,
+        scheduler_config: dict | None = None,
+        queue_size: int = 8,
+        upsert_config: dict | None = None,
+        debug_dir: str | Path | None = None,
+        sparse_encoder: SparseEncoder | None = None,
+        progress: IngestProgress | None = None,
+        page_cache_path: str | Path | None = None,
+    ):
+        self.scheduler = EmbeddingScheduler(embedder, **(scheduler_config or {}))
+        self.qdrant_client = qdrant_client
+        self.qdrant_collection = qdrant_collection
+        self.text_splitter = text_splitter
+        self.parse_workers = parse_workers
+        self.upsert_config = upsert_config or {}
+        self.debug_dir = Path(debug_dir) if debug_dir else None
+        self.sparse_encoder = sparse_encoder
+        self.progress = progress
+        self.page_cache_path = page_cache_path
+
+        # chunks: parser -> embedder, batches: embedder -> uploader. Both are bounded, so a slow stage slows down the
+        # ones before it instead of piling up documents in memory
+        self._chunks: queue.Queue = queue.Queue(maxsize=queue_size * self.scheduler.max_batch_size)
+        self._batches: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._errors: list[BaseException] = []
+
+        self.parsed_files: list[Path] = []
+        self.chunk_ids: dict[str, list[str]] = defaultdict(list)
+
+    def _put(self, target: queue.Queue, item):
+        """Put an item into a queue, but give up when another stage failed"""
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, error: BaseException):
+        self._errors.append(error)
+        self._stop.set()
+
+    def _parse_stage(self, pdf_files: list[Path]):
+        progress = self.progress
+        if progress is not None:
+            progress.set_total("parse", len(pdf_files))
+            for stage in ("parse", "embed", "upload"):
+                progress.start(stage)
+        chunks = 0
+        try:
+            for pdf_file, documents, error in iter_parsed_pdfs(
+                pdf_files, self.text_splitter, self.parse_workers, self.page_cache_path
+            ):
+                if error is not None:
+                    logger.error("Skipping pdf at %s, parsing failed: %s", pdf_file, error)
+                else:
+                    for document in documents:
+                        if self.debug_dir is not None:
+                            document.save(self.debug_dir / "preprocessed")
+                        if not self._put(self._chunks, document):
+                            return
+                    self.parsed_files.append(pdf_file)
+                    chunks += len(documents)
+                if progress is not None:
+                    progress.advance("parse")
+            if progress is not None:
+                # only known now that all files are parsed
+                progress.set_total("embed", chunks)
+                progress.set_total("upload", chunks)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(self._chunks, _DONE)
+
+    def _embed_stage(self):
+        scheduler = self.scheduler
+        in_flight: deque[tuple[list[Document], Future]] = deque()
+
+        def hand_over_finished(block: bool):
+            while in_flight and (block or in_flight[0][1].done()):
+                documents, future = in_flight.popleft()
+                if not self._put(self._batches, (documents, future.result())):
+                    return
+                if self.progress is not None:
+                    self.progress.advance("embed", len(documents))
+
+        try:
+            with ThreadPoolExecutor(max_workers=scheduler.max_concurrency) as executor:
+                batch, batch_tokens = [], 0
+                while True:
+                    document = self._get(self._chunks)
+                    tokens = 0
+                    if document is not _DONE:
+                        tokens = document.tokens if document.tokens is not None else count_tokens(document.content)
+                    full = batch and (
+                        document is _DONE
+                        or batch_tokens + tokens > scheduler.max_batch_tokens
+                        or len(batch) >= scheduler.max_batch_size
+                    )
+                    if full:
+                        texts = [chunk.content for chunk in batch]
+                        in_flight.append((batch, executor.submit(scheduler.embed_batch, texts, batch_tokens)))
+                        batch, batch_tokens = [], 0
+                        # never more than max_concurrency batches waiting for the API
+                        hand_over_finished(block=len(in_flight) >= scheduler.max_concurrency)
+                    if document is _DONE:
+                        break
+                    batch.append(document)
+                    batch_tokens += tokens
+                hand_over_finished(block=True)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(self._batches, _DONE)
+
+    def _upsert_stage(self):
+        while True:
+            item = self._get(self._batches)
+            if item is _DONE:
+                return
+            documents, embeddings = item
+            for document, embedding in zip(documents, embeddings):
+                document.add_embedding(embedding)
+                if self.debug_dir is not None:
+                    document.save(self.debug_dir / "embedded")
+
+            payloads = [document.payload for document in documents]
+            sparse_vectors = None
+            if self.sparse_encoder is not None:
+                sparse_vectors = self.sparse_encoder.encode_documents([document.content for document in documents])
+            ids = upsert_embeddings(
+                self.qdrant_client,
+                self.qdrant_collection,
+                payloads,
+                embeddings,
+                ids=[document.point_id for document in documents],
+                sparse_vectors=sparse_vectors,
+                **self.upsert_config,
+            )
+            for document, point_id in zip(documents, ids):
+                document.embedding = []  # don't keep the vectors around
+                self.chunk_ids[document.source].append(point_id)
+            logger.debug("Upserted %s documents", len(documents))
+            if self.progress is not None:
+                self.progress.advance("upload", len(documents))
+
+    def run(self, pdf_files: list[Path]) -> tuple[list[Path], dict[str, list[str]]]:
+        """Ingest the given PDFs
+
+        Args:
+            pdf_files (List[Path]): PDFs to parse, embed and upload
+
+        Raises:
+            PipelineError: if any of the stages failed
+
+        Returns:
+            Tuple[List[Path], Dict[str, List[str]]]: the PDFs that were parsed, and the point ids per source document
+        """
+        stages = [
+            threading.Thread(target=self._parse_stage, args=(sorted(pdf_files),), name="ingest-parse", daemon=True),
+            threading.Thread(target=self._embed_stage, name="ingest-embed", daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+        try:
+            self._upsert_stage()
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            for stage in stages:
+                stage.join()
+
+        if self._errors:
+            raise PipelineError(f"Streaming ingestion failed: {self._errors[0]!r}") from self._errors[0]
+        logger.info(
+            "Streamed %s pdfs with %s chunks to Qdrant",
+            len(self.parsed_files),
+            sum(len(ids) for ids in self.chunk_ids.values()),
+        )
+        return self.parsed_files, dict(self.chunk_ids)
@@ -0,0 +1,141 @@
+"""Collection profiles trade memory for recall. A plain collection keeps every float32 vector and the HNSW graph in RAM,
+which adds up quickly for large corpora with text-embedding-3-large (3072 dimensions, 12 KB per chunk).
+A profile can instead
+    - quantize the vectors (scalar: int8, 4x smaller; binary: 1 bit, 32x smaller) and keep only those in RAM,
+      while the original vectors stay on disk and are used to rescore an oversampled candidate list,
+    - tune the HNSW graph (m, ef_construct) and the search-time ef,
+    - ask the embedding API for fewer dimensions (text-embedding-3 models support the dimensions parameter).
+
+Profiles are selected in the config:
+
+    qdrant:
+      profile: scalar
+      profiles:           # optional: own profiles, or overrides of the built-in ones below
+        scalar_1024:
+          quantization: scalar
+          on_disk: true
+          dimensions: 1024
+
+Use `python -m bench.collection_profiles` to measure recall and memory of the profiles on your own data."""
+
+import logging
+from collections.abc import Mapping
+from dataclasses import dataclass, fields, replace
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from qdrant_client.http.models import BinaryQuantization, HnswConfigDiff, ScalarQuantization, SearchParams
+
+logger = logging.getLogger("AInstein")
+
+
+@dataclass(frozen=True)
+class CollectionProfile:
+    name: str = "default"
+    quantization: str | None = None  # None, "scalar" or "binary"
+    always_ram: bool = True  # keep the quantized vectors in RAM
+    on_disk: bool = False  # keep the original vectors on disk
+    m: int | None = None  # HNSW edges per node, Qdrant's default is 16
+    ef_construct: int | None = None  # HNSW build-time neighbours, Qdrant's default is 100
+    hnsw_ef: int | None = None  # HNSW search-time neighbours
+    oversampling: float | None = None  # fetch oversampling * limit candidates with the quantized vectors ...
+    rescore: bool = True  # ... and rescore them with the original vectors
+    dimensions: int | None = None  # reduced embedding dimensions
+
+    def __post_init__(self):
+        if self.quantization not in (None, "scalar", "binary"):
+            raise ValueError(f"Unknown quantization {self.quantization!r} in profile {self.name}, use scalar or binary")
+
+    # the qdrant_client models are imported where they are needed, so reading profiles stays cheap
+    def hnsw_config(self) -> "HnswConfigDiff | None":
+        from qdrant_client.http.models import HnswConfigDiff
+
+        if self.m is None and self.ef_construct is None:
+            return None
+        return HnswConfigDiff(m=self.m, ef_construct=self.ef_construct)
+
+    def quantization_config(self) -> "ScalarQuantization | BinaryQuantization | None":
+        from qdrant_client.http.models import (
+            BinaryQuantization,
+            BinaryQuantizationConfig,
+            ScalarQuantization,
+            ScalarQuantizationConfig,
+            ScalarType,
+        )
+
+        if self.quantization == "scalar":
+            return ScalarQuantization(
+                scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=self.always_ram)
+            )
+        if self.quantization == "binary":
+            return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=self.always_ram))
+        return None
+
+    def search_params(self) -> "SearchParams | None":
+        """The search parameters to pass with every query on a collection of this profile"""
+        from qdrant_client.http.models import QuantizationSearchParams, SearchParams
+
+        quantization = None
+        if self.quantization is not None:
+            quantization = QuantizationSearchParams(rescore=self.rescore, oversampling=self.oversampling)
+        if self.hnsw_ef is None and quantization is None:
+            return None
+        return SearchParams(hnsw_ef=self.hnsw_ef, quantization=quantization)
+
+    def embedder_config(self, embedder) -> dict | str:
+        """The embedder config with the reduced dimensions of this profile, if it has any"""
+        if self.dimensions is None:
+            return embedder
+        # imported here, so the qdrant helpers don't depend on the embedder backends
+        from llm.embed import embedder_settings
+
+        return {**embedder_settings(embedder), "dimensions": self.dimensions}
+
+    def estimated_memory(self, points: int, dim: int) -> dict[str, int]:
+        """Rough RAM and disk usage in bytes of the vectors and the HNSW graph of a collection with this profile"""
+        dim = self.dimensions or dim
+        original = points * dim * 4
+        quantized = {"scalar": points * dim, "binary": points * ((dim + 7) // 8)}.get(self.quantization, 0)
+        # every node has up to 2 * m links of 4 bytes on the bottom layer
+        graph = points * 2 * (self.m or 16) * 4
+        ram = graph + (0 if self.on_disk else original) + (quantized if self.always_ram else 0)
+        disk = original + quantized + graph
+        return {"ram_bytes": ram, "disk_bytes": disk}
+
+
+BUILTIN_PROFILES = {
+    "default": CollectionProfile(),
+    # int8 vectors in RAM, 4x less memory, nearly lossless after rescoring
+    "scalar": CollectionProfile(name="scalar", quantization="scalar", on_disk=True, oversampling=2.0, hnsw_ef=128),
+    # 1 bit per dimension in RAM, 32x less memory; works well for the high-dimensional OpenAI embeddings
+    "binary": CollectionProfile(name="binary", quantization="binary", on_disk=True, oversampling=3.0, hnsw_ef=128),
+    # binary quantization of 1024 instead of 3072 dimensions (text-embedding-3-large)
+    "binary_1024": CollectionProfile(
+        name="binary_1024", quantization="binary", on_disk=True, oversampling=3.0, hnsw_ef=128, dimensions=1024
+    ),
+}
+
+
+def profile_from_config(name: str, settings: Mapping | None = None) -> CollectionProfile:
+    """A built-in profile (or the default one), overridden by the given settings"""
+    base = BUILTIN_PROFILES.get(name, CollectionProfile())
+    settings = dict(settings or {})
+    unknown = set(settings) - {field.name for field in fields(CollectionProfile)}
+    if unknown:
+        raise ValueError(f"Unknown settings {sorted(unknown)} in collection profile {name}")
+    return replace(base, **{**settings, "name": name})
+
+
+def get_profile(qdrant_config: Mapping) -> CollectionProfile:
+    """The collection profile selected by qdrant.profile in the config (default: no quantization, default HNSW)"""
+    name = qdrant_config.get("profile", "default")
+    profiles = qdrant_config.get("profiles", {}) or {}
+    if name not in profiles and name not in BUILTIN_PROFILES:
+        raise ValueError(f"Unknown collection profile {name!r}, choose one of {sorted({*BUILTIN_PROFILES, *profiles})}")
+    return profile_from_config(name, profiles.get(name))
+
+
+def all_profiles(qdrant_config: Mapping | None = None) -> dict[str, CollectionProfile]:
+    """The built-in profiles and the ones defined in the config"""
+    profiles = (qdrant_config or {}).get("profiles", {}) or {}
+    return {name: profile_from_config(name, profiles.get(name)) for name in {**BUILTIN_PROFILES, **profiles}}
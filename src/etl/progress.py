@@ -0,0 +1,115 @@
+"""Progress of an ingestion run, per stage: files parsed, chunks embedded and points upserted.
+The ingestion functions advance the counters (from whichever thread does the work), a UI or job runner reads
+snapshots with throughput and ETA. Advancing is also where a requested cancellation takes effect: the next
+advance() raises IngestionCancelled, so a run stops after the file or batch it is working on.
+
+Cancelling is safe with the incremental ingestion: the manifest is only saved at the end of a run, so the next
+run picks up the same new or changed PDFs again, and re-uploaded points overwrite the partial ones (same ids)."""
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+STAGE_UNITS = {"parse": "files", "embed": "chunks", "upload": "points"}
+
+
+class IngestionCancelled(Exception):
+    """Raised inside the ingestion when its cancellation was requested"""
+
+
+@dataclass
+class StageProgress:
+    done: int = 0
+    total: int | None = None  # None while unknown, e.g. the chunks before parsing is done
+    started_at: float | None = None
+    updated_at: float | None = None
+
+    @property
+    def rate(self) -> float | None:
+        """Items per second since the stage started"""
+        if not self.done or self.started_at is None or self.updated_at <= self.started_at:
+            return None
+        return self.done / (self.updated_at - self.started_at)
+
+    @property
+    def eta_seconds(self) -> float | None:
+        rate = self.rate
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+
+class IngestProgress:
+    """Thread-safe progress counters of the ingestion stages, with cancellation
+
+    Args:
+        on_change (Callable, optional): called with to_dict() after changes, at most every min_interval seconds,
+            e.g. to store the progress of a background job
+        min_interval (float): seconds between on_change calls
+    """
+
+    def __init__(self, on_change: Callable[[dict], None] | None = None, min_interval: float = 0.5):
+        self.stages = {stage: StageProgress() for stage in STAGE_UNITS}
+        self.on_change = on_change
+        self.min_interval = min_interval
+        self._last_change = 0.0
+        self._cancel_requested = threading.Event()
+        self._lock = threading.Lock()
+
+    def set_total(self, stage: str, total: int):
+        with self._lock:
+            self.stages[stage].total = total
+        self._changed()
+
+    def advance(self, stage: str, count: int = 1):
+        """Count finished items of a stage. Raises IngestionCancelled if the run was cancelled."""
+        now = time.time()
+        with self._lock:
+            progress = self.stages[stage]
+            if progress.started_at is None:
+                progress.started_at = now
+            progress.done += count
+            progress.updated_at = now
+        self._changed()
+        self.raise_if_cancelled()
+
+    def start(self, stage: str):
+        """Start the clock of a stage, so its rate includes the time until the first item is done"""
+        with self._lock:
+            if self.stages[stage].started_at is None:
+                self.stages[stage].started_at = time.time()
+
+    def cancel(self):
+        self._cancel_requested.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_requested.is_set()
+
+    def raise_if_cancelled(self):
+        if self._cancel_requested.is_set():
+            raise IngestionCancelled("Ingestion was cancelled")
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                stage: {
+                    "done": progress.done,
+                    "total": progress.total,
+                    "unit": STAGE_UNITS[stage],
+                    "rate": progress.rate,
+                    "eta_seconds": progress.eta_seconds,
+                }
+                for stage, progress in self.stages.items()
+            }
+
+    def flush(self):
+        """Report the current state to on_change right away, e.g. when the run is over"""
+        if self.on_change is not None:
+            self._last_change = time.monotonic()
+            self.on_change(self.to_dict())
+
+    def _changed(self):
+        if self.on_change is not None and time.monotonic() - self._last_change >= self.min_interval:
+            self.flush()
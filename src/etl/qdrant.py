@@ -1,19 +1,91 @@
 """Qdrant client for embedding storage and retrieval - lots of useful functions to interact with our database"""
 
+import logging
 import os
 import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
 
+import numpy as np
 from qdrant_client.http.exceptions import UnexpectedResponse
-from qdrant_client.http.models import Batch, Distance, VectorParams
-from qdrant_client.http.models.models import ScoredPoint
+from qdrant_client.http.models import (
+    BinaryQuantization,
+    Disabled,
+    Distance,
+    FieldCondition,
+    Filter,
+    Fusion,
+    FusionQuery,
+    IntegerIndexParams,
+    IntegerIndexType,
+    IsEmptyCondition,
+    KeywordIndexParams,
+    KeywordIndexType,
+    MatchAny,
+    MatchValue,
+    Mmr,
+    Modifier,
+    NearestQuery,
+    PayloadField,
+    PointIdsList,
+    Prefetch,
+    QuantizationConfig,
+    QueryRequest,
+    Range,
+    ScalarQuantization,
+    SearchParams,
+    SparseVector,
+    SparseVectorParams,
+    VectorParams,
+)
+from qdrant_client.http.models.models import Record, ScoredPoint
+from qdrant_client.local.qdrant_local import QdrantLocal
 from qdrant_client.qdrant_client import QdrantClient
 
+from etl.profiles import CollectionProfile
+from etl.sparse import SPARSE_VECTOR_NAME
+from util.tracing import tracer
+
+logger = logging.getLogger("AInstein")
+
+# payload fields that searches can be restricted to, see DocumentFilter
+PAYLOAD_INDEXES = {
+    "source": KeywordIndexParams(type=KeywordIndexType.KEYWORD),
+    "name": KeywordIndexParams(type=KeywordIndexType.KEYWORD),
+    # only page ranges are filtered, no exact page numbers
+    "page": IntegerIndexParams(type=IntegerIndexType.INTEGER, lookup=False, range=True),
+}
+
+
+@dataclass
+class DocumentFilter:
+    """Restricts a search to some documents and/or a page range. Empty fields don't restrict anything.
+    Pages are numbered from 0, like in the payload."""
+
+    sources: list[str] = field(default_factory=list)
+    names: list[str] = field(default_factory=list)
+    min_page: int | None = None
+    max_page: int | None = None
+
+    def to_filter(self) -> Filter | None:
+        conditions = []
+        if self.sources:
+            conditions.append(FieldCondition(key="source", match=MatchAny(any=list(self.sources))))
+        if self.names:
+            conditions.append(FieldCondition(key="name", match=MatchAny(any=list(self.names))))
+        if self.min_page is not None or self.max_page is not None:
+            conditions.append(FieldCondition(key="page", range=Range(gte=self.min_page, lte=self.max_page)))
+        return Filter(must=conditions) if conditions else None
+
 
 def instantiate_qclient(
     qdrant_path: str = "",
     qdrant_url: str = "",
     qdrant_port: int = 6333,
     qdrant_api_key: str = "",
+    prefer_grpc: bool = False,
+    grpc_port: int = 6334,
 ) -> QdrantClient:
     """Create db when there's none or instantiate an existing one
     QdrantClient is a client for interacting with Qdrant API
@@ -21,6 +93,8 @@ def instantiate_qclient(
     Args:
         qdrant_url (str): e.g. "http://localhost"
         qdrant_port (int): e.g. 6333
+        prefer_grpc (bool): talk to the server over gRPC (one multiplexed connection) instead of REST
+        grpc_port (int): e.g. 6334
     """
 
     if qdrant_path:
@@ -33,23 +107,189 @@ def instantiate_qclient(
 
         qdrant_api_key = os.getenv("QDRANT_API_KEY")
 
-    qclient = QdrantClient(url=qdrant_url, port=qdrant_port, api_key=qdrant_api_key)
+    qclient = QdrantClient(
+        url=qdrant_url, port=qdrant_port, api_key=qdrant_api_key, prefer_grpc=prefer_grpc, grpc_port=grpc_port
+    )
     return qclient
 
 
-def create_db_collection(q_client: QdrantClient, collection_name: str, vectorsize: int):
+def is_local(q_client: QdrantClient) -> bool:
+    """Whether the client runs Qdrant in-process (storage_path or ":memory:") instead of talking to a server.
+    Local mode implements queries in Python and ignores some settings, e.g. payload indexes and quantization
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+
+    Returns:
+        bool: True in local mode
+    """
+    return isinstance(q_client._client, QdrantLocal)
+
+
+def is_healthy(q_client: QdrantClient) -> bool:
+    """Check that the client can still talk to the db
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+
+    Returns:
+        bool: True if the db answered
+    """
+    try:
+        q_client.get_collections()
+        return True
+    except Exception:
+        return False
+
+
+def create_db_collection(
+    q_client: QdrantClient,
+    collection_name: str,
+    vectorsize: int,
+    profile: CollectionProfile | None = None,
+    sparse: bool = False,
+):
     """Create db collection within exisiting db
 
     Args:
         q_client (QdrantClient): qdrant instance
         collection_name (str): preferred collection name
         vectorsize (int): size of embeddings based on used model
+        profile (CollectionProfile, optional): quantization, on-disk vectors and HNSW settings, see profiles.py
+        sparse (bool): add a sparse vector for BM25 (hybrid search, see sparse.py) next to the dense one
     """
+    profile = profile or CollectionProfile()
     # Create db collection within a given db
     q_client.recreate_collection(
         collection_name=collection_name,
-        vectors_config=VectorParams(size=vectorsize, distance=Distance.COSINE),
+        vectors_config=VectorParams(size=vectorsize, distance=Distance.COSINE, on_disk=profile.on_disk or None),
+        # Qdrant computes the IDF of the terms from the collection
+        sparse_vectors_config={SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)} if sparse else None,
+        hnsw_config=profile.hnsw_config(),
+        quantization_config=profile.quantization_config(),
     )
+    ensure_payload_indexes(q_client, collection_name)
+
+
+def ensure_db_collection(
+    q_client: QdrantClient,
+    collection_name: str,
+    vectorsize: int,
+    profile: CollectionProfile | None = None,
+    sparse: bool = False,
+):
+    """Create db collection only if it does not exist yet, so existing points are kept.
+    Raises a ValueError if the existing collection has a different vector size.
+    The quantization and HNSW settings of an existing collection are updated to the profile
+    (Qdrant rebuilds the index in the background), on-disk storage only changes when the collection is recreated.
+    Points from before the name payload field get it, see backfill_document_names.
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+        collection_name (str): preferred collection name
+        vectorsize (int): size of embeddings based on used model
+        profile (CollectionProfile, optional): quantization, on-disk vectors and HNSW settings, see profiles.py
+        sparse (bool): the collection needs a sparse vector for BM25 (hybrid search, see sparse.py)
+    """
+    if not q_client.collection_exists(collection_name):
+        create_db_collection(q_client, collection_name, vectorsize, profile, sparse)
+        return
+
+    collection_params = q_client.get_collection(collection_name).config.params
+    if sparse and SPARSE_VECTOR_NAME not in (collection_params.sparse_vectors or {}):
+        raise ValueError(f"Collection {collection_name} has no sparse vectors for hybrid search, recreate it")
+    existing_size = collection_params.vectors.size
+    if existing_size != vectorsize:
+        raise ValueError(
+            f"Collection {collection_name} holds vectors of size {existing_size}, but the embedder returns {vectorsize}. "
+            "Recreate the collection (etl/create_collection.py) or switch back to the previous embedder."
+        )
+    if profile is not None:
+        _update_collection_profile(q_client, collection_name, profile)
+    ensure_payload_indexes(q_client, collection_name)
+    backfill_document_names(q_client, collection_name)
+
+
+def ensure_payload_indexes(q_client: QdrantClient, collection_name: str):
+    """Create the payload indexes of PAYLOAD_INDEXES that don't exist yet, so filtered searches use the index
+    instead of checking the payload of every candidate. (The local mode of Qdrant has no payload indexes.)
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+        collection_name (str): name of collection within db
+    """
+    existing = q_client.get_collection(collection_name).payload_schema
+    for field_name, field_schema in PAYLOAD_INDEXES.items():
+        if field_name not in existing:
+            logger.debug("Creating payload index on %s of %s", field_name, collection_name)
+            q_client.create_payload_index(collection_name, field_name=field_name, field_schema=field_schema)
+
+
+def backfill_document_names(q_client: QdrantClient, collection_name: str) -> int:
+    """Set the name payload field (see Document.payload) on the points that don't have it yet, i.e. were uploaded
+    before searches could be restricted by name. Incremental ingestion skips unchanged PDFs, so their points are
+    updated here, with one request per document. Without such points, this is a single scroll request.
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+        collection_name (str): name of collection within db
+
+    Returns:
+        int: number of documents whose points got a name
+    """
+    without_name = IsEmptyCondition(is_empty=PayloadField(key="name"))
+    documents = 0
+    while True:
+        points, _ = q_client.scroll(
+            collection_name, scroll_filter=Filter(must=[without_name]), limit=1, with_payload=["source"]
+        )
+        if not points:
+            return documents
+        source = points[0].payload["source"]
+        q_client.set_payload(
+            collection_name,
+            # like Document.name
+            payload={"name": Path(source).stem},
+            points=Filter(must=[FieldCondition(key="source", match=MatchValue(value=source)), without_name]),
+            wait=True,
+        )
+        logger.info("Added the name to the points of %s in %s", source, collection_name)
+        documents += 1
+
+
+def _same_quantization(
+    wanted: ScalarQuantization | BinaryQuantization | None, stored: QuantizationConfig | None
+) -> bool:
+    # compares only the fields the profile sets, the server fills in defaults for the others
+    if wanted is None or stored is None:
+        return wanted is None and stored is None
+
+    def same_values(wanted_values: dict, stored_values: dict) -> bool:
+        return all(
+            same_values(value, stored_values[key])
+            if isinstance(value, dict) and isinstance(stored_values.get(key), dict)
+            else stored_values.get(key) == value
+            for key, value in wanted_values.items()
+        )
+
+    return same_values(wanted.model_dump(mode="json", exclude_none=True), stored.model_dump(mode="json"))
+
+
+def _update_collection_profile(q_client: QdrantClient, collection_name: str, profile: CollectionProfile):
+    if is_local(q_client):
+        # local mode ignores quantization and HNSW settings, and reports no quantization whatever was set
+        return
+    collection_config = q_client.get_collection(collection_name).config
+    hnsw_config = profile.hnsw_config()
+    if hnsw_config is not None and (
+        (hnsw_config.m or collection_config.hnsw_config.m) != collection_config.hnsw_config.m
+        or (hnsw_config.ef_construct or collection_config.hnsw_config.ef_construct)
+        != collection_config.hnsw_config.ef_construct
+    ):
+        q_client.update_collection(collection_name, hnsw_config=hnsw_config)
+    quantization_config = profile.quantization_config()
+    if not _same_quantization(quantization_config, collection_config.quantization_config):
+        q_client.update_collection(collection_name, quantization_config=quantization_config or Disabled.DISABLED)
 
 
 def delete_db_collection(q_client: QdrantClient, collection_name: str):
@@ -63,53 +303,313 @@ def delete_db_collection(q_client: QdrantClient, collection_name: str):
     q_client.delete_collection(collection_name)
 
 
+def _hybrid_vectors(
+    embeddings: list[list] | np.ndarray, sparse_vectors: list[SparseVector], batch_size: int
+) -> Iterator[dict]:
+    # upload_collection only takes named vectors as arrays if all of them are, so the points are streamed instead.
+    # The dense vectors are converted one batch at a time, like upload_collection does for an array: a memmap is only
+    # read while its batch is sent
+    for start in range(0, len(sparse_vectors), batch_size):
+        dense_vectors = embeddings[start : start + batch_size]
+        if isinstance(dense_vectors, np.ndarray):
+            dense_vectors = dense_vectors.tolist()
+        for dense_vector, sparse_vector in zip(dense_vectors, sparse_vectors[start : start + batch_size]):
+            # "" is the name of the (unnamed) dense vector
+            yield {"": dense_vector, SPARSE_VECTOR_NAME: sparse_vector}
+
+
 def upsert_embeddings(
     q_client: QdrantClient,
     collection_name: str,
     payloads: list[dict],
-    embeddings: list[list],
-):
-    """Upload embeddings to db
+    embeddings: list[list] | np.ndarray,
+    ids: list[str] | None = None,
+    sparse_vectors: list[SparseVector] | None = None,
+    batch_size: int = 256,
+    parallel: int = 1,
+    max_retries: int = 3,
+    wait: bool = True,
+) -> list[str]:
+    """Upload embeddings to db in chunks of batch_size points, using several parallel requests
 
     Args:
         q_client (QdrantClient): qdrant instance
         collection_name (str): name of collection within db
-        texts (List[str]): payloads to be uploaded
-        embeddings (List[List]): text embeddings
+        payloads (List[dict]): payloads to be uploaded
+        embeddings (List[List] | np.ndarray): text embeddings
+        ids (List[str], optional): point ids, e.g. Document.point_id. Deterministic ids make re-uploads idempotent:
+            existing points are overwritten instead of duplicated. Random ones are generated if not given.
+        sparse_vectors (List[SparseVector], optional): BM25 vectors for hybrid search, see sparse.py
+        batch_size (int): number of points per request, keeps requests below the payload limit
+        parallel (int): number of parallel upload processes (server mode only)
+        max_retries (int): retries per failed request
+        wait (bool): wait until the points are indexed before returning
 
     Returns:
-        bool: True for successful operation
+        List[str]: the ids of the uploaded points
     """
     # Text ids
-    ids = [str(uuid.uuid4()) for _ in range(len(payloads))]
+    if ids is None:
+        ids = [str(uuid.uuid4()) for _ in range(len(payloads))]
 
     # Uploading embeddings to database collection
-    q_client.upsert(
-        collection_name=collection_name,
-        points=Batch(ids=ids, payloads=payloads, vectors=embeddings),
-    )
+    with tracer.span("upsert", items=len(ids)) as span:
+        # float32 vectors, computed without converting (or reading, for a memmap) the embeddings
+        span.nbytes = len(ids) * len(embeddings[0]) * 4 if tracer.enabled and len(ids) else None
+        vectors = embeddings
+        if sparse_vectors is not None:
+            vectors = _hybrid_vectors(embeddings, sparse_vectors, batch_size)
+        q_client.upload_collection(
+            collection_name=collection_name,
+            vectors=vectors,
+            payload=payloads,
+            ids=ids,
+            batch_size=batch_size,
+            parallel=parallel,
+            max_retries=max_retries,
+            wait=wait,
+        )
+    return ids
+
+
+def delete_points(q_client: QdrantClient, collection_name: str, ids: list[str]):
+    """Delete points from db, e.g. the chunks of a document that was removed or changed
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+        collection_name (str): name of collection within db
+        ids (List[str]): ids of the points to delete
+    """
+    if not ids:
+        return
+    q_client.delete(collection_name=collection_name, points_selector=PointIdsList(points=ids))
+
+
+def _hybrid_prefetch(
+    embedded_question: list[float],
+    sparse_question: SparseVector,
+    query_filter: Filter | None,
+    search_params: SearchParams | None,
+    score_threshold: float | None,
+    limit: int,
+) -> list[Prefetch]:
+    """The dense and the sparse candidates, which are fused by the hybrid query"""
+    return [
+        Prefetch(
+            query=embedded_question,
+            filter=query_filter,
+            params=search_params,
+            score_threshold=score_threshold,
+            limit=limit,
+        ),
+        Prefetch(query=sparse_question, using=SPARSE_VECTOR_NAME, filter=query_filter, limit=limit),
+    ]
 
 
 def search_documents(
-    q_client: QdrantClient, collection_name: str, embedded_question: list[float]
+    q_client: QdrantClient,
+    collection_name: str,
+    embedded_question: list[float],
+    search_params: SearchParams | None = None,
+    document_filter: DocumentFilter | Filter | None = None,
+    limit: int = 10,
+    score_threshold: float | None = None,
+    sparse_question: SparseVector | None = None,
+    prefetch_limit: int = 50,
+    with_vectors: bool = False,
+    mmr: Mmr | None = None,
 ) -> list[ScoredPoint]:
-    """Given a question, return X documents ranked on cosine similarity score
+    """Given a question, return up to limit documents ranked on cosine similarity score.
+    With a sparse_question, the dense and the BM25 results are fused with Reciprocal Rank Fusion in one query,
+    so exact matches of part numbers or names rank high even if their embedding is not the closest.
+    With mmr, Qdrant (server >= 1.15) picks the documents from the best mmr.candidates_limit ones (dense or fused)
+    by Maximal Marginal Relevance, comparing their vectors without sending them to the client, see etl/diversify.py.
 
     Args:
         q_client (QdrantClient): qdrant instance
-        collection_name (str): where embeddings are stored
+        collection_name (str): where embeddings are stored, normally the document_collection alias (see versions.py)
         embedded_question (List[float]): current question in embedded format
+        search_params (SearchParams, optional): e.g. CollectionProfile.search_params(): hnsw_ef, oversampling, rescoring
+        document_filter (DocumentFilter | Filter, optional): only search these documents / pages
+        limit (int): maximum number of documents
+        score_threshold (float, optional): only return documents with at least this (cosine) similarity. In hybrid
+            search it only filters the dense candidates: the RRF score is rank based, BM25 matches are always kept
+        sparse_question (SparseVector, optional): the question as BM25 vector (SparseEncoder.encode_query) for hybrid search
+        prefetch_limit (int): number of dense and of sparse candidates that are fused in hybrid search
+        with_vectors (bool): also return the vectors, e.g. for diversify()
+        mmr (Mmr, optional): diversify the results on the server, e.g. Mmr(diversity=0.5, candidates_limit=50)
 
     Returns:
         List[ScoredPoint]: List of payloads per document
     """
+    if isinstance(document_filter, DocumentFilter):
+        document_filter = document_filter.to_filter()
+    hybrid = sparse_question is not None and bool(sparse_question.indices)
+
+    if mmr is not None:
+        candidates = mmr.candidates_limit or max(prefetch_limit, limit)
+        if hybrid:
+            prefetch = Prefetch(
+                prefetch=_hybrid_prefetch(
+                    embedded_question,
+                    sparse_question,
+                    document_filter,
+                    search_params,
+                    score_threshold,
+                    max(prefetch_limit, candidates),
+                ),
+                query=FusionQuery(fusion=Fusion.RRF),
+                limit=candidates,
+            )
+        else:
+            prefetch = Prefetch(
+                query=embedded_question,
+                filter=document_filter,
+                params=search_params,
+                score_threshold=score_threshold,
+                limit=candidates,
+            )
+        # the MMR query re-ranks the prefetched candidates, its scores are their similarities to the question
+        with tracer.span("search_documents_mmr") as span:
+            search_result = q_client.query_points(
+                collection_name=collection_name,
+                prefetch=prefetch,
+                query=NearestQuery(nearest=embedded_question, mmr=mmr),
+                limit=limit,
+                with_payload=True,
+                with_vectors=[""] if with_vectors and hybrid else with_vectors,
+            ).points
+            span.items = len(search_result)
+        return search_result
+
+    if hybrid:
+        with tracer.span("search_documents_hybrid") as span:
+            search_result = q_client.query_points(
+                collection_name=collection_name,
+                prefetch=_hybrid_prefetch(
+                    embedded_question,
+                    sparse_question,
+                    document_filter,
+                    search_params,
+                    score_threshold,
+                    max(prefetch_limit, limit),
+                ),
+                query=FusionQuery(fusion=Fusion.RRF),
+                limit=limit,
+                with_payload=True,
+                with_vectors=[""] if with_vectors else False,
+            ).points
+            span.items = len(search_result)
+        return search_result
+
     # Searching for the most similar text
-    search_result = q_client.search(
-        collection_name=collection_name,
-        query_vector=embedded_question,
-        query_filter=None,
-        limit=10,
-        with_payload=True,
-    )
+    with tracer.span("search_documents") as span:
+        search_result = q_client.search(
+            collection_name=collection_name,
+            query_vector=embedded_question,
+            query_filter=document_filter,
+            search_params=search_params,
+            limit=limit,
+            score_threshold=score_threshold,
+            with_payload=True,
+            with_vectors=with_vectors,
+        )
+        span.items = len(search_result)
 
-    return search_result
\ No newline at end of file
+    return search_result
+
+
+def search_documents_batch(
+    q_client: QdrantClient,
+    collection_name: str,
+    embedded_questions: list[list[float]],
+    search_params: SearchParams | None = None,
+    document_filter: DocumentFilter | Filter | None = None,
+    limit: int = 10,
+    score_threshold: float | None = None,
+    sparse_questions: list[SparseVector] | None = None,
+    prefetch_limit: int = 50,
+) -> list[list[ScoredPoint]]:
+    """Like search_documents, for many questions in a single request
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+        collection_name (str): where embeddings are stored
+        embedded_questions (List[List[float]]): the questions in embedded format
+        search_params (SearchParams, optional): e.g. CollectionProfile.search_params()
+        document_filter (DocumentFilter | Filter, optional): only search these documents / pages
+        limit (int): maximum number of documents per question
+        score_threshold (float, optional): only return documents with at least this (cosine) similarity
+        sparse_questions (List[SparseVector], optional): the questions as BM25 vectors, for hybrid search
+        prefetch_limit (int): number of dense and of sparse candidates that are fused in hybrid search
+
+    Returns:
+        List[List[ScoredPoint]]: the documents of each question
+    """
+    if isinstance(document_filter, DocumentFilter):
+        document_filter = document_filter.to_filter()
+
+    requests = []
+    for i, embedded_question in enumerate(embedded_questions):
+        sparse_question = sparse_questions[i] if sparse_questions is not None else None
+        if sparse_question is not None and sparse_question.indices:
+            request = QueryRequest(
+                prefetch=_hybrid_prefetch(
+                    embedded_question,
+                    sparse_question,
+                    document_filter,
+                    search_params,
+                    score_threshold,
+                    max(prefetch_limit, limit),
+                ),
+                query=FusionQuery(fusion=Fusion.RRF),
+                limit=limit,
+                with_payload=True,
+            )
+        else:
+            request = QueryRequest(
+                query=embedded_question,
+                filter=document_filter,
+                params=search_params,
+                score_threshold=score_threshold,
+                limit=limit,
+                with_payload=True,
+            )
+        requests.append(request)
+
+    with tracer.span("search_documents_batch", items=len(requests)):
+        responses = q_client.query_batch_points(collection_name=collection_name, requests=requests)
+    return [response.points for response in responses]
+
+
+def list_document_names(q_client: QdrantClient, collection_name: str, limit: int = 10_000) -> list[str]:
+    """The names of all documents in the collection, e.g. to choose which ones to search
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+        collection_name (str): where embeddings are stored
+        limit (int): maximum number of names
+
+    Returns:
+        List[str]: sorted document names
+    """
+    if not q_client.collection_exists(collection_name):
+        return []
+    # counts the distinct values of the keyword index instead of scrolling through all points
+    hits = q_client.facet(collection_name, key="name", limit=limit).hits
+    return sorted(str(hit.value) for hit in hits)
+
+
+def retrieve_documents(q_client: QdrantClient, collection_name: str, ids: list[str]) -> list[Record]:
+    """Fetch documents by their point ids, in the order of the ids
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+        collection_name (str): where embeddings are stored
+        ids (List[str]): point ids, e.g. Document.point_id
+
+    Returns:
+        List[Record]: the points that still exist, with payload
+    """
+    records = {str(record.id): record for record in q_client.retrieve(collection_name, ids=ids, with_payload=True)}
+    return [records[point_id] for point_id in ids if point_id in records]
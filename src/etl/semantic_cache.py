@@ -0,0 +1,131 @@
+"""A semantic cache for answers: users often ask the same question in slightly different words.
+Every answer is stored with the embedding of its question in a dedicated Qdrant collection. When a new question is
+similar enough to a cached one (and was answered with the same prompt template), the cached answer is returned
+instead of searching the documents and calling the LLM again.
+Entries expire after a TTL and are invalidated when ingestion changes or removes one of the chunks they were based on."""
+
+import hashlib
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+
+from qdrant_client.http.models import (
+    Distance,
+    FieldCondition,
+    Filter,
+    FilterSelector,
+    MatchAny,
+    MatchValue,
+    PointStruct,
+    Range,
+    VectorParams,
+)
+from qdrant_client.qdrant_client import QdrantClient
+
+logger = logging.getLogger("AInstein")
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    chunk_ids: list[str]
+    score: float
+
+
+def template_hash(template: str) -> str:
+    """Answers only match if they were generated with the same prompt template"""
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()
+
+
+class SemanticCache:
+    """Stores (question embedding, chunk ids, prompt template hash, answer) in a Qdrant collection"""
+
+    def __init__(
+        self,
+        q_client: QdrantClient,
+        collection_name: str = "answer_cache",
+        threshold: float = 0.95,
+        ttl_seconds: float = 24 * 60 * 60,
+    ):
+        self.q_client = q_client
+        self.collection_name = collection_name
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+
+    def lookup(self, question_embedding: list[float], prompt_template: str) -> CachedAnswer | None:
+        """Return the cached answer of the most similar question, if it is similar enough and not expired"""
+        if not self.q_client.collection_exists(self.collection_name):
+            return None
+
+        query_filter = Filter(
+            must=[
+                FieldCondition(key="template_hash", match=MatchValue(value=template_hash(prompt_template))),
+                FieldCondition(key="created_at", range=Range(gte=time.time() - self.ttl_seconds)),
+            ]
+        )
+        points = self.q_client.query_points(
+            collection_name=self.collection_name,
+            query=question_embedding,
+            query_filter=query_filter,
+            score_threshold=self.threshold,
+            limit=1,
+            with_payload=True,
+        ).points
+        if not points:
+            return None
+
+        payload = points[0].payload
+        logger.debug("Semantic cache hit for %r (score %.3f)", payload["question"], points[0].score)
+        return CachedAnswer(
+            question=payload["question"],
+            answer=payload["answer"],
+            chunk_ids=payload["chunk_ids"],
+            score=points[0].score,
+        )
+
+    def store(
+        self, question: str, question_embedding: list[float], prompt_template: str, answer: str, chunk_ids: list[str]
+    ):
+        """Cache an answer together with the ids of the chunks it was based on"""
+        if not self.q_client.collection_exists(self.collection_name):
+            self.q_client.create_collection(
+                collection_name=self.collection_name,
+                vectors_config=VectorParams(size=len(question_embedding), distance=Distance.COSINE),
+            )
+
+        self.q_client.upsert(
+            collection_name=self.collection_name,
+            points=[
+                PointStruct(
+                    id=str(uuid.uuid4()),
+                    vector=question_embedding,
+                    payload={
+                        "question": question,
+                        "answer": answer,
+                        "chunk_ids": list(chunk_ids),
+                        "template_hash": template_hash(prompt_template),
+                        "created_at": time.time(),
+                    },
+                )
+            ],
+        )
+        self.expire()
+
+    def expire(self):
+        """Delete all entries older than the TTL"""
+        self._delete(Filter(must=[FieldCondition(key="created_at", range=Range(lt=time.time() - self.ttl_seconds))]))
+
+    def invalidate_chunks(self, chunk_ids: list[str]):
+        """Delete all entries whose answer was based on one of the given chunks, e.g. after they were re-ingested"""
+        if chunk_ids:
+            self._delete(Filter(must=[FieldCondition(key="chunk_ids", match=MatchAny(any=list(chunk_ids)))]))
+
+    def clear(self):
+        if self.q_client.collection_exists(self.collection_name):
+            self.q_client.delete_collection(self.collection_name)
+
+    def _delete(self, points_filter: Filter):
+        if self.q_client.collection_exists(self.collection_name):
+            self.q_client.delete(collection_name=self.collection_name, points_selector=FilterSelector(filter=points_filter))
@@ -0,0 +1,130 @@
+"""A compact storage format for (embedded) documents, as an alternative to one pretty-printed json file per chunk.
+Documents are written to shards: the metadata and content go into a line-delimited json file (shard-00000.jsonl)
+and the embeddings into a float32 array file (shard-00000.f32), which is memory-mapped when reading,
+so the vectors are never parsed from text. An index.json lists the finished shards with their size."""
+
+import json
+import logging
+import os
+from dataclasses import asdict
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from etl.model import Document
+
+logger = logging.getLogger("AInstein")
+
+SHARD_INDEX = "index.json"
+
+
+def _load_index(directory: Path) -> list[dict]:
+    index_file = directory / SHARD_INDEX
+    if not index_file.exists():
+        return []
+    with open(index_file, "r", encoding="utf-8") as f:
+        return json.load(f)["shards"]
+
+
+class ShardWriter:
+    """Writes documents to shards of at most shard_size documents. New shards are appended to existing ones.
+    A shard only becomes visible to readers once it is finished, so a crash never leaves a half-written shard behind."""
+
+    def __init__(self, target_dir: str | Path, shard_size: int = 10_000):
+        self.target_dir = Path(target_dir)
+        self.target_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.index = _load_index(self.target_dir)
+        self._records = None
+        self._vectors = None
+        self._name = None
+        self._count = 0
+        self._dim = None
+
+    def _open(self):
+        self._name = f"shard-{len(self.index):05d}"
+        self._records = open(self.target_dir / f"{self._name}.jsonl", "w", encoding="utf-8")
+        self._vectors = open(self.target_dir / f"{self._name}.f32", "wb")
+        self._count = 0
+        self._dim = None
+
+    def write(self, document: Document):
+        if self._records is None:
+            self._open()
+
+        record = asdict(document)
+        embedding = record.pop("embedding")
+        if self._count and bool(embedding) != bool(self._dim):
+            raise ValueError("All documents in a shard need an embedding, or none of them")
+        if embedding:
+            vector = np.asarray(embedding, dtype=np.float32)
+            if self._dim is not None and vector.shape[0] != self._dim:
+                raise ValueError(f"Embedding has {vector.shape[0]} dimensions, expected {self._dim}")
+            self._dim = vector.shape[0]
+            self._vectors.write(vector.tobytes())
+        self._records.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._count += 1
+
+        if self._count >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """Finish the current shard and add it to the index"""
+        if self._records is None:
+            return
+        self._records.close()
+        self._vectors.close()
+        self._records = self._vectors = None
+        if not self._count:
+            return
+
+        self.index.append({"name": self._name, "count": self._count, "dim": self._dim})
+        tmp_file = self.target_dir / f"{SHARD_INDEX}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"shards": self.index}, f, indent=4)
+        os.replace(tmp_file, self.target_dir / SHARD_INDEX)
+        logger.debug("Wrote shard %s with %s documents", self._name, self._count)
+
+    close = flush
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ShardReader:
+    """Reads the documents of all finished shards in a directory, shard by shard"""
+
+    def __init__(self, source_dir: str | Path):
+        self.source_dir = Path(source_dir)
+        self.index = _load_index(self.source_dir)
+
+    def __len__(self):
+        return sum(shard["count"] for shard in self.index)
+
+    def iter_shards(self) -> Iterator[tuple[list[Document], np.ndarray | None]]:
+        """Yield the documents of each shard (without embeddings) together with a read-only, memory-mapped
+        (count x dim) float32 array of their embeddings, or None if the shard has no embeddings"""
+        for shard in self.index:
+            with open(self.source_dir / f"{shard['name']}.jsonl", "r", encoding="utf-8") as f:
+                documents = [Document(**json.loads(line)) for line in f]
+
+            vectors = None
+            if shard["dim"]:
+                vectors = np.memmap(
+                    self.source_dir / f"{shard['name']}.f32",
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(shard["count"], shard["dim"]),
+                )
+            yield documents, vectors
+
+    def iter_documents(self, with_embedding: bool = False) -> Iterator[Document]:
+        for documents, vectors in self.iter_shards():
+            for i, document in enumerate(documents):
+                if with_embedding and vectors is not None:
+                    document.add_embedding(vectors[i].tolist())
+                yield document
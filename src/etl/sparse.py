@@ -0,0 +1,97 @@
+"""Sparse lexical (BM25) vectors for hybrid search. Dense embeddings capture meaning, but often miss exact matches on
+part numbers, error codes and names - exactly what a lexical search is good at.
+
+Every chunk gets a sparse vector next to its dense one: one entry per distinct term, weighted with the BM25 term
+frequency saturation and document length normalization. Terms are hashed to indices, so there's no vocabulary to
+keep in sync. The IDF part of BM25 is computed by Qdrant itself (Modifier.IDF on the sparse vector), so it stays
+correct while documents are added and removed. A query vector simply has weight 1 for each of its terms.
+
+Enable it in the config (changing it rebuilds the collection on the next ingestion):
+
+    qdrant:
+      hybrid: true
+      sparse:          # optional BM25 parameters
+        k1: 1.2
+        b: 0.75
+        avg_doc_length: 256
+"""
+
+import hashlib
+import re
+from collections import Counter
+from collections.abc import Mapping
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from qdrant_client.http.models import SparseVector
+
+SPARSE_VECTOR_NAME = "bm25"
+
+# keeps part numbers and codes like "PN-1234", "E_042" or "v2.1" together
+TOKEN_PATTERN = re.compile(r"\w+(?:[-_./]\w+)*")
+PART_PATTERN = re.compile(r"[^\W_]+")
+
+STOPWORDS = frozenset(
+    """
+    a an and are as at be but by for from has have if in into is it its of on or that the their there these this to
+    was were will with
+    aber als am an auch auf aus bei bin bis das dass dem den der des die doch du ein eine einem einen einer eines er es
+    für hat ich ihr im in ist mit nach nicht noch oder sich sie sind so um und von vor war wie wir zu zum zur
+    """.split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased terms of a text, without stopwords. Compound tokens like "pn-1234" also yield their parts,
+    so a search for "1234" still finds them."""
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        parts = PART_PATTERN.findall(token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part not in STOPWORDS)
+    return terms
+
+
+def term_index(term: str) -> int:
+    """Stable 32 bit index of a term in the sparse vector"""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=4).digest(), "little")
+
+
+class SparseEncoder:
+    """Turns texts into BM25-weighted sparse vectors (without IDF, see module docstring)"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, avg_doc_length: float = 256):
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = avg_doc_length
+
+    def encode_document(self, text: str) -> "SparseVector":
+        from qdrant_client.http.models import SparseVector
+
+        tokens = tokenize(text)
+        length_norm = self.k1 * (1 - self.b + self.b * len(tokens) / self.avg_doc_length)
+        weights: dict[int, float] = {}
+        for term, tf in Counter(tokens).items():
+            index = term_index(term)
+            # hash collisions just add up
+            weights[index] = weights.get(index, 0.0) + tf * (self.k1 + 1) / (tf + length_norm)
+        return SparseVector(indices=list(weights), values=list(weights.values()))
+
+    def encode_documents(self, texts: list[str]) -> list["SparseVector"]:
+        return [self.encode_document(text) for text in texts]
+
+    def encode_query(self, text: str) -> "SparseVector":
+        from qdrant_client.http.models import SparseVector
+
+        indices = sorted({term_index(term) for term in tokenize(text)})
+        return SparseVector(indices=indices, values=[1.0] * len(indices))
+
+
+def get_sparse_encoder(qdrant_config: Mapping) -> SparseEncoder | None:
+    """The sparse encoder if hybrid search is enabled (qdrant.hybrid in the config), else None"""
+    if not qdrant_config.get("hybrid", False):
+        return None
+    return SparseEncoder(**(qdrant_config.get("sparse", {}) or {}))
@@ -0,0 +1,279 @@
+"""Versioned collections for zero-downtime reindexing. The configured document_collection is a Qdrant alias that
+points to one concrete collection, e.g. documents -> documents__v20261018093000. Everything searches the alias.
+
+A full reindex (first ingestion, a different embedder or different chunking settings) doesn't touch the live
+collection: it builds a new version next to it, waits until it is indexed, validates it (point count, its points
+find themselves, sample questions return results - which also warms it up), and then switches the alias in one
+atomic operation. Small changes (some PDFs added, changed or removed) are still applied to the live version.
+
+Previous versions stay available for a rollback and are deleted once they are older than the retention period,
+except for the newest `keep` ones. Each version has its own manifest next to the configured one, so after a
+rollback the incremental ingestion continues from the state of that version.
+
+    qdrant:
+      document_collection: documents
+      versions:
+        keep: 2                  # previous versions that are never deleted
+        retention_hours: 168     # older previous versions are deleted after a week
+        min_self_recall: 0.8     # share of sampled points that have to find themselves
+        sample_queries:          # optional questions that have to return results
+          - How do I reset the device?
+
+    cd src
+    python -m etl.versions list
+    python -m etl.versions rollback [--to documents__v20261017120000]
+    python -m etl.versions cleanup
+"""
+
+import argparse
+import logging
+import re
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from qdrant_client.http.models import (
+    CollectionStatus,
+    CreateAlias,
+    CreateAliasOperation,
+    DeleteAlias,
+    DeleteAliasOperation,
+    SearchParams,
+)
+from qdrant_client.qdrant_client import QdrantClient
+
+from etl.qdrant import delete_db_collection, instantiate_qclient, search_documents_batch
+from etl.semantic_cache import SemanticCache
+from util.util import PROJECT_ROOT, load_config, logging_setup
+
+logger = logging.getLogger("AInstein")
+
+VERSION_SEPARATOR = "__v"
+VERSION_TIME_FORMAT = "%Y%m%d%H%M%S"
+
+
+class VersionValidationError(RuntimeError):
+    """Raised when a newly built collection version doesn't pass the checks before the alias switch"""
+
+
+@dataclass
+class VersioningConfig:
+    keep: int = 2
+    retention_hours: float = 168
+    min_self_recall: float = 0.8
+    self_recall_samples: int = 20
+    sample_queries: list[str] = field(default_factory=list)
+    index_timeout: float = 600
+
+
+def get_versioning_config(qdrant_config: Mapping) -> VersioningConfig:
+    """The qdrant.versions settings of the config"""
+    return VersioningConfig(**(qdrant_config.get("versions", {}) or {}))
+
+
+def version_time(collection_name: str) -> datetime | None:
+    """The creation time encoded in the name of a version, None for other collections"""
+    match = re.search(re.escape(VERSION_SEPARATOR) + r"(\d{14})$", collection_name)
+    return datetime.strptime(match.group(1), VERSION_TIME_FORMAT) if match else None
+
+
+def list_versions(q_client: QdrantClient, alias: str) -> list[str]:
+    """The versions of an alias, oldest first"""
+    pattern = re.compile(re.escape(alias + VERSION_SEPARATOR) + r"\d{14}")
+    names = [collection.name for collection in q_client.get_collections().collections]
+    return sorted(name for name in names if pattern.fullmatch(name))
+
+
+def current_version(q_client: QdrantClient, alias: str) -> str | None:
+    """The collection the alias points to, None if there is no such alias"""
+    for description in q_client.get_aliases().aliases:
+        if description.alias_name == alias:
+            return description.collection_name
+    return None
+
+
+def new_version_name(q_client: QdrantClient, alias: str) -> str:
+    """A name for a new version, e.g. documents__v20261018093000"""
+    existing = set(list_versions(q_client, alias))
+    created = datetime.now().replace(microsecond=0)
+    while (name := f"{alias}{VERSION_SEPARATOR}{created.strftime(VERSION_TIME_FORMAT)}") in existing:
+        created += timedelta(seconds=1)
+    return name
+
+
+def version_manifest_path(manifest_path: str | Path, collection_name: str | None) -> Path:
+    """The manifest of a version, next to the configured one. Collections from before the versioning (no version
+    in the name) use the configured manifest itself."""
+    manifest_path = Path(manifest_path)
+    if collection_name is None or version_time(collection_name) is None:
+        return manifest_path
+    return manifest_path.with_name(f"{manifest_path.stem}.{collection_name}{manifest_path.suffix}")
+
+
+def wait_until_indexed(q_client: QdrantClient, collection_name: str, timeout: float = 600):
+    """Wait until the optimizers of the collection are done, so the first queries don't hit unindexed segments"""
+    deadline = time.monotonic() + timeout
+    while (status := q_client.get_collection(collection_name).status) != CollectionStatus.GREEN:
+        if status == CollectionStatus.RED:
+            raise VersionValidationError(f"Collection {collection_name} has status red")
+        if time.monotonic() > deadline:
+            raise VersionValidationError(f"Collection {collection_name} is not indexed after {timeout:.0f}s")
+        time.sleep(1)
+
+
+def _dense_vector(vector) -> list[float]:
+    # with sparse vectors, the point has a dict of named vectors; "" is the unnamed dense one
+    return vector[""] if isinstance(vector, dict) else vector
+
+
+def validate_version(
+    q_client: QdrantClient,
+    collection_name: str,
+    expected_points: int,
+    versioning: VersioningConfig,
+    embedder=None,
+    search_params: SearchParams | None = None,
+) -> dict:
+    """Check a new version before it goes live, and warm it up with the check queries
+
+    Args:
+        q_client (QdrantClient): qdrant instance
+        collection_name (str): the new version
+        expected_points (int): number of points that were uploaded
+        versioning (VersioningConfig): thresholds and sample questions
+        embedder: embeds the sample questions, required if there are any
+        search_params (SearchParams, optional): the search parameters of the collection profile
+
+    Raises:
+        VersionValidationError: if any of the checks failed
+
+    Returns:
+        dict: the results of the checks, for the log
+    """
+    wait_until_indexed(q_client, collection_name, versioning.index_timeout)
+    points = q_client.count(collection_name, exact=True).count
+    if points == 0:
+        raise VersionValidationError(f"Collection {collection_name} is empty, not switching to it")
+    if points != expected_points:
+        raise VersionValidationError(f"Collection {collection_name} has {points} points, expected {expected_points}")
+
+    # each sampled point should be (one of) the best matches of its own vector
+    samples, _ = q_client.scroll(collection_name, limit=versioning.self_recall_samples, with_vectors=True)
+    results = search_documents_batch(
+        q_client,
+        collection_name,
+        [_dense_vector(sample.vector) for sample in samples],
+        search_params=search_params,
+        limit=10,
+    )
+    found = sum(sample.id in {point.id for point in result} for sample, result in zip(samples, results))
+    self_recall = found / len(samples)
+    if self_recall < versioning.min_self_recall:
+        raise VersionValidationError(
+            f"Only {found} of {len(samples)} sampled points of {collection_name} find themselves "
+            f"(minimum {versioning.min_self_recall:.0%})"
+        )
+
+    empty_queries = []
+    if versioning.sample_queries:
+        results = search_documents_batch(
+            q_client,
+            collection_name,
+            embedder.embed_documents(versioning.sample_queries),
+            search_params=search_params,
+            limit=10,
+        )
+        empty_queries = [query for query, result in zip(versioning.sample_queries, results) if not result]
+    if empty_queries:
+        raise VersionValidationError(f"No results in {collection_name} for the sample queries {empty_queries}")
+
+    report = {"points": points, "self_recall": self_recall, "sample_queries": len(versioning.sample_queries)}
+    logger.info("Validated %s: %s", collection_name, report)
+    return report
+
+
+def swap_alias(q_client: QdrantClient, alias: str, collection_name: str):
+    """Point the alias to another collection, in one atomic operation"""
+    previous = current_version(q_client, alias)
+    if previous is None and q_client.collection_exists(alias):
+        # a collection from before the versioning has the name of the alias: it has to go first (once)
+        logger.warning("Replacing the unversioned collection %s by an alias to %s", alias, collection_name)
+        delete_db_collection(q_client, alias)
+    operations = [CreateAliasOperation(create_alias=CreateAlias(collection_name=collection_name, alias_name=alias))]
+    if previous is not None:
+        operations.insert(0, DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=alias)))
+    q_client.update_collection_aliases(change_aliases_operations=operations)
+    logger.info("Alias %s now points to %s (was %s)", alias, collection_name, previous)
+
+
+def rollback(q_client: QdrantClient, alias: str, to: str | None = None) -> str:
+    """Point the alias back to an earlier version, by default the one before the current. Returns that version."""
+    versions = list_versions(q_client, alias)
+    current = current_version(q_client, alias)
+    if to is None:
+        earlier = [version for version in versions if current is None or version < current]
+        if not earlier:
+            raise ValueError(f"There is no version of {alias} before {current} to roll back to")
+        to = earlier[-1]
+    elif to not in versions:
+        raise ValueError(f"Unknown version {to}, choose one of {versions}")
+    swap_alias(q_client, alias, to)
+    return to
+
+
+def cleanup_versions(
+    q_client: QdrantClient, alias: str, versioning: VersioningConfig, manifest_path: str | Path | None = None
+) -> list[str]:
+    """Delete previous versions older than the retention period, except for the newest versioning.keep ones.
+    Returns the deleted versions."""
+    current = current_version(q_client, alias)
+    previous = [version for version in reversed(list_versions(q_client, alias)) if version != current]
+    cutoff = datetime.now() - timedelta(hours=versioning.retention_hours)
+    deleted = []
+    for version in previous[versioning.keep :]:
+        if version_time(version) >= cutoff:
+            continue
+        delete_db_collection(q_client, version)
+        if manifest_path is not None:
+            version_manifest_path(manifest_path, version).unlink(missing_ok=True)
+        deleted.append(version)
+    if deleted:
+        logger.info("Deleted old versions %s", deleted)
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="show the versions and which one is live")
+    rollback_parser = commands.add_parser("rollback", help="switch the alias back to an earlier version")
+    rollback_parser.add_argument("--to", help="the version, default: the one before the current")
+    commands.add_parser("cleanup", help="delete the versions past the retention period")
+    args = parser.parse_args()
+
+    config = load_config(PROJECT_ROOT / "config" / "config.yml")
+    logging_setup(config)
+    qdrant_config = config["qdrant"]
+    q_client = instantiate_qclient(qdrant_config["storage_path"])
+    alias = qdrant_config["document_collection"]
+    versioning = get_versioning_config(qdrant_config)
+
+    if args.command == "list":
+        current = current_version(q_client, alias)
+        for version in list_versions(q_client, alias):
+            points = q_client.count(version).count
+            print(f"{'*' if version == current else ' '} {version}  {points} points")
+    elif args.command == "rollback":
+        version = rollback(q_client, alias, args.to)
+        # the cached answers refer to the chunks of the version that was live until now
+        SemanticCache(q_client, config.get("semantic_cache", {}).get("collection", "answer_cache")).clear()
+        print(f"{alias} now points to {version}")
+    else:
+        manifest_path = config["paths"].get("manifest", PROJECT_ROOT / "data" / "manifest.json")
+        print(f"Deleted {cleanup_versions(q_client, alias, versioning, manifest_path) or 'nothing'}")
+
+
+if __name__ == "__main__":
+    main()
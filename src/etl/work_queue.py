@@ -0,0 +1,474 @@
+"""Crash-resumable ingestion. An ingestion run is split into work units, one per PDF, which are tracked in a
+SQLite database. Workers claim units, take each through parse -> embed -> upload and checkpoint after every stage:
+the parsed and embedded documents of a unit are kept as shards (see shards.py) in the run's directory, so a unit
+that was interrupted continues from its last finished stage. A run that dies at 90% continues with the remaining
+10% on the next start, instead of starting over.
+
+A claimed unit has a lease, which its worker renews with a heartbeat. If a worker dies, its lease runs out and
+another worker claims the unit again; after max_attempts claims the unit is marked as failed (its PDF is skipped,
+and tried again by the next run). Any number of workers can share a run: the threads of the ingesting process,
+and extra processes started with `python -m etl.ingest --worker`, also on other hosts if the work_queue directory
+is on a shared filesystem with working file locks (and Qdrant runs as a server, local mode is single-process).
+The database uses the rollback journal instead of WAL for that reason, WAL needs shared memory.
+
+    ingest:
+      work_queue:
+        enabled: true
+        workers: 2           # worker threads of the ingesting process
+        lease_seconds: 120   # a unit is claimed again when its worker missed heartbeats for this long
+        max_attempts: 3
+
+    cd src
+    python -m etl.work_queue status [--run <run id>]
+    python -m etl.work_queue retry [--run <run id>]   # give failed units another try
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from etl.manifest import file_hash
+from etl.progress import IngestionCancelled, IngestProgress
+from util.util import PROJECT_ROOT, load_config, logging_setup
+
+logger = logging.getLogger("AInstein")
+
+PENDING, CLAIMED, DONE, FAILED = "pending", "claimed", "done", "failed"
+RUNNING, FINISHED, ABANDONED = "running", "finished", "abandoned"
+# the stages of a unit, in order; a unit's stage is the last one it finished
+STAGES = ("parse", "embed", "upload")
+
+
+class LeaseLost(RuntimeError):
+    """Raised at a checkpoint when the unit's lease ran out and another worker has claimed it"""
+
+
+@dataclass
+class WorkQueueConfig:
+    enabled: bool = False
+    workers: int = 1
+    lease_seconds: float = 120
+    max_attempts: int = 3
+
+
+def get_work_queue_config(ingest_config: Mapping) -> WorkQueueConfig:
+    """The ingest.work_queue settings of the config"""
+    return WorkQueueConfig(**(ingest_config.get("work_queue", {}) or {}))
+
+
+@dataclass
+class Run:
+    id: str
+    alias: str
+    collection: str
+    splitter: str
+    embedder: str
+    status: str
+    created_at: float
+    finished_at: float | None = None
+
+
+@dataclass
+class WorkUnit:
+    id: int
+    run_id: str
+    source: str
+    content_hash: str
+    status: str
+    stage: str | None = None
+    worker: str | None = None
+    lease_until: float | None = None
+    attempts: int = 0
+    error: str | None = None
+    chunk_ids: list[str] = field(default_factory=list)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+
+
+class WorkQueue:
+    """SQLite store of the ingestion runs and their work units
+
+    Args:
+        directory (str | Path): holds the database (queue.sqlite) and the checkpoints of the units
+        lease_seconds (float): how long a claim is valid without a heartbeat
+        max_attempts (int): claims of a unit before it is marked as failed
+    """
+
+    def __init__(self, directory: str | Path, lease_seconds: float = 120, max_attempts: int = 3):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.directory / "queue.sqlite", check_same_thread=False, isolation_level=None, timeout=60
+        )
+        self._connection.executescript(
+            """CREATE TABLE IF NOT EXISTS runs (
+                id TEXT PRIMARY KEY,
+                alias TEXT NOT NULL,
+                collection TEXT NOT NULL,
+                splitter TEXT NOT NULL,
+                embedder TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS units (
+                id INTEGER PRIMARY KEY,
+                run_id TEXT NOT NULL REFERENCES runs (id),
+                source TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                chunk_ids TEXT NOT NULL DEFAULT '[]',
+                UNIQUE (run_id, source)
+            );
+            CREATE INDEX IF NOT EXISTS units_run_status ON units (run_id, status);"""
+        )
+
+    def _transaction(self, statements: Callable[[sqlite3.Connection], object]):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim the same unit
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self._connection)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+            return result
+
+    def run_dir(self, run_id: str) -> Path:
+        return self.directory / "runs" / run_id
+
+    def unit_dir(self, unit: WorkUnit) -> Path:
+        """Where the checkpoints of a unit are kept"""
+        return self.run_dir(unit.run_id) / str(unit.id)
+
+    # runs
+
+    def create_run(self, alias: str, collection: str, splitter: str, embedder: str) -> Run:
+        run = Run(uuid.uuid4().hex[:12], alias, collection, splitter, embedder, RUNNING, time.time())
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (run.id, alias, collection, splitter, embedder, RUNNING, run.created_at, None),
+            )
+        return run
+
+    def get_run(self, run_id: str) -> Run | None:
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        return Run(*row) if row else None
+
+    def unfinished_run(self, alias: str) -> Run | None:
+        """The latest run of the alias that is still running (or was interrupted)"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM runs WHERE alias = ? AND status = ? ORDER BY created_at DESC LIMIT 1", (alias, RUNNING)
+            ).fetchone()
+        return Run(*row) if row else None
+
+    def latest_run(self) -> Run | None:
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM runs ORDER BY created_at DESC LIMIT 1").fetchone()
+        return Run(*row) if row else None
+
+    def finish_run(self, run_id: str, status: str = FINISHED):
+        """Close a run (FINISHED or ABANDONED) and delete the checkpoints of its units"""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE runs SET status = ?, finished_at = ? WHERE id = ?", (status, time.time(), run_id)
+            )
+        shutil.rmtree(self.run_dir(run_id), ignore_errors=True)
+        logger.info("Ingestion run %s %s", run_id, status)
+
+    # units
+
+    def sync_units(self, run_id: str, pdf_files: list[Path]) -> list[str]:
+        """Make the units of a run match the PDFs to ingest: add units for new files, start over with files that
+        changed since their unit was created, and drop the units of files that are gone.
+        Returns the chunk ids already uploaded for the changed and dropped units, which have to be deleted."""
+        hashes = {str(pdf_file): file_hash(pdf_file) for pdf_file in pdf_files}
+
+        def statements(connection: sqlite3.Connection) -> tuple[list[str], list[int]]:
+            obsolete_chunk_ids, reset_units = [], []
+            existing = connection.execute(
+                "SELECT id, source, content_hash, chunk_ids FROM units WHERE run_id = ?", (run_id,)
+            ).fetchall()
+            for unit_id, source, content_hash, chunk_ids in existing:
+                if hashes.get(source) == content_hash:
+                    continue
+                obsolete_chunk_ids.extend(json.loads(chunk_ids))
+                if source in hashes:
+                    connection.execute(
+                        """UPDATE units SET content_hash = ?, status = ?, stage = NULL, worker = NULL,
+                        lease_until = NULL, attempts = 0, error = NULL, chunk_ids = '[]' WHERE id = ?""",
+                        (hashes[source], PENDING, unit_id),
+                    )
+                else:
+                    connection.execute("DELETE FROM units WHERE id = ?", (unit_id,))
+                reset_units.append(unit_id)
+            known = {source for _, source, _, _ in existing}
+            new_units = [(run_id, source, content_hash, PENDING) for source, content_hash in hashes.items()]
+            connection.executemany(
+                "INSERT INTO units (run_id, source, content_hash, status) VALUES (?, ?, ?, ?)",
+                [unit for unit in new_units if unit[1] not in known],
+            )
+            return obsolete_chunk_ids, reset_units
+
+        obsolete_chunk_ids, reset_units = self._transaction(statements)
+        for unit_id in reset_units:
+            shutil.rmtree(self.run_dir(run_id) / str(unit_id), ignore_errors=True)
+        return obsolete_chunk_ids
+
+    def claim(self, run_id: str, worker: str) -> WorkUnit | None:
+        """Claim the next pending unit of a run, or one whose lease ran out. None if there is none."""
+
+        def statements(connection: sqlite3.Connection) -> WorkUnit | None:
+            now = time.time()
+            connection.execute(
+                """UPDATE units SET status = ?, error = 'Lease expired ' || attempts || ' times', worker = NULL
+                WHERE run_id = ? AND status = ? AND lease_until < ? AND attempts >= ?""",
+                (FAILED, run_id, CLAIMED, now, self.max_attempts),
+            )
+            row = connection.execute(
+                """SELECT id FROM units WHERE run_id = ? AND (status = ? OR (status = ? AND lease_until < ?))
+                ORDER BY id LIMIT 1""",
+                (run_id, PENDING, CLAIMED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE units SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (CLAIMED, worker, now + self.lease_seconds, row[0]),
+            )
+            return self._unit(connection.execute("SELECT * FROM units WHERE id = ?", (row[0],)).fetchone())
+
+        return self._transaction(statements)
+
+    def heartbeat(self, worker: str):
+        """Renew the leases of the units claimed by a worker"""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE units SET lease_until = ? WHERE worker = ? AND status = ?",
+                (time.time() + self.lease_seconds, worker, CLAIMED),
+            )
+
+    def _update_owned(self, unit: WorkUnit, **values):
+        # only the worker holding the lease may change a claimed unit
+        columns = ", ".join(f"{column} = ?" for column in values)
+        with self._lock:
+            cursor = self._connection.execute(
+                f"UPDATE units SET {columns} WHERE id = ? AND worker = ? AND status = ?",
+                [*values.values(), unit.id, unit.worker, CLAIMED],
+            )
+        if cursor.rowcount == 0:
+            raise LeaseLost(f"Unit {unit.id} ({unit.source}) was claimed by another worker")
+
+    def checkpoint(self, unit: WorkUnit, stage: str):
+        """Record that a unit finished a stage, and renew its lease"""
+        self._update_owned(unit, stage=stage, lease_until=time.time() + self.lease_seconds)
+        unit.stage = stage
+
+    def complete(self, unit: WorkUnit, chunk_ids: list[str]):
+        self._update_owned(unit, status=DONE, stage=STAGES[-1], chunk_ids=json.dumps(chunk_ids), lease_until=None)
+
+    def fail(self, unit: WorkUnit, error: str):
+        """Give up on an attempt: the unit is pending again, or failed after max_attempts"""
+        status = FAILED if unit.attempts >= self.max_attempts else PENDING
+        self._update_owned(unit, status=status, error=error, worker=None, lease_until=None)
+
+    def release(self, unit: WorkUnit):
+        """Hand a unit back without counting the attempt, e.g. when the run was cancelled"""
+        self._update_owned(unit, status=PENDING, worker=None, lease_until=None, attempts=unit.attempts - 1)
+
+    def retry_failed(self, run_id: str) -> int:
+        """Make the failed units of a run pending again. Returns their number."""
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE units SET status = ?, attempts = 0, error = NULL WHERE run_id = ? AND status = ?",
+                (PENDING, run_id, FAILED),
+            )
+        return cursor.rowcount
+
+    def units(self, run_id: str, status: str | None = None) -> list[WorkUnit]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM units WHERE run_id = ? AND (? IS NULL OR status = ?) ORDER BY id",
+                (run_id, status, status),
+            ).fetchall()
+        return [self._unit(row) for row in rows]
+
+    def open_units(self, run_id: str) -> int:
+        """Number of units that are pending or claimed"""
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM units WHERE run_id = ? AND status IN (?, ?)", (run_id, PENDING, CLAIMED)
+            ).fetchone()
+        return count
+
+    def status(self, run_id: str) -> dict:
+        """Counts of the units of a run by status and stage, the active workers and the failed units"""
+        units = self.units(run_id)
+        now = time.time()
+        return {
+            "units": len(units),
+            "status": dict(Counter(unit.status for unit in units)),
+            "stages": dict(Counter(unit.stage or "-" for unit in units if unit.status in (PENDING, CLAIMED))),
+            "chunks": sum(len(unit.chunk_ids) for unit in units),
+            "workers": {
+                unit.worker: round(unit.lease_until - now)
+                for unit in units
+                if unit.status == CLAIMED and unit.lease_until is not None
+            },
+            "failed": {unit.source: unit.error for unit in units if unit.status == FAILED},
+        }
+
+    @staticmethod
+    def _unit(row: tuple) -> WorkUnit:
+        *columns, chunk_ids = row
+        return WorkUnit(*columns, chunk_ids=json.loads(chunk_ids))
+
+    def close(self):
+        self._connection.close()
+
+
+class Heartbeat:
+    """Renews the leases of a worker in a background thread while the worker is busy"""
+
+    def __init__(self, queue: WorkQueue, worker: str):
+        self.queue = queue
+        self.worker = worker
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name=f"heartbeat-{worker}", daemon=True)
+
+    def _beat(self):
+        while not self._stopped.wait(self.queue.lease_seconds / 3):
+            try:
+                self.queue.heartbeat(self.worker)
+            except sqlite3.Error:
+                # e.g. the database is locked for a moment; the lease has time for two more tries
+                logger.warning("Heartbeat of %s failed", self.worker, exc_info=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+
+ProcessUnit = Callable[[WorkUnit, Callable[[str], None]], list[str]]
+
+
+def run_worker(queue: WorkQueue, run_id: str, process_unit: ProcessUnit, worker: str | None = None) -> int:
+    """Claim and process units of a run until there are none left. Returns the number of units completed.
+
+    Args:
+        queue (WorkQueue): the queue of the run
+        run_id (str): the run to work on
+        process_unit (Callable): takes a unit through its stages, starting after unit.stage, and returns its
+            chunk ids. It is called with the unit and a checkpoint function to call with each finished stage.
+        worker (str, optional): the name of this worker, default: host, process and thread id
+    """
+    worker = worker or default_worker_id()
+    completed = 0
+    with Heartbeat(queue, worker):
+        while (unit := queue.claim(run_id, worker)) is not None:
+            logger.debug("%s claimed %s (stage %s, attempt %s)", worker, unit.source, unit.stage, unit.attempts)
+            try:
+                chunk_ids = process_unit(unit, lambda stage: queue.checkpoint(unit, stage))
+                queue.complete(unit, chunk_ids)
+                completed += 1
+            except LeaseLost:
+                logger.warning("Lost the lease of %s, another worker continues with it", unit.source)
+            except IngestionCancelled:
+                queue.release(unit)
+                raise
+            except Exception as e:
+                logger.exception("Unit %s failed (attempt %s)", unit.source, unit.attempts)
+                queue.fail(unit, f"{type(e).__name__}: {e}")
+    return completed
+
+
+def drain(
+    queue: WorkQueue,
+    run_id: str,
+    process_unit: ProcessUnit,
+    workers: int = 1,
+    progress: IngestProgress | None = None,
+    poll_seconds: float = 2,
+):
+    """Work on a run with `workers` threads until all of its units are done or failed, including the units that
+    other processes are working on: their leases are waited for, and units of workers that died are taken over."""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-worker") as executor:
+        while True:
+            futures = [executor.submit(run_worker, queue, run_id, process_unit) for _ in range(workers)]
+            for future in futures:
+                future.result()
+            if not queue.open_units(run_id):
+                return
+            if progress is not None:
+                progress.raise_if_cancelled()
+            time.sleep(poll_seconds)
+
+
+def work_queue_dir(config: Mapping) -> Path:
+    return Path(config["paths"].get("work_queue", PROJECT_ROOT / "data" / "work_queue"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in (("status", "show the progress of a run"), ("retry", "retry the failed units")):
+        command_parser = commands.add_parser(command, help=help_text)
+        command_parser.add_argument("--run", help="the run id, default: the latest run")
+    args = parser.parse_args()
+
+    config = load_config(PROJECT_ROOT / "config" / "config.yml")
+    logging_setup(config)
+    queue = WorkQueue(work_queue_dir(config))
+    run = queue.get_run(args.run) if args.run else queue.latest_run()
+    if run is None:
+        print("No ingestion run found")
+        return
+
+    if args.command == "retry":
+        print(f"{queue.retry_failed(run.id)} failed units of run {run.id} are pending again")
+        return
+    status = queue.status(run.id)
+    done = status["status"].get(DONE, 0)
+    print(f"Run {run.id} into {run.collection} ({run.status}), started {time.ctime(run.created_at)}")
+    print(f"  {done}/{status['units']} units done, {status['chunks']} chunks uploaded")
+    print(f"  by status: {status['status']}")
+    print(f"  open units by last finished stage: {status['stages'] or '-'}")
+    for worker, lease_seconds in status["workers"].items():
+        print(f"  worker {worker}: lease {'expires in' if lease_seconds >= 0 else 'expired'} {abs(lease_seconds)}s")
+    for source, error in status["failed"].items():
+        print(f"  failed {source}: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Answer many questions at once, e.g. evaluation sets or FAQ lists, without the Streamlit UI.
+
+The questions are embedded in batches, retrieved with one batch query per batch, and answered by the LLM with
+a bounded number of concurrent requests (rate limits and server errors are retried with backoff).
+Every answer is appended to the output as one json line as soon as it is done, with the ids of the retrieved chunks
+and the timings of each step. Running the same command again skips the questions that were already answered,
+so an interrupted run can simply be resumed.
+
+    cd src
+    python -m llm.batch_qa questions.txt --output answers.jsonl --concurrency 8
+
+The questions file has one question per line, or is a .jsonl file with {"id": ..., "question": ...} objects.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Iterator
+
+from etl.model import Document
+from etl.profiles import get_profile
+from etl.qdrant import instantiate_qclient, search_documents_batch
+from etl.sparse import get_sparse_encoder
+from llm.chat import get_chat_generator
+from llm.context import pack_context
+from llm.embed import get_cached_embedder
+from llm.embed_scheduler import is_retryable
+from util.tracing import tracer, tracing_setup
+from util.util import PROJECT_ROOT, load_config, logging_setup
+
+logger = logging.getLogger("AInstein")
+
+PROMPT_TEMPLATE = """Task: Answer the question based on the context.
+Context: {context}
+Question: {question}
+Answer:"""
+
+
+def question_id(question: str) -> str:
+    """A stable id for questions without one, so a resumed run recognizes them"""
+    return hashlib.sha1(question.encode("utf-8")).hexdigest()[:16]
+
+
+def read_questions(questions_file: str | Path) -> list[dict]:
+    """The questions as {"id": ..., "question": ...} dicts, from a text file (one per line) or a jsonl file"""
+    questions = []
+    with open(questions_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if Path(questions_file).suffix == ".jsonl":
+                record = json.loads(line)
+                questions.append({"id": str(record.get("id") or question_id(record["question"])), "question": record["question"]})
+            else:
+                questions.append({"id": question_id(line), "question": line})
+    return questions
+
+
+def answered_ids(output_file: str | Path) -> set[str]:
+    """The ids of the questions that were answered without error in an earlier run"""
+    if not Path(output_file).exists():
+        return set()
+    done = set()
+    with open(output_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run may be incomplete
+                continue
+            if not record.get("error"):
+                done.add(record["id"])
+    return done
+
+
+def _batches(items: list, size: int) -> Iterator[list]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+class BatchAnswerer:
+    """Runs the RAG chain (embed, retrieve, pack context, generate) for batches of questions"""
+
+    def __init__(
+        self,
+        config: dict,
+        chat_generator,
+        prompt_template: str = PROMPT_TEMPLATE,
+        limit: int = 10,
+        context_tokens: int = 2_000,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        qdrant_config = config["qdrant"]
+        profile = get_profile(qdrant_config)
+        self.embedder = get_cached_embedder(
+            profile.embedder_config(config["embedder"]),
+            config["paths"].get("embedding_cache", PROJECT_ROOT / "data" / "embedding_cache.sqlite"),
+        )
+        self.q_client = instantiate_qclient(
+            qdrant_config.get("storage_path", ""),
+            qdrant_config.get("url", ""),
+            qdrant_config.get("port", 6333),
+            qdrant_config.get("api_key", ""),
+            prefer_grpc=qdrant_config.get("prefer_grpc", False),
+            grpc_port=qdrant_config.get("grpc_port", 6334),
+        )
+        self.collection_name = qdrant_config["document_collection"]
+        self.search_params = profile.search_params()
+        self.sparse_encoder = get_sparse_encoder(qdrant_config)
+        self.chat_generator = chat_generator
+        self.prompt_template = prompt_template
+        self.limit = limit
+        self.context_tokens = context_tokens
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def retrieve(self, questions: list[dict]) -> list[dict]:
+        """Embed and search a batch of questions, returns one partial result per question"""
+        texts = [question["question"] for question in questions]
+        start = time.perf_counter()
+        with tracer.span("embed_questions", items=len(texts)):
+            embeddings = self.embedder.embed_documents(texts)
+        embed_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        search_results = search_documents_batch(
+            self.q_client,
+            self.collection_name,
+            embeddings,
+            search_params=self.search_params,
+            limit=self.limit,
+            sparse_questions=[self.sparse_encoder.encode_query(text) for text in texts] if self.sparse_encoder else None,
+        )
+        search_seconds = time.perf_counter() - start
+
+        results = []
+        for question, points in zip(questions, search_results):
+            packed_context = pack_context(
+                [Document.from_qdrant_scored_point(point) for point in points], budget=self.context_tokens
+            )
+            results.append(
+                {
+                    **question,
+                    "chunk_ids": [document.point_id for document in packed_context.documents],
+                    "scores": [point.score for point in points[: len(packed_context.documents)]],
+                    "context_tokens": packed_context.tokens_used,
+                    "context": packed_context.text,
+                    # the batch timings, split evenly over its questions
+                    "timings": {"embed_s": embed_seconds / len(questions), "search_s": search_seconds / len(questions)},
+                }
+            )
+        return results
+
+    def generate(self, result: dict) -> dict:
+        """Ask the LLM, retrying rate limits and server errors with exponential backoff"""
+        prompt = self.prompt_template.format(context=result.pop("context"), question=result["question"])
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                with tracer.span("llm_generate"):
+                    response = self.chat_generator.invoke(prompt)
+                result["answer"] = getattr(response, "content", response)
+                break
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    logger.warning("Question %s failed: %r", result["id"], e)
+                    result["error"] = f"{type(e).__name__}: {e}"
+                    break
+                delay = min(self.backoff_max, self.backoff_base * 2**attempt) * random.uniform(0.5, 1.0)
+                logger.info("Question %s: %r, retrying in %.1fs", result["id"], e, delay)
+                time.sleep(delay)
+        result["timings"]["llm_s"] = time.perf_counter() - start
+        result["timings"]["total_s"] = sum(result["timings"].values())
+        return result
+
+
+def run(
+    answerer: BatchAnswerer,
+    questions: list[dict],
+    output_file: str | Path,
+    batch_size: int = 32,
+    concurrency: int = 4,
+) -> int:
+    """Answer the questions that are not in output_file yet and append the results to it. Returns the number of errors."""
+    done = answered_ids(output_file)
+    todo = [question for question in questions if question["id"] not in done]
+    logger.info("%s questions, %s already answered, %s to do", len(questions), len(questions) - len(todo), len(todo))
+
+    errors = 0
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, "a", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight: set[Future] = set()
+
+        def write_finished(block: bool):
+            nonlocal errors
+            if block:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            else:
+                finished = {future for future in in_flight if future.done()}
+            for future in finished:
+                in_flight.discard(future)
+                result = future.result()
+                errors += bool(result.get("error"))
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+
+        for batch in _batches(todo, batch_size):
+            for result in answerer.retrieve(batch):
+                in_flight.add(executor.submit(answerer.generate, result))
+            write_finished(block=False)
+            # don't retrieve far ahead of the LLM
+            while len(in_flight) > 2 * concurrency:
+                write_finished(block=True)
+        while in_flight:
+            write_finished(block=True)
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", help="text file with one question per line, or jsonl with id and question")
+    parser.add_argument("--output", default="answers.jsonl", help="jsonl file, answered questions in it are skipped")
+    parser.add_argument("--batch-size", type=int, default=32, help="questions embedded and searched together")
+    parser.add_argument("--concurrency", type=int, default=4, help="maximum number of concurrent LLM requests")
+    parser.add_argument("--max-retries", type=int, default=5, help="retries of rate-limited or failed LLM requests")
+    parser.add_argument("--limit", type=int, default=10, help="chunks retrieved per question")
+    parser.add_argument("--context-tokens", type=int, help="token budget of the context, default: retrieval.context_tokens")
+    parser.add_argument("--prompt-file", help="prompt template with {context} and {question}")
+    args = parser.parse_args()
+
+    config = load_config(PROJECT_ROOT / "config" / "config.yml")
+    logging_setup(config)
+    tracing_setup(config)
+
+    prompt_template = Path(args.prompt_file).read_text(encoding="utf-8") if args.prompt_file else PROMPT_TEMPLATE
+    answerer = BatchAnswerer(
+        config,
+        get_chat_generator(config["chat_generator"]),
+        prompt_template=prompt_template,
+        limit=args.limit,
+        context_tokens=args.context_tokens or config.get("retrieval", {}).get("context_tokens", 2_000),
+        max_retries=args.max_retries,
+    )
+    errors = run(answerer, read_questions(args.questions), args.output, args.batch_size, args.concurrency)
+    tracer.log_summary()
+    tracer.write_prometheus()
+    if errors:
+        logger.warning("%s questions failed, run the same command again to retry them", errors)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,46 @@
-"""Here, we define the chat generator that we will use to generate responses to user queries."""
+"""Here, we define the chat generator that we will use to generate responses to user queries.
+Importing this module has no side effects: the LLM settings (config.yaml) are read, the API key is checked and
+langchain_openai is imported only when the first chat generator is created."""
 
 import os
 from enum import Enum
-from logging import config
-from langchain_openai import OpenAI
-from omegaconf import OmegaConf
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+from util.util import PROJECT_ROOT
+
+if TYPE_CHECKING:
+    from langchain_openai import OpenAI
+
+LLM_CONFIG_FILE = PROJECT_ROOT / "config.yaml"
 
-config = OmegaConf.load("config.yaml")
-print(config)
-# Load API key from environment variable
-API_KEY = os.getenv("OPENAI_API_KEY")
-if not API_KEY:
-    raise ValueError("API key for OpenAI is not set in environment variables.")
 
 class OpenAIModelSelection(Enum):
     """A selection of OpenAI models to choose from."""
-    
+
     GPT3 = "gpt-3.5-turbo"
     GPT4 = "gpt-4.0-turbo"
 
-def get_chat_generator(model_name: OpenAIModelSelection) -> OpenAI:
-    
-        return OpenAI(
-            model=model_name,
-            api_key=API_KEY,
-            temperature=float(config.llm.temperature),
-            top_p=float(config.llm.top_p),
-        )
\ No newline at end of file
+
+@lru_cache(maxsize=1)
+def llm_settings():
+    """The llm section of config.yaml, loaded on first use"""
+    from omegaconf import OmegaConf
+
+    return OmegaConf.load(LLM_CONFIG_FILE).llm
+
+
+def get_chat_generator(model_name: OpenAIModelSelection) -> "OpenAI":
+    from langchain_openai import OpenAI
+
+    # Load API key from environment variable
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("API key for OpenAI is not set in environment variables.")
+    settings = llm_settings()
+    return OpenAI(
+        model=model_name,
+        api_key=api_key,
+        temperature=float(settings.temperature),
+        top_p=float(settings.top_p),
+    )
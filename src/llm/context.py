@@ -0,0 +1,174 @@
+"""Packing retrieved chunks into the prompt context. A fixed number of chunks gives prompts of very different sizes:
+too big is slow and expensive, too small leaves out useful context. Instead, the chunks are added in relevance
+order until a token budget is used up; the last one is trimmed to fit.
+Chunks that are adjacent on the same page (e.g. neighbours with overlapping text) are merged into one passage,
+so the overlap is only sent once; a chunk that bridges two passages joins them. The token counts are precomputed
+at ingestion (Document.tokens), so packing doesn't need the tokenizer at query time, except for the trimmed chunk."""
+
+import logging
+from dataclasses import dataclass, field
+
+from etl.model import Document
+from llm.tokens import count_tokens, truncate_to_tokens
+
+logger = logging.getLogger("AInstein")
+
+CONTEXT_SEPARATOR = "\n\n...\n\n"
+
+
+@dataclass
+class _Passage:
+    """Adjacent chunks of one page, in text order"""
+
+    documents: list[Document]
+    tokens: int
+
+    def is_adjacent(self, document: Document) -> bool:
+        first = self.documents[0]
+        if (document.source, document.page) != (first.source, first.page):
+            return False
+        for member in self.documents:
+            if abs(member.chunk - document.chunk) == 1:
+                return True
+            if member.start_index is not None and document.start_index is not None:
+                # overlapping or touching text
+                if (
+                    member.start_index <= document.start_index + len(document.content)
+                    and document.start_index <= member.start_index + len(member.content)
+                ):
+                    return True
+        return False
+
+    def _spans(self) -> list[tuple[int, int]]:
+        # the parts of the page the passage covers, as sorted, disjoint (start, end) character ranges
+        spans: list[tuple[int, int]] = []
+        for start, end in sorted(
+            (member.start_index, member.start_index + len(member.content))
+            for member in self.documents
+            if member.start_index is not None
+        ):
+            if spans and start <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], max(end, spans[-1][1]))
+            else:
+                spans.append((start, end))
+        return spans
+
+    def new_characters(self, document: Document) -> int:
+        """Length of the part of the document's text that is not in the passage yet"""
+        if document.start_index is None:
+            return len(document.content)
+        document_end = document.start_index + len(document.content)
+        overlap = sum(
+            max(0, min(document_end, end) - max(document.start_index, start)) for start, end in self._spans()
+        )
+        return len(document.content) - overlap
+
+    @staticmethod
+    def merge(passages: list["_Passage"]) -> "_Passage":
+        documents = [document for passage in passages for document in passage.documents]
+        return _Passage(documents, sum(passage.tokens for passage in passages))
+
+    @property
+    def text(self) -> str:
+        documents = sorted(self.documents, key=lambda document: document.chunk)
+        text = documents[0].content
+        # end of the text so far on the page, None if unknown
+        end = documents[0].start_index + len(documents[0].content) if documents[0].start_index is not None else None
+        for document in documents[1:]:
+            if end is not None and document.start_index is not None:
+                document_end = document.start_index + len(document.content)
+                overlap = end - document.start_index
+                if overlap > 0:
+                    text += document.content[overlap:]
+                    end = max(end, document_end)
+                    continue
+            text += "\n" + document.content
+            end = document.start_index + len(document.content) if document.start_index is not None else None
+        return text
+
+
+@dataclass
+class PackedContext:
+    text: str
+    documents: list[Document] = field(default_factory=list)  # the chunks that are (at least partly) in the context
+    tokens_used: int = 0
+    budget: int = 0
+    truncated: bool = False  # the last chunk was trimmed or chunks were left out
+
+
+def _tokens(document: Document) -> int:
+    return document.tokens if document.tokens is not None else count_tokens(document.content)
+
+
+def pack_context(
+    documents: list[Document], budget: int, separator: str = CONTEXT_SEPARATOR, min_chunk_tokens: int = 32
+) -> PackedContext:
+    """Fill a token budget with the documents, in the given (relevance) order
+
+    Args:
+        documents (List[Document]): the retrieved chunks, most relevant first
+        budget (int): maximum number of tokens of the context
+        separator (str): put between passages of different pages (or non-adjacent chunks)
+        min_chunk_tokens (int): a chunk that doesn't fit is trimmed to the rest of the budget, if at least this much is left
+
+    Returns:
+        PackedContext: the context text, the chunks in it and the number of tokens used
+    """
+    separator_tokens = count_tokens(separator)
+    passages: list[_Passage] = []
+    used = []
+    tokens_used = 0
+    truncated = False
+
+    for document in documents:
+        # a chunk can be adjacent to several passages, e.g. chunk 1 after chunks 0 and 2: it joins them into one
+        adjacent = [passage for passage in passages if passage.is_adjacent(document)]
+        passage = _Passage.merge(adjacent) if adjacent else None
+        if passage is not None:
+            # the precomputed count, scaled down to the part of the text that is new, minus the separators that
+            # are no longer needed between the joined passages
+            tokens = round(_tokens(document) * passage.new_characters(document) / max(len(document.content), 1))
+            tokens -= separator_tokens * (len(adjacent) - 1)
+        else:
+            tokens = _tokens(document) + (separator_tokens if passages else 0)
+
+        if tokens_used + tokens <= budget:
+            if passage is not None:
+                passage.documents.append(document)
+                passage.tokens += tokens
+                # the joined passage takes the place of the first (most relevant) of them
+                passages = [
+                    passage if other is adjacent[0] else other
+                    for other in passages
+                    if not any(other is joined for joined in adjacent[1:])
+                ]
+            else:
+                passages.append(_Passage([document], tokens))
+            used.append(document)
+            tokens_used += tokens
+            continue
+
+        truncated = True
+        remaining = budget - tokens_used - (separator_tokens if passages else 0)
+        if passage is None and remaining >= min_chunk_tokens:
+            trimmed = Document(
+                content=truncate_to_tokens(document.content, remaining),
+                source=document.source,
+                page=document.page,
+                chunk=document.chunk,
+                start_index=document.start_index,
+            )
+            trimmed.tokens = count_tokens(trimmed.content)
+            passages.append(_Passage([trimmed], trimmed.tokens))
+            used.append(document)
+            tokens_used += trimmed.tokens + (separator_tokens if len(passages) > 1 else 0)
+        break
+
+    logger.debug("Packed %s of %s chunks into %s of %s tokens", len(used), len(documents), tokens_used, budget)
+    return PackedContext(
+        text=separator.join(passage.text for passage in passages),
+        documents=used,
+        tokens_used=tokens_used,
+        budget=budget,
+        truncated=truncated,
+    )
@@ -1,20 +1,23 @@
 """Embeddings are used to convert text into vectors. 
-This module provides a wrapper around the OpenAI functions to embed text.
+This module provides a registry of embedder backends: the OpenAI embeddings (the default), a local model on the CPU
+and a deterministic hashing embedder for tests. Which one is used is set in the config, see get_embedder.
 We will use this to embed the user's question and the document documents, by using the `embed_query` and `embed_documents` methods.
 As you will see, we will import the get_embedder function from this module in the frontend file."""
 
 import logging
-from omegaconf import OmegaConf
-from langchain_openai import OpenAIEmbeddings
+from collections.abc import Mapping
 from enum import Enum
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
 import os
 
+from llm.embed_cache import CachedEmbedder, EmbeddingCache
+from llm.embedders import HashingEmbedder, LocalEmbedder
+
+if TYPE_CHECKING:
+    from langchain_openai import OpenAIEmbeddings
+
 logger = logging.getLogger("AInstein")
-config = OmegaConf.load("config.yaml")
-# Load API key from environment variable
-API_KEY = os.getenv("OPENAI_API_KEY")
-if not API_KEY:
-    raise ValueError("API key for OpenAI is not set in environment variables.")
 
 
 class OpenAIEmbedderSelection(Enum):
@@ -24,17 +27,126 @@ class OpenAIEmbedderSelection(Enum):
     SMALL = "text-embedding-3-small"  # Add other embedders as needed
 
 
-def get_embedder(embedder: OpenAIEmbedderSelection) -> OpenAIEmbeddings:
-    """Creates an OpenAIEmbeddings object.
+OPENAI_EMBEDDING_DIMENSIONS = {
+    OpenAIEmbedderSelection.LARGE.value: 3072,
+    OpenAIEmbedderSelection.SMALL.value: 1536,
+    "text-embedding-ada-002": 1536,
+}
+
+# backend name -> factory, called with the remaining settings of the embedder config as keyword arguments
+EMBEDDER_BACKENDS: dict[str, Callable] = {}
+
+
+def register_embedder(backend: str):
+    """Decorator to register a factory for an embedder backend, e.g.
+
+        @register_embedder("my_backend")
+        def my_embedder(model: str, **options):
+            return MyEmbedder(model, **options)
+
+    The returned object needs embed_documents and embed_query methods."""
+
+    def decorator(factory: Callable) -> Callable:
+        EMBEDDER_BACKENDS[backend] = factory
+        return factory
+
+    return decorator
+
+
+@register_embedder("openai")
+def _openai_embedder(model: str = OpenAIEmbedderSelection.SMALL.value, dimensions: int | None = None) -> "OpenAIEmbeddings":
+    # the key is only needed (and checked), and langchain_openai only imported, when an OpenAI embedder is created
+    from langchain_openai import OpenAIEmbeddings
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("API key for OpenAI is not set in environment variables.")
+    return OpenAIEmbeddings(model=model, api_key=api_key, dimensions=dimensions)
+
+
+@register_embedder("local")
+def _local_embedder(
+    model: str, batch_size: int = 32, threads: int | None = None, normalize: bool = True, dimensions: int | None = None
+) -> LocalEmbedder:
+    return LocalEmbedder(model, batch_size=batch_size, threads=threads, normalize=normalize, truncate_dim=dimensions)
+
+
+@register_embedder("hashing")
+def _hashing_embedder(dim: int = 256, dimensions: int | None = None) -> HashingEmbedder:
+    return HashingEmbedder(dimensions or dim)
+
+
+def embedder_settings(embedder) -> dict:
+    """Normalize the embedder config to a dict with a backend key.
+    A plain model name (or OpenAIEmbedderSelection) selects the OpenAI backend, as before."""
+    if isinstance(embedder, Mapping):
+        settings = dict(embedder)
+        settings.setdefault("backend", "openai")
+        return settings
+    return {"backend": "openai", "model": getattr(embedder, "value", embedder)}
+
+
+def embedder_id(embedder) -> str:
+    """A name for the embedder config that changes whenever the vectors would change, e.g. to key caches.
+    For OpenAI models it is the model name (plus the dimensions, if reduced)."""
+    settings = embedder_settings(embedder)
+    backend = settings.pop("backend")
+    if backend == "openai":
+        model = settings.get("model", OpenAIEmbedderSelection.SMALL.value)
+        return f"{model}:{settings['dimensions']}" if settings.get("dimensions") else model
+    # batch size and threads don't change the vectors
+    return ":".join([backend] + [str(settings[key]) for key in ("model", "dim", "dimensions") if settings.get(key)])
+
+
+def get_embedder(embedder: OpenAIEmbedderSelection | str | Mapping):
+    """Creates an embedder of one of the registered backends.
 
     Args:
-        embedder (OpenAIEmbedderSelection.value): Can be one of the OpenAIEmbedderSelection values.
+        embedder (OpenAIEmbedderSelection.value | Mapping): Can be one of the OpenAIEmbedderSelection values,
+            or a mapping with a backend ("openai", "local", "hashing") and its options, e.g.
+            {"backend": "local", "model": "/models/bge-small-en-v1.5", "batch_size": 32, "threads": 4}
 
     Returns:
-        OpenAIEmbeddings: An OpenAIEmbeddings object.
+        An object with embed_documents and embed_query methods, e.g. OpenAIEmbeddings.
     """
-    return OpenAIEmbeddings(
-        model=embedder,
-        api_key=API_KEY,
-    )
-    
+    settings = embedder_settings(embedder)
+    backend = settings.pop("backend")
+    if backend not in EMBEDDER_BACKENDS:
+        raise ValueError(f"Unknown embedder backend {backend!r}, choose one of {sorted(EMBEDDER_BACKENDS)}")
+    return EMBEDDER_BACKENDS[backend](**settings)
+
+
+def embedding_dimension(embedder) -> int:
+    """The size of the vectors of an embedder (as returned by get_embedder or get_cached_embedder).
+
+    Args:
+        embedder: the embedder
+
+    Returns:
+        int: number of dimensions, e.g. the vectorsize of the Qdrant collection
+    """
+    # a CachedEmbedder wraps the actual embedder
+    embedder = getattr(embedder, "embedder", embedder)
+    dimension = getattr(embedder, "dimension", None) or getattr(embedder, "dimensions", None)
+    if dimension:
+        return dimension
+    if getattr(embedder, "model", None) in OPENAI_EMBEDDING_DIMENSIONS:
+        return OPENAI_EMBEDDING_DIMENSIONS[embedder.model]
+    # unknown model: ask it
+    return len(embedder.embed_query("dimension"))
+
+
+def get_cached_embedder(
+    embedder: OpenAIEmbedderSelection | str | Mapping, cache_path: str | Path, max_entries: int = 1_000_000
+) -> CachedEmbedder:
+    """Creates an embedder like get_embedder, which caches all embeddings on disk.
+
+    Args:
+        embedder (OpenAIEmbedderSelection.value | Mapping): the embedder config, see get_embedder.
+        cache_path (str | Path): location of the SQLite cache file.
+        max_entries (int): number of embeddings to keep before the least recently used ones are evicted.
+
+    Returns:
+        CachedEmbedder: An embedder with embed_documents and embed_query methods, and hit/miss counters.
+    """
+    return CachedEmbedder(get_embedder(embedder), EmbeddingCache(cache_path, max_entries), model=embedder_id(embedder))
@@ -0,0 +1,142 @@
+"""A persistent cache for embeddings, so the same text is never sent to the embeddings API twice.
+Embeddings are stored in a local SQLite database, keyed by (model, sha256(text)), as compact float32 blobs.
+The least recently used entries are evicted once the cache holds more than max_entries embeddings."""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from pathlib import Path
+
+logger = logging.getLogger("AInstein")
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """SQLite store for embeddings with size-bounded LRU eviction"""
+
+    def __init__(self, path: str | Path, max_entries: int = 1_000_000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash BLOB NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            ) WITHOUT ROWID"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    def get_many(self, model: str, texts: list[str]) -> list[list[float] | None]:
+        """Look up the embeddings of texts, None for texts that are not cached"""
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            # stay below SQLite's limit of variables per statement
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start : start + 500]
+                rows = self._connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                    [model, *chunk],
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, found_hash) for found_hash in found],
+                )
+        return [array("f", found[h]).tolist() if h in found else None for h in hashes]
+
+    def put_many(self, model: str, texts: list[str], embeddings: list[list[float]]):
+        """Store embeddings and evict the least recently used ones if the cache is full"""
+        now = time.time()
+        rows = [
+            (model, text_hash(text), array("f", embedding).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            self._connection.execute("BEGIN")
+            self._connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._connection.execute("COMMIT")
+            self._evict()
+
+    def _evict(self):
+        (size,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if size <= self.max_entries:
+            return
+        logger.debug("Evicting %s embeddings from the cache", size - self.max_entries)
+        self._connection.execute(
+            """DELETE FROM embeddings WHERE (model, text_hash) IN (
+                SELECT model, text_hash FROM embeddings ORDER BY last_used LIMIT ?
+            )""",
+            (size - self.max_entries,),
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+
+class CachedEmbedder:
+    """Wraps an embedder (e.g. OpenAIEmbeddings) and only embeds texts that are not in the cache yet.
+    Offers the same embed_documents and embed_query methods, plus hit and miss counters."""
+
+    def __init__(self, embedder, cache: EmbeddingCache, model: str):
+        self.embedder = embedder
+        self.cache = cache
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        embeddings = self.cache.get_many(self.model, texts)
+        # each distinct missing text is embedded only once
+        missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        with self._counter_lock:
+            self.misses += len(missing_texts)
+            self.hits += len(texts) - len(missing_texts)
+
+        if missing_texts:
+            new_embeddings = self.embedder.embed_documents(missing_texts)
+            self.cache.put_many(self.model, missing_texts, new_embeddings)
+            new_embeddings_by_text = dict(zip(missing_texts, new_embeddings))
+            embeddings = [
+                new_embeddings_by_text[text] if embedding is None else embedding
+                for text, embedding in zip(texts, embeddings)
+            ]
+        return embeddings
+
+    def embed_query(self, text: str) -> list[float]:
+        (embedding,) = self.cache.get_many(self.model, [text])
+        if embedding is not None:
+            with self._counter_lock:
+                self.hits += 1
+            return embedding
+
+        with self._counter_lock:
+            self.misses += 1
+        embedding = self.embedder.embed_query(text)
+        self.cache.put_many(self.model, [text], [embedding])
+        return embedding
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,200 @@
+"""Embedding a whole corpus in one call is fragile: everything is kept in memory and one failed request loses all of it.
+The EmbeddingScheduler splits the texts into token-budgeted batches and embeds a few of them at the same time,
+while staying below the requests-per-minute and tokens-per-minute limits of the embeddings API.
+Failed batches are retried with exponential backoff, and every finished batch is handed to a callback right away,
+so the caller can save its progress.
+
+The scheduler only needs an object with an `embed_documents` method, so it can be tested with a local stub."""
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Protocol
+
+from llm.tokens import count_tokens
+from util.tracing import tracer
+
+logger = logging.getLogger("AInstein")
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class Embedder(Protocol):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]: ...
+
+
+class EmbeddingBatchError(RuntimeError):
+    """Raised when some batches could not be embedded, even after retrying them."""
+
+    def __init__(self, failed_batches: dict[int, Exception]):
+        self.failed_batches = failed_batches
+        super().__init__(f"{len(failed_batches)} embedding batches failed, e.g. {next(iter(failed_batches.values()))!r}")
+
+
+def make_batches(token_counts: list[int], max_batch_tokens: int, max_batch_size: int) -> list[list[int]]:
+    """Group text indices into batches with at most max_batch_tokens tokens and max_batch_size texts.
+    A single text above the token budget gets a batch of its own."""
+    batches = []
+    batch, batch_tokens = [], 0
+    for index, tokens in enumerate(token_counts):
+        if batch and (batch_tokens + tokens > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(index)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits (429), server errors (5xx), timeouts and connection errors are worth another try"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    return isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in (
+        "APIConnectionError",
+        "APITimeoutError",
+    )
+
+
+class RateLimiter:
+    """Blocks until a request fits into the requests-per-minute and tokens-per-minute limits (sliding window)"""
+
+    def __init__(self, requests_per_minute: int | None, tokens_per_minute: int | None, window: float = 60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self._requests: deque[tuple[float, int]] = deque()
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        while self._requests and self._requests[0][0] <= now - self.window:
+            _, old_tokens = self._requests.popleft()
+            self._tokens_in_window -= old_tokens
+        if not self._requests:
+            return 0.0
+        too_many_requests = self.requests_per_minute and len(self._requests) >= self.requests_per_minute
+        too_many_tokens = self.tokens_per_minute and self._tokens_in_window + tokens > self.tokens_per_minute
+        if too_many_requests or too_many_tokens:
+            return self._requests[0][0] + self.window - now
+        return 0.0
+
+    def acquire(self, tokens: int):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait_time = self._wait_time(tokens, now)
+                if wait_time <= 0:
+                    self._requests.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+            time.sleep(wait_time)
+
+
+class EmbeddingScheduler:
+    """Embeds texts in token-budgeted batches with bounded concurrency, rate limiting and retries"""
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        max_batch_tokens: int = 50_000,
+        max_batch_size: int = 256,
+        max_concurrency: int = 4,
+        requests_per_minute: int | None = 3_000,
+        tokens_per_minute: int | None = 1_000_000,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        self.embedder = embedder
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+    def embed_batch(self, texts: list[str], tokens: int | None = None) -> list[list[float]]:
+        """Embed a single batch in the calling thread, respecting the rate limits and retrying on failures"""
+        if tokens is None:
+            tokens = sum(count_tokens(text) for text in texts)
+        for attempt in range(self.max_retries + 1):
+            with tracer.span("rate_limit_wait"):
+                self.rate_limiter.acquire(tokens)
+            try:
+                with tracer.span("embed_batch", items=len(texts)) as span:
+                    span.nbytes = sum(len(text.encode("utf-8")) for text in texts) if tracer.enabled else None
+                    return self.embedder.embed_documents(texts)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                delay = min(self.backoff_max, self.backoff_base * 2**attempt) * random.uniform(0.5, 1.0)
+                logger.warning("Embedding batch failed (%r), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+
+    def embed(
+        self,
+        texts: list[str],
+        on_batch_done: Callable[[list[int], list[list[float]]], None] | None = None,
+        token_counts: list[int] | None = None,
+    ) -> list[list[float]]:
+        """Embed all texts and return the embeddings in the same order
+
+        Args:
+            texts (List[str]): texts to embed
+            on_batch_done (Callable, optional): called with (text indices, embeddings) for each finished batch,
+                from the calling thread, e.g. to save the embedded documents right away
+            token_counts (List[int], optional): tokens per text, if already known (e.g. Document.tokens)
+
+        Raises:
+            EmbeddingBatchError: if batches still fail after all retries. All other batches are done by then.
+
+        Returns:
+            List[List[float]]: one embedding per text
+        """
+        if token_counts is None:
+            token_counts = [count_tokens(text) for text in texts]
+        batches = make_batches(token_counts, self.max_batch_tokens, self.max_batch_size)
+        logger.info("Embedding %s texts in %s batches", len(texts), len(batches))
+
+        embeddings: list[list[float] | None] = [None] * len(texts)
+        failed_batches = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {
+                executor.submit(
+                    self.embed_batch, [texts[i] for i in batch], sum(token_counts[i] for i in batch)
+                ): batch_number
+                for batch_number, batch in enumerate(batches)
+            }
+            try:
+                for future in as_completed(futures):
+                    batch_number = futures[future]
+                    batch = batches[batch_number]
+                    try:
+                        batch_embeddings = future.result()
+                    except Exception as e:
+                        logger.error("Embedding batch %s failed: %r", batch_number, e)
+                        failed_batches[batch_number] = e
+                        continue
+                    for index, embedding in zip(batch, batch_embeddings):
+                        embeddings[index] = embedding
+                    if on_batch_done is not None:
+                        on_batch_done(batch, batch_embeddings)
+                    logger.debug("Embedded batch %s with %s texts", batch_number, len(batch))
+            except BaseException:
+                # e.g. on_batch_done raised because the ingestion was cancelled: don't wait for the remaining batches
+                for future in futures:
+                    future.cancel()
+                raise
+
+        if failed_batches:
+            raise EmbeddingBatchError(failed_batches)
+        return embeddings
@@ -0,0 +1,93 @@
+"""Embedders that run without an API: a local model on the CPU and a deterministic hashing embedder.
+Both offer the embed_documents and embed_query methods of the langchain embeddings, plus the dimension of their vectors."""
+
+import hashlib
+import logging
+import re
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger("AInstein")
+
+
+class HashingEmbedder:
+    """Deterministic bag-of-words embedder: every token is hashed into one of dim buckets. No model, no network.
+    The vectors are meaningless for real questions, but stable across runs - useful for tests and benchmarks."""
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    @property
+    def dimension(self) -> int:
+        return self.dim
+
+    def _embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+class LocalEmbedder:
+    """Runs a sentence-transformers model from disk on the CPU. Texts are embedded in batches of batch_size,
+    using threads torch threads. Requires the optional sentence-transformers package.
+    truncate_dim reduces the dimensions of models trained for it (Matryoshka embeddings)."""
+
+    def __init__(
+        self,
+        model_path: str | Path,
+        batch_size: int = 32,
+        threads: int | None = None,
+        normalize: bool = True,
+        truncate_dim: int | None = None,
+    ):
+        try:
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "The local embedder needs sentence-transformers, install the local extra: `poetry install --extras local`"
+            ) from e
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.model_path = str(model_path)
+        self.batch_size = batch_size
+        self.normalize = normalize
+        # local_files_only: never download anything, the model has to be on disk already
+        self.model = SentenceTransformer(
+            self.model_path, device="cpu", local_files_only=True, truncate_dim=truncate_dim
+        )
+        logger.info(
+            "Loaded local embedding model %s (%s dimensions, %s threads)",
+            self.model_path, self.dimension, torch.get_num_threads(),
+        )
+
+    @property
+    def dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        vectors = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=self.normalize,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return vectors.astype(np.float32).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
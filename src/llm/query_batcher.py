@@ -0,0 +1,146 @@
+"""Micro-batching of query embeddings. Every Streamlit session embeds its question with its own request; when many
+users ask at once, that is one round-trip per question and the requests-per-minute limit is reached quickly, although
+the embeddings API takes many inputs per request.
+
+The QueryEmbeddingBatcher is shared by all sessions of the process (see ui/resources.py). embed_query puts the
+question into a queue and blocks; a collector thread takes the questions that arrive within max_wait_ms of the
+oldest waiting one (or max_batch_size of them, whichever comes first) and sends them as one embed_documents call,
+then hands each caller its vector. Identical questions in a batch are embedded once. The price is the time a
+question waits for its batch to be collected, which is at most max_wait_ms (plus thread scheduling). When all
+max_concurrent_batches are in flight, a collected batch also waits for a free slot, and that queueing is not bounded
+by max_wait_ms. stats() reports both waits separately with the batch sizes, and so does the tracer, as the
+query_embed_wait and query_embed_queue stages next to query_embed_batch.
+
+    query_batching:
+      enabled: true
+      max_wait_ms: 10
+      max_batch_size: 32"""
+
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from util.tracing import StageStats, tracer
+
+logger = logging.getLogger("AInstein")
+
+
+@dataclass
+class _QueryRequest:
+    text: str
+    enqueued_at: float
+    future: Future = field(default_factory=Future)
+
+
+class QueryEmbeddingBatcher:
+    """Wraps an embedder (e.g. a CachedEmbedder) and batches the embed_query calls of concurrent callers.
+    embed_documents is passed through, and so are other attributes, e.g. the hit and miss counters of the cache.
+
+    Args:
+        embedder: an object with an embed_documents method
+        max_wait_ms (float): how long the oldest question waits for others to join its batch
+        max_batch_size (int): a full batch is sent right away
+        max_concurrent_batches (int): batches in flight at the same time, while the next one is collected
+    """
+
+    def __init__(self, embedder, max_wait_ms: float = 10, max_batch_size: int = 32, max_concurrent_batches: int = 4):
+        self.embedder = embedder
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._pending: deque[_QueryRequest] = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix="query-embed")
+        self._collector = threading.Thread(target=self._collect, name="query-embed-collector", daemon=True)
+        self._collector.start()
+        self._stats_lock = threading.Lock()
+        self._waits = StageStats()
+        self._queueing = StageStats()
+        self._batch_sizes: Counter[int] = Counter()
+
+    def embed_query(self, text: str) -> list[float]:
+        request = _QueryRequest(text, time.perf_counter())
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The query embedding batcher is closed")
+            self._pending.append(request)
+            self._condition.notify()
+        return request.future.result()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embedder.embed_documents(texts)
+
+    def __getattr__(self, name: str):
+        # only called for attributes the batcher doesn't have itself
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.embedder, name)
+
+    def _collect(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                # the window starts when the oldest question arrived
+                deadline = self._pending[0].enqueued_at + self.max_wait
+                while len(self._pending) < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.max_batch_size))]
+            self._executor.submit(self._embed_batch, batch, time.perf_counter())
+
+    def _embed_batch(self, batch: list[_QueryRequest], collected_at: float):
+        sent_at = time.perf_counter()
+        texts = list(dict.fromkeys(request.text for request in batch))
+        try:
+            with tracer.span("query_embed_batch", items=len(texts)):
+                embeddings = dict(zip(texts, self.embedder.embed_documents(texts)))
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+        else:
+            for request in batch:
+                request.future.set_result(list(embeddings[request.text]))
+
+        with self._stats_lock:
+            self._batch_sizes[len(batch)] += 1
+            for request in batch:
+                self._waits.add(collected_at - request.enqueued_at, 1, None, False)
+                self._queueing.add(sent_at - collected_at, 1, None, False)
+        for request in batch:
+            tracer.record("query_embed_wait", collected_at - request.enqueued_at, items=1)
+        tracer.record("query_embed_queue", sent_at - collected_at, items=len(batch))
+
+    def stats(self) -> dict:
+        """Number of questions and batches, the batch size distribution (size -> number of batches), the time the
+        questions waited for their batch to be collected, and the time they waited for a free slot after that; the
+        sum is the latency added by batching"""
+        with self._stats_lock:
+            batches = sum(self._batch_sizes.values())
+            return {
+                "requests": self._waits.count,
+                "batches": batches,
+                "mean_batch_size": self._waits.count / batches if batches else 0.0,
+                "batch_sizes": dict(sorted(self._batch_sizes.items())),
+                "wait_p50_ms": self._waits.percentile(0.50) * 1000,
+                "wait_p95_ms": self._waits.percentile(0.95) * 1000,
+                "wait_p99_ms": self._waits.percentile(0.99) * 1000,
+                "queue_p50_ms": self._queueing.percentile(0.50) * 1000,
+                "queue_p95_ms": self._queueing.percentile(0.95) * 1000,
+            }
+
+    def close(self):
+        """Send the questions that are still waiting, then stop the collector"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._collector.join()
+        self._executor.shutdown(wait=True)
+        logger.info("Query embedding batcher stats: %s", self.stats())
@@ -0,0 +1,30 @@
+"""Streaming LLM responses token by token, so users see the answer while it is still being generated."""
+
+import time
+from typing import Iterable, Iterator
+
+from util.tracing import tracer
+
+
+class TimedStream:
+    """Wraps a LangChain token stream (e.g. chat_generator.stream(...)) and measures the time to the first token
+    and the total generation time, and records both as tracing spans (llm_first_token, llm_generate).
+    Iterating it yields the text of each token, e.g. for st.write_stream."""
+
+    def __init__(self, stream: Iterable):
+        self.stream = stream
+        self.time_to_first_token: float | None = None
+        self.total_time: float | None = None
+
+    def __iter__(self) -> Iterator[str]:
+        start = time.perf_counter()
+        tokens = 0
+        for chunk in self.stream:
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - start
+                tracer.record("llm_first_token", self.time_to_first_token)
+            tokens += 1
+            # LLMs stream strings, chat models stream message chunks
+            yield getattr(chunk, "content", chunk)
+        self.total_time = time.perf_counter() - start
+        tracer.record("llm_generate", self.total_time, items=tokens)
@@ -0,0 +1,41 @@
+"""Counting tokens - the embeddings and chat APIs are limited and billed by tokens, not by characters."""
+
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger("AInstein")
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(encoding_name: str = "cl100k_base"):
+    """Load a tiktoken encoding once per process. Returns None if tiktoken or the encoding is not available."""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        # tiktoken downloads encodings on first use, which fails on machines without internet access
+        logger.warning("Could not load tokenizer %s (%r), token counts are estimated from the text length", encoding_name, e)
+        return None
+
+
+def count_tokens(text: str, encoding_name: str = "cl100k_base") -> int:
+    """Count the tokens of a text, or estimate them (~4 characters per token) without tiktoken"""
+    tokenizer = get_tokenizer(encoding_name)
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, encoding_name: str = "cl100k_base") -> str:
+    """The beginning of a text with at most max_tokens tokens (estimated without tiktoken)"""
+    if max_tokens <= 0:
+        return ""
+    tokenizer = get_tokenizer(encoding_name)
+    if tokenizer is None:
+        # consistent with the estimate of count_tokens
+        return text[: (max_tokens - 1) * 4]
+    tokens = tokenizer.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return tokenizer.decode(tokens[:max_tokens])
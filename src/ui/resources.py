@@ -0,0 +1,127 @@
+"""Streamlit re-executes the whole UI script on every interaction. To avoid rebuilding the Qdrant client, the embedder
+and the chat model each time (and reopening the on-disk collection in local mode), they are created once per process
+with st.cache_resource and shared across all reruns and sessions."""
+
+import logging
+
+import streamlit as st
+
+from etl.jobs import JobRunner, JobTable
+from etl.progress import IngestProgress
+from etl.qdrant import QdrantClient, instantiate_qclient, is_healthy, list_document_names
+from etl.semantic_cache import SemanticCache
+from llm.chat import get_chat_generator
+from llm.embed import get_cached_embedder
+from llm.query_batcher import QueryEmbeddingBatcher
+from util.util import PROJECT_ROOT
+
+logger = logging.getLogger("AInstein")
+
+
+def _close_if_unhealthy(q_client: QdrantClient) -> bool:
+    if is_healthy(q_client):
+        return True
+    logger.warning("Qdrant client is not healthy anymore, creating a new one")
+    try:
+        # frees the lock on the storage in local mode, so the new client can open it
+        q_client.close()
+    except Exception:
+        pass
+    return False
+
+
+@st.cache_resource(validate=_close_if_unhealthy, show_spinner=False)
+def _get_qdrant_client(
+    storage_path: str, url: str, port: int, api_key: str, prefer_grpc: bool, grpc_port: int
+) -> QdrantClient:
+    logger.info("Creating Qdrant client")
+    return instantiate_qclient(storage_path, url, port, api_key, prefer_grpc=prefer_grpc, grpc_port=grpc_port)
+
+
+def get_qdrant_client(qdrant_config: dict) -> QdrantClient:
+    """The process-wide Qdrant client. In server mode (qdrant.url instead of qdrant.storage_path)
+    it keeps its connections open, over gRPC if qdrant.prefer_grpc is set"""
+    return _get_qdrant_client(
+        qdrant_config.get("storage_path", ""),
+        qdrant_config.get("url", ""),
+        qdrant_config.get("port", 6333),
+        qdrant_config.get("api_key", ""),
+        qdrant_config.get("prefer_grpc", False),
+        qdrant_config.get("grpc_port", 6334),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_embedder(embedder, cache_path: str | None = None):
+    """The process-wide (cached) embedder"""
+    logger.info("Creating embedder %s", embedder)
+    return get_cached_embedder(embedder, cache_path or PROJECT_ROOT / "data" / "embedding_cache.sqlite")
+
+
+@st.cache_resource(show_spinner=False)
+def _get_query_batcher(
+    embedder, cache_path: str | None, max_wait_ms: float, max_batch_size: int
+) -> QueryEmbeddingBatcher:
+    logger.info("Batching query embeddings within %s ms, at most %s per batch", max_wait_ms, max_batch_size)
+    return QueryEmbeddingBatcher(get_embedder(embedder, cache_path), max_wait_ms, max_batch_size)
+
+
+def get_query_embedder(embedder, config: dict):
+    """The process-wide embedder for the questions. With query_batching.enabled in the config, the questions
+    of all sessions are embedded in micro-batches, see query_batcher.py"""
+    cache_path = config["paths"].get("embedding_cache")
+    batching_config = config.get("query_batching", {})
+    if not batching_config.get("enabled", False):
+        return get_embedder(embedder, cache_path)
+    return _get_query_batcher(
+        embedder, cache_path, batching_config.get("max_wait_ms", 10), batching_config.get("max_batch_size", 32)
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_chat_model(chat_generator):
+    """The process-wide chat model"""
+    logger.info("Creating chat generator %s", chat_generator)
+    return get_chat_generator(chat_generator)
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_document_names(_q_client: QdrantClient, collection_name: str) -> list[str]:
+    """The names of the documents in the collection, refreshed at most once a minute"""
+    return list_document_names(_q_client, collection_name)
+
+
+def get_semantic_cache(q_client: QdrantClient, config: dict) -> SemanticCache | None:
+    """The semantic answer cache, or None if it is not enabled (semantic_cache.enabled in the config)"""
+    cache_config = config.get("semantic_cache", {})
+    if not cache_config.get("enabled", False):
+        return None
+    return SemanticCache(
+        q_client,
+        collection_name=cache_config.get("collection", "answer_cache"),
+        threshold=cache_config.get("threshold", 0.95),
+        ttl_seconds=cache_config.get("ttl_seconds", 24 * 60 * 60),
+    )
+
+
+def _run_ingestion(params: dict, progress: IngestProgress, q_client: QdrantClient):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    import etl.ingest as ingest
+
+    # text splitter that is used. can theoretically be changed to other text splitters
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=params["chunk_size"],
+        chunk_overlap=params["chunk_overlap"],
+        length_function=len,
+        add_start_index=True,
+        is_separator_regex=False,
+    )
+    ingest.main(text_splitter=text_splitter, qdrant_client=q_client, progress=progress)
+
+
+@st.cache_resource(show_spinner=False)
+def get_ingestion_jobs(jobs_path: str | None = None) -> JobRunner:
+    """The process-wide runner of ingestion jobs. It runs one job at a time, so two ingestions never update the
+    collection and the manifest at once. Submit jobs with the Qdrant client of the UI (q_client=...)."""
+    return JobRunner(JobTable(jobs_path or PROJECT_ROOT / "data" / "jobs.sqlite"), "ingestion", _run_ingestion)
@@ -1,30 +1,82 @@
-import streamlit as st
+import time
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import streamlit as st
 
-from llm.chat import get_chat_generator
-from llm.embed import get_embedder
+from etl.diversify import diversified_search
 from etl.model import Document
-from etl.qdrant import instantiate_qclient, search_documents
+from etl.profiles import get_profile
+from etl.qdrant import DocumentFilter, retrieve_documents, search_documents
+from etl.sparse import get_sparse_encoder
+from llm.context import pack_context
+from llm.query_batcher import QueryEmbeddingBatcher
+from llm.streaming import TimedStream
+from etl.jobs import Job
+from ui.resources import (
+    get_chat_model,
+    get_document_names,
+    get_ingestion_jobs,
+    get_query_embedder,
+    get_qdrant_client,
+    get_semantic_cache,
+)
+from util.tracing import tracer, tracing_setup
 from util.util import PROJECT_ROOT, load_config
-import etl.ingest as ingest
-
 from langchain.schema.messages import HumanMessage, SystemMessage
 from langchain.prompts import PromptTemplate
 
 st.set_page_config(layout="wide")
 config = load_config(PROJECT_ROOT / "config" / "config.yml")
+tracing_setup(config)
 
 st.title("My chatbot 'built in a day'")
 
-embedder = config["embedder"]
-embedder = get_embedder(embedder)
-
-chat_generator = config["chat_generator"]
-chat_generator = get_chat_generator(chat_generator)
+# these are created once per process and shared by all sessions, see resources.py
+collection_profile = get_profile(config["qdrant"])
+embedder = get_query_embedder(collection_profile.embedder_config(config["embedder"]), config)
+chat_generator = get_chat_model(config["chat_generator"])
+qdrant = get_qdrant_client(config["qdrant"])
+semantic_cache = get_semantic_cache(qdrant, config)
+sparse_encoder = get_sparse_encoder(config["qdrant"])
+ingestion_jobs = get_ingestion_jobs(config["paths"].get("jobs"))
 
 answer_generated = False
 
+STAGE_LABELS = {"parse": "Parsed", "embed": "Embedded", "upload": "Upserted"}
+
+
+def _format_seconds(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m {seconds:02d}s" if minutes else f"{seconds}s"
+
+
+def show_job(job: Job):
+    """Status, per-stage progress, and cancel or retry buttons of an ingestion job"""
+    duration = f" ({_format_seconds(job.duration_seconds)})" if job.duration_seconds is not None else ""
+    st.caption(f"Ingestion {job.id}: {job.status}{duration}")
+    for stage, label in STAGE_LABELS.items():
+        progress = job.progress.get(stage)
+        if not progress or (not progress["done"] and not progress["total"]):
+            continue
+        text = f"{label} {progress['done']}" + (f"/{progress['total']}" if progress["total"] is not None else "")
+        text += f" {progress['unit']}"
+        if progress["rate"]:
+            text += f", {progress['rate']:.1f}/s"
+        if progress["eta_seconds"] is not None and not job.finished:
+            text += f", ETA {_format_seconds(progress['eta_seconds'])}"
+        fraction = progress["done"] / progress["total"] if progress["total"] else 0.0
+        st.progress(min(fraction, 1.0), text=text)
+    if job.error:
+        st.error(job.error)
+    if not job.finished:
+        if st.button("Cancel", key=f"cancel_{job.id}"):
+            ingestion_jobs.cancel(job.id)
+    elif job.status != "succeeded":
+        if st.button("Retry", key=f"retry_{job.id}"):
+            ingestion_jobs.retry(job.id, q_client=qdrant)
+            st.rerun(scope="app")
+    elif job.finished_at is not None and time.time() - job.finished_at < 60:
+        st.success("Ingestion complete")
+
 prompt_instructions = """\
     You're a helpful assistant.\
     When answering a question, be mildly rude and complain about how much work you have to do, but then provide an adequate answer.'\
@@ -35,20 +87,71 @@ with st.sidebar:
     st.subheader("Display options")
     st.toggle("Show prompt template", False, key="show_prompt_template")
     st.toggle("Show chunks", False, key="show_chunks")
+    st.caption(f"Embedding cache: {embedder.hits} hits, {embedder.misses} misses")
+    if isinstance(embedder, QueryEmbeddingBatcher):
+        batching = embedder.stats()
+        st.caption(
+            f"Query batching: {batching['requests']} questions in {batching['batches']} batches "
+            f"(mean size {batching['mean_batch_size']:.1f}), p95 wait {batching['wait_p95_ms']:.1f} ms "
+            f"plus {batching['queue_p95_ms']:.1f} ms for a free batch slot"
+        )
     st.write("")
     st.write("")
+    st.subheader("Search")
+    st.multiselect(
+        "Only search in", get_document_names(qdrant, config["qdrant"]["document_collection"]), key="documents",
+        placeholder="All documents",
+    )
+    first_page, last_page = st.columns(2)
+    first_page.number_input("From page", min_value=1, value=None, step=1, key="first_page", placeholder="first")
+    last_page.number_input("To page", min_value=1, value=None, step=1, key="last_page", placeholder="last")
+    st.slider("Number of results", 1, 50, 10, key="limit")
+    # only available if the collection has BM25 vectors (qdrant.hybrid in the config)
+    st.toggle("Hybrid search (keywords + embeddings)", sparse_encoder is not None, key="hybrid", disabled=sparse_encoder is None)
+    similarity_help = "Cosine similarity between the question and a chunk"
+    if st.session_state["hybrid"]:
+        # the fused ranking (RRF) is rank based, the threshold only filters the embedding candidates before the fusion
+        similarity_help += ". In hybrid search it only drops embedding matches, keyword matches are kept regardless"
+    st.slider("Minimum similarity", 0.0, 1.0, 0.0, step=0.05, key="score_threshold", help=similarity_help)
+    # picks the top k chunks from the results with MMR, skipping near-duplicates of overlapping chunks
+    mmr_config = config.get("retrieval", {}).get("mmr", {})
+    st.toggle("Diversify chunks (MMR)", mmr_config.get("enabled", False), key="mmr")
+    if st.session_state["mmr"]:
+        st.slider("Relevance vs. diversity", 0.0, 1.0, mmr_config.get("lambda_mult", 0.5), step=0.05, key="lambda_mult")
+        st.slider("Duplicate threshold", 0.8, 1.0, mmr_config.get("duplicate_threshold", 0.95), step=0.01, key="duplicate_threshold")
+    st.write("")
     st.subheader("Chunking strategy")
     st.slider("Use top k chunks", 1, 10, 1, key="k")
+    st.number_input(
+        "Context budget (tokens)", 100, 16_000, config.get("retrieval", {}).get("context_tokens", 2_000), step=100,
+        key="context_tokens",
+    )
     with st.expander("Ingestion", expanded=True):
         st.number_input("Chunk size", 100, 3000, 200, step=300, key="chunk_size", format="%d")
         st.number_input("Chunk overlap", 0, 500, 0, step=50, key="chunk_overlap", format="%d")
-        if st.button("Run ingestion", key="ingestion"):
-            # text splitter that is used. can theoretically be changed to other text splitters
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=st.session_state["chunk_size"], chunk_overlap=st.session_state["chunk_overlap"], length_function=len,
-                    add_start_index=True, is_separator_regex = False,)
-            ingest.main(
-                text_splitter=text_splitter)
-            st.success("Ingestion complete")
+        # the ingestion runs as a background job, questions are still answered in the meantime
+        ingestion_running = bool(ingestion_jobs.active())
+        if st.button("Run ingestion", key="ingestion", disabled=ingestion_running):
+            ingestion_jobs.submit(
+                {"chunk_size": st.session_state["chunk_size"], "chunk_overlap": st.session_state["chunk_overlap"]},
+                q_client=qdrant,
+            )
+            ingestion_running = True
+
+        # polls the job every second while one is running, without rerunning the rest of the page
+        @st.fragment(run_every=1 if ingestion_running else None)
+        def ingestion_status():
+            latest = ingestion_jobs.table.recent("ingestion", limit=1)
+            if not latest:
+                return
+            job = latest[0]
+            show_job(job)
+            if job.finished and ingestion_running:
+                # the documents changed: refresh the document list and stop polling
+                get_document_names.clear()
+                st.rerun(scope="app")
+
+        ingestion_status()
 
 prompt_template_string = """Task: Answer the question based on the context.
 Kontext: {context}
@@ -73,12 +176,57 @@ if st.button("Generate"):
     else:
         qa_field = st.container()
     with qa_field:
+        cached_answer = None
+        # pages are shown from 1, but numbered from 0 in the payload
+        document_filter = DocumentFilter(
+            names=st.session_state["documents"],
+            min_page=st.session_state["first_page"] - 1 if st.session_state["first_page"] else None,
+            max_page=st.session_state["last_page"] - 1 if st.session_state["last_page"] else None,
+        )
+        # answers are only reused for the same instructions, template, number of chunks and search scope
+        cache_key = (
+            f"{prompt_instructions}\n{prompt_template_string}\nk={st.session_state['k']}\nbudget={st.session_state['context_tokens']}\n"
+            f"filter={document_filter}\nlimit={st.session_state['limit']}\nmin_score={st.session_state['score_threshold']}\n"
+            f"hybrid={st.session_state['hybrid']}\nmmr={st.session_state['mmr']}/"
+            f"{st.session_state.get('lambda_mult')}/{st.session_state.get('duplicate_threshold')}"
+        )
         if user_input:
 
             qdrant_config = config["qdrant"]
-            qdrant = instantiate_qclient(qdrant_config["storage_path"])
-            embedded_question = embedder.embed_query(user_input)
-            top_10_documents = search_documents(qdrant, qdrant_config["document_collection"], embedded_question)
+            with tracer.span("embed_query"):
+                embedded_question = embedder.embed_query(user_input)
+            if semantic_cache:
+                cached_answer = semantic_cache.lookup(embedded_question, cache_key)
+            if cached_answer:
+                top_10_documents = retrieve_documents(
+                    qdrant, qdrant_config["document_collection"], cached_answer.chunk_ids
+                )
+            else:
+                search_kwargs = dict(
+                    search_params=collection_profile.search_params(),
+                    document_filter=document_filter,
+                    score_threshold=st.session_state["score_threshold"] or None,
+                    sparse_question=sparse_encoder.encode_query(user_input) if st.session_state["hybrid"] else None,
+                )
+                if st.session_state["mmr"]:
+                    top_10_documents = diversified_search(
+                        qdrant,
+                        qdrant_config["document_collection"],
+                        embedded_question,
+                        k=st.session_state["k"],
+                        candidates=st.session_state["limit"],
+                        lambda_mult=st.session_state["lambda_mult"],
+                        duplicate_threshold=st.session_state["duplicate_threshold"],
+                        **search_kwargs,
+                    )
+                else:
+                    top_10_documents = search_documents(
+                        qdrant,
+                        qdrant_config["document_collection"],
+                        embedded_question,
+                        limit=st.session_state["limit"],
+                        **search_kwargs,
+                    )
 
             if not top_10_documents:
                 st.warning("No results found.")
@@ -89,26 +237,49 @@ if st.button("Generate"):
 
         st.subheader("LLM Response:")
 
-        # build context blob
-        st.session_state["context"] = "...\n\n...".join([chunk.content for _, chunk, _ in st.session_state["top_10_chunks"][0:st.session_state["k"]]])
-
-        # create message history to call LLM with
-        messages = [SystemMessage(content=prompt_instructions), HumanMessage(
-            content=prompt_template.format(user_input=user_input,
-                                           context=st.session_state["context"])), ]
+        with tracer.span("prompt_assembly"):
+            # build context blob: the top k chunks, as far as they fit into the token budget
+            packed_context = pack_context(
+                [chunk for _, chunk, _ in st.session_state["top_10_chunks"][0:st.session_state["k"]]],
+                budget=st.session_state["context_tokens"],
+            )
+            st.session_state["context"] = packed_context.text
+            used_chunk_ids = {chunk.point_id for chunk in packed_context.documents}
 
-        st.session_state["response"] = chat_generator.invoke(messages)
+            # create message history to call LLM with
+            messages = [SystemMessage(content=prompt_instructions), HumanMessage(
+                content=prompt_template.format(user_input=user_input,
+                                               context=st.session_state["context"])), ]
 
-        st.write(st.session_state["response"])
-
-        # display chunks
+        # display chunks - before the LLM call, so they are visible while the answer is generated
         if st.session_state.show_chunks:
             with chunks:
                 if st.session_state.show_chunks:
                     st.subheader("Chunks")
+                    st.caption(
+                        f"Context: {packed_context.tokens_used} of {packed_context.budget} tokens, "
+                        f"{len(packed_context.documents)} chunks" + (" (trimmed)" if packed_context.truncated else "")
+                    )
                     if st.session_state["context"]:
                         for rank, chunk, source in st.session_state["top_10_chunks"][0:st.session_state["k"]]:
-                            st.write(f"**{rank}. ({source})**\n\n{chunk.content}")  # nicer to look at
+                            if chunk.point_id in used_chunk_ids:
+                                st.write(f"**{rank}. ({source})**\n\n{chunk.content}")  # nicer to look at
                         # st.write(st.session_state["context"])  # the actual text that is pasted into prompt template
+
+        if cached_answer:
+            st.session_state["response"] = cached_answer.answer
+            st.caption(f"Cached answer to the similar question \"{cached_answer.question}\" (similarity {cached_answer.score:.2f})")
+            st.write(st.session_state["response"])
+        else:
+            # stream the answer token by token into the page
+            response_stream = TimedStream(chat_generator.stream(messages))
+            st.session_state["response"] = st.write_stream(response_stream)
+            time_to_first_token, generation_time = st.columns(2)
+            time_to_first_token.metric("Time to first token", f"{response_stream.time_to_first_token or 0:.2f} s")
+            generation_time.metric("Generation time", f"{response_stream.total_time or 0:.2f} s")
+            if semantic_cache and user_input:
+                used_chunks = [chunk.point_id for chunk in packed_context.documents]
+                semantic_cache.store(user_input, embedded_question, cache_key, st.session_state["response"], used_chunks)
+        tracer.write_prometheus()
 else:
     st.warning("Please enter some text.")
@@ -0,0 +1,204 @@
+"""A lightweight tracing layer to see where the time goes, in the ingestion and in the query path.
+Code is instrumented with spans:
+
+    with tracer.span("embed_batch", items=len(texts)) as span:
+        ...
+        span.nbytes = ...
+
+Every finished span is recorded in a per-stage histogram (count, sum, p50/p95/p99 of the duration, items and bytes)
+and can be appended to a JSONL file. The histograms can be written as a Prometheus textfile.
+When tracing is disabled, span() returns a shared no-op object, so instrumented code costs next to nothing."""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Dict
+
+logger = logging.getLogger("AInstein")
+
+
+class _NoopSpan:
+    items = None
+    nbytes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "items", "nbytes", "start", "duration")
+
+    def __init__(self, tracer: "Tracer", name: str, items: int | None, nbytes: int | None):
+        self.tracer = tracer
+        self.name = name
+        self.items = items
+        self.nbytes = nbytes
+        self.start = 0.0
+        self.duration = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.duration = time.perf_counter() - self.start
+        self.tracer.record(self.name, self.duration, self.items, self.nbytes, failed=exc_type is not None)
+        return False
+
+
+class StageStats:
+    """Duration histogram of one stage. Percentiles are computed from the most recent max_samples durations."""
+
+    def __init__(self, max_samples: int = 10_000):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.items = 0
+        self.nbytes = 0
+        self.durations: deque[float] = deque(maxlen=max_samples)
+
+    def add(self, duration: float, items: int | None, nbytes: int | None, failed: bool):
+        self.count += 1
+        self.errors += failed
+        self.total += duration
+        self.items += items or 0
+        self.nbytes += nbytes or 0
+        self.durations.append(duration)
+
+    def percentile(self, q: float) -> float:
+        if not self.durations:
+            return 0.0
+        durations = sorted(self.durations)
+        return durations[min(len(durations) - 1, int(q * len(durations)))]
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_s": self.total,
+            "items": self.items,
+            "bytes": self.nbytes,
+            "p50_s": self.percentile(0.50),
+            "p95_s": self.percentile(0.95),
+            "p99_s": self.percentile(0.99),
+        }
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.jsonl_path: Path | None = None
+        self.prometheus_path: Path | None = None
+        self.stages: Dict[str, StageStats] = {}
+        self._lock = threading.Lock()
+        self._jsonl_file = None
+
+    def configure(self, enabled: bool, jsonl_path: str | Path | None = None, prometheus_path: str | Path | None = None):
+        jsonl_path = Path(jsonl_path) if jsonl_path else None
+        prometheus_path = Path(prometheus_path) if prometheus_path else None
+        if (enabled, jsonl_path, prometheus_path) == (self.enabled, self.jsonl_path, self.prometheus_path):
+            # e.g. the Streamlit UIs call this on every rerun
+            return
+        with self._lock:
+            self.enabled = enabled
+            if self._jsonl_file is not None:
+                self._jsonl_file.close()
+                self._jsonl_file = None
+            self.jsonl_path = jsonl_path
+            self.prometheus_path = prometheus_path
+            if enabled and self.jsonl_path is not None:
+                self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+                self._jsonl_file = open(self.jsonl_path, "a", encoding="utf-8", buffering=1)
+
+    def span(self, name: str, items: int | None = None, nbytes: int | None = None):
+        """A context manager measuring the duration of its block as one span of the stage name"""
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, items, nbytes)
+
+    def record(self, name: str, duration: float, items: int | None = None, nbytes: int | None = None, failed=False):
+        """Record a span that was measured elsewhere"""
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(duration, items, nbytes, failed)
+            if self._jsonl_file is not None:
+                event = {"ts": time.time(), "stage": name, "duration_s": duration, "items": items, "bytes": nbytes}
+                if failed:
+                    event["error"] = True
+                self._jsonl_file.write(json.dumps(event) + "\n")
+
+    def summary(self) -> dict[str, dict]:
+        with self._lock:
+            return {name: stats.summary() for name, stats in sorted(self.stages.items())}
+
+    def write_prometheus(self, path: str | Path | None = None):
+        """Write the stage histograms in the Prometheus text format, e.g. for the node_exporter textfile collector"""
+        path = Path(path) if path else self.prometheus_path
+        if not self.enabled or path is None:
+            return
+
+        lines = [
+            "# HELP ainstein_stage_duration_seconds Duration of the stages of ingestion and query path",
+            "# TYPE ainstein_stage_duration_seconds summary",
+        ]
+        summary = self.summary()
+        for stage, stats in summary.items():
+            for quantile, key in (("0.5", "p50_s"), ("0.95", "p95_s"), ("0.99", "p99_s")):
+                lines.append(f'ainstein_stage_duration_seconds{{stage="{stage}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'ainstein_stage_duration_seconds_sum{{stage="{stage}"}} {stats["total_s"]}')
+            lines.append(f'ainstein_stage_duration_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        for metric, key, help_text in (
+            ("ainstein_stage_errors_total", "errors", "Failed spans per stage"),
+            ("ainstein_stage_items_total", "items", "Items (documents, chunks, points) processed per stage"),
+            ("ainstein_stage_bytes_total", "bytes", "Bytes processed per stage"),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f'{metric}{{stage="{stage}"}} {stats[key]}' for stage, stats in summary.items())
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = path.with_suffix(path.suffix + ".tmp")
+        tmp_file.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        os.replace(tmp_file, path)
+
+    def log_summary(self):
+        for stage, stats in self.summary().items():
+            logger.info(
+                "%s: %s spans, %s items, p50 %.3fs, p95 %.3fs, p99 %.3fs, total %.1fs",
+                stage, stats["count"], stats["items"], stats["p50_s"], stats["p95_s"], stats["p99_s"], stats["total_s"],
+            )
+
+
+# the process-wide tracer, used by all instrumented code
+tracer = Tracer()
+
+
+def tracing_setup(config: Dict):
+    """
+    setup tracing based on the configuration (optional 'tracing' section with enabled, jsonl_path, prometheus_path)
+
+    :param config: the parsed config tree
+    """
+    tracing_conf = config.get("tracing", {})
+    tracer.configure(
+        enabled=tracing_conf.get("enabled", False),
+        jsonl_path=tracing_conf.get("jsonl_path"),
+        prometheus_path=tracing_conf.get("prometheus_path"),
+    )
@@ -4,9 +4,6 @@ import shutil
 from pathlib import Path
 from typing import Any, Dict, Union
 
-import pkg_resources
-import yaml
-
 logger = logging.getLogger("AInstein")
 
 PROJECT_ROOT = Path(__file__).parent.parent.parent
@@ -21,26 +18,31 @@ def get_resource_string(path: str, decode=True) -> Union[str, bytes]:
     :param decode: if true, decode the file contents as string (otherwise return bytes)
     :return: the contents of the resource file (as string or bytes)
     """
+    import pkg_resources
+
     s = pkg_resources.resource_string(__name__.split(".")[0], path)
     return s.decode(errors="ignore") if decode else s
 
 
-# def load_config(config_file: Union[str, Path]) -> Dict[str, Any]:
-#     """
-#     Load the config from the specified yaml file
+def load_config(config_file: Union[str, Path]) -> Dict[str, Any]:
+    """
+    Load the config from the specified yaml file
+
+    :param config_file: path of the config file to load
+    :return: the parsed config as dictionary
+    """
+    import yaml
 
-#     :param config_file: path of the config file to load
-#     :return: the parsed config as dictionary
-#     """
-#     with open(config_file, "r") as fp:
-#         config = yaml.safe_load(fp)
+    with open(config_file, "r") as fp:
+        config = yaml.safe_load(fp)
 
-#     for data_path in config["paths"]["data"]:
-#         config["paths"]["data"][data_path] = str(Path(config["paths"]["data"][data_path]))
+    for data_path in config.get("paths", {}).get("data", {}):
+        config["paths"]["data"][data_path] = str(Path(config["paths"]["data"][data_path]))
 
-#     config["qdrant"]["storage_path"] = str(Path(config["qdrant"]["storage_path"]))
+    if config.get("qdrant", {}).get("storage_path"):
+        config["qdrant"]["storage_path"] = str(Path(config["qdrant"]["storage_path"]))
 
-#     return config
+    return config
 
 
 def logging_setup(config: Dict):
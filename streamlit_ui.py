@@ -1,18 +1,31 @@
+import sys
+from pathlib import Path
+
 import streamlit as st
 
-from src.llm.chat import get_chat_generator, OpenAIModelSelection
-from src.llm.embed import get_embedder, OpenAIEmbedderSelection
-from src.etl.model import Document
-from src.etl.qdrant import instantiate_qclient, search_documents
-from src.util.util import PROJECT_ROOT, load_config
+# the modules in src import each other as top-level packages (etl, llm, util, ui)
+sys.path.insert(0, str(Path(__file__).parent / "src"))
 
+from llm.chat import OpenAIModelSelection
+from llm.embed import OpenAIEmbedderSelection
+from etl.model import Document
+from etl.profiles import get_profile
+from etl.qdrant import search_documents
+from etl.sparse import get_sparse_encoder
+from llm.context import pack_context
+from llm.streaming import TimedStream
+from ui.resources import get_chat_model, get_qdrant_client, get_query_embedder, get_semantic_cache
+from util.tracing import tracer, tracing_setup
+from util.util import PROJECT_ROOT, load_config
 
+config = load_config(PROJECT_ROOT / "config" / "config.yml")
+tracing_setup(config)
 
 INPUT_PROMPT = """\
 [INST] <<SYS>>
 You are helpful assistant. \
 <</SYS>>
-The best matching reference is:
+The best matching references are:
 {reference_1}
 
 Please provide an answer to the following question, based on the given references above:
@@ -22,9 +35,13 @@ Please provide an answer to the following question, based on the given reference
 
 st.title("Hallo, ich bin AInstein. Wie kann ich dir helfen?")
 
-embedder = get_embedder(OpenAIEmbedderSelection.SMALL)
-
-chat_generator = get_chat_generator(OpenAIModelSelection.GPT3)
+# these are created once per process and shared by all sessions, see src/ui/resources.py
+collection_profile = get_profile(config["qdrant"])
+embedder = get_query_embedder(collection_profile.embedder_config(config.get("embedder", OpenAIEmbedderSelection.SMALL.value)), config)
+chat_generator = get_chat_model(OpenAIModelSelection.GPT3.value)
+qdrant = get_qdrant_client(config["qdrant"])
+semantic_cache = get_semantic_cache(qdrant, config)
+sparse_encoder = get_sparse_encoder(config["qdrant"])
 
 # TASK 3.1: Add a text input widget
 # Checkout https://docs.streamlit.io/library/api-reference/text and https://docs.streamlit.io/library/api-reference/widgets
@@ -34,11 +51,28 @@ if st.button("Generate"):
     if user_input:
 
         qdrant_config = config["qdrant"]
-        qdrant = instantiate_qclient(qdrant_config["storage_path"])
+        context_budget = config.get("retrieval", {}).get("context_tokens", 2_000)
+        # answers are only reused for the same template, context budget and search mode
+        cache_key = f"{INPUT_PROMPT}\nbudget={context_budget}\nhybrid={sparse_encoder is not None}"
         # TASK 3.2: Embed the user input
-        embedded_question = embedder.embed_query(user_input)
+        with tracer.span("embed_query"):
+            embedded_question = embedder.embed_query(user_input)
+
+        # a similar question was answered before with the same prompt: no need to search and ask the LLM again
+        cached_answer = semantic_cache.lookup(embedded_question, cache_key) if semantic_cache else None
+        if cached_answer:
+            st.write("LLM Response:")
+            st.caption(f"Cached answer to the similar question \"{cached_answer.question}\"")
+            st.write(cached_answer.answer)
+            st.stop()
+
         top_10_documents = search_documents(
-            qdrant, qdrant_config["document_collection"], embedded_question
+            qdrant,
+            qdrant_config["document_collection"],
+            embedded_question,
+            search_params=collection_profile.search_params(),
+            # hybrid search: part numbers, error codes and names also match exactly
+            sparse_question=sparse_encoder.encode_query(user_input) if sparse_encoder else None,
         )
 
         if not top_10_documents:
@@ -51,19 +85,33 @@ if st.button("Generate"):
             (rank, Document.from_qdrant_scored_point(document))
             for rank, document in enumerate(top_10_documents, start=1)
         ]
-        text_of_top_result = document_results[0][1].content
+        # as many of the best chunks as fit into the token budget of the context
+        packed_context = pack_context(
+            [document for _, document in document_results],
+            budget=context_budget,
+        )
             
     st.write("LLM Response:")
     
     # TASK 3.4: Add reasonable prompts for the chatbot - in case you are unhappy with the provided prompt
-    input_prompt = INPUT_PROMPT.format(
-        reference_1=text_of_top_result,
-        question=user_input)
+    with tracer.span("prompt_assembly"):
+        input_prompt = INPUT_PROMPT.format(
+            reference_1=packed_context.text,
+            question=user_input)
 
-    # TASK 3.5: Invoke the chat generator with the input prompt
-    response = chat_generator.invoke(input_prompt)
+    with st.expander(f"References ({packed_context.tokens_used} tokens)"):
+        st.write(packed_context.text)
 
+    # TASK 3.5: Invoke the chat generator with the input prompt
     # TASK 3.6: Display the response
-    st.write(response)
+    # the response is streamed token by token, so it is shown while it is still being generated
+    response_stream = TimedStream(chat_generator.stream(input_prompt))
+    response = st.write_stream(response_stream)
+    time_to_first_token, generation_time = st.columns(2)
+    time_to_first_token.metric("Time to first token", f"{response_stream.time_to_first_token or 0:.2f} s")
+    generation_time.metric("Generation time", f"{response_stream.total_time or 0:.2f} s")
+    if semantic_cache:
+        semantic_cache.store(user_input, embedded_question, cache_key, response, [document.point_id for document in packed_context.documents])
+    tracer.write_prometheus()
 else:
     st.warning("Please enter some text.")
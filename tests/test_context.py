@@ -0,0 +1,78 @@
+import random
+
+from etl.model import Document
+from llm.context import CONTEXT_SEPARATOR, pack_context
+from llm.tokens import count_tokens
+
+CHUNK_SIZE, OVERLAP = 400, 100
+
+
+def _page_chunks(text: str, source: str = "manual.pdf", page: int = 0) -> list[Document]:
+    """Overlapping chunks of one page, like a splitter with add_start_index=True makes them"""
+    chunks = []
+    for chunk, start in enumerate(range(0, len(text) - OVERLAP, CHUNK_SIZE - OVERLAP)):
+        content = text[start:start + CHUNK_SIZE]
+        chunks.append(
+            Document(
+                content=content, source=source, page=page, chunk=chunk, start_index=start, tokens=count_tokens(content)
+            )
+        )
+    return chunks
+
+
+def _page_text(length: int = 1300, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = ["pump", "valve", "pressure", "seal", "motor", "flow", "bar", "check", "replace", "torque"]
+    text = ""
+    while len(text) < length:
+        text += rng.choice(words) + " "
+    return text[:length]
+
+
+def test_overlapping_chunks_are_sent_once():
+    text = _page_text()
+    chunks = _page_chunks(text)
+    packed = pack_context(chunks, budget=10_000)
+    assert packed.text == text
+
+
+def test_chunk_that_bridges_two_passages_joins_them():
+    text = _page_text()
+    chunks = _page_chunks(text)
+    assert [chunk.start_index for chunk in chunks] == [0, 300, 600, 900]
+
+    # relevance order 0, 2, 1, 3: chunk 1 connects the passages of chunk 0 and chunk 2
+    packed = pack_context([chunks[0], chunks[2], chunks[1], chunks[3]], budget=10_000)
+    assert CONTEXT_SEPARATOR not in packed.text
+    assert packed.text == text
+    assert len(packed.documents) == 4
+    # the token accounting follows the text that is actually sent
+    assert abs(packed.tokens_used - count_tokens(packed.text)) <= 4
+
+
+def test_bridged_passages_keep_the_place_of_the_first():
+    text = _page_text()
+    chunks = _page_chunks(text)
+    other = Document(content="another page", source="other.pdf", page=3, tokens=count_tokens("another page"))
+
+    packed = pack_context([chunks[0], other, chunks[2], chunks[1]], budget=10_000)
+    assert packed.text == text[:1000] + CONTEXT_SEPARATOR + "another page"
+
+
+def test_contained_chunk_adds_nothing():
+    text = _page_text()
+    chunks = _page_chunks(text)
+    inner = Document(content=text[350:450], source="manual.pdf", page=0, chunk=9, start_index=350, tokens=30)
+
+    packed = pack_context([chunks[0], chunks[1], inner], budget=10_000)
+    assert packed.text == text[:700]
+    # chunk 1 adds the 300 characters after chunk 0, the contained chunk nothing
+    assert packed.tokens_used == chunks[0].tokens + round(chunks[1].tokens * 300 / 400)
+
+
+def test_budget_is_respected():
+    chunks = _page_chunks(_page_text(5000))
+    budget = 200
+    packed = pack_context(list(reversed(chunks)), budget=budget)
+    assert packed.truncated
+    assert packed.tokens_used <= budget
@@ -0,0 +1,98 @@
+import uuid
+
+import numpy as np
+import pytest
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import Mmr, ScoredPoint
+
+from etl import diversify as diversify_module
+from etl.diversify import diversified_search, diversify, drop_near_duplicates, mmr
+from etl.qdrant import create_db_collection, search_documents
+
+DIM = 16
+
+
+def _groups_of_duplicates(groups: int, per_group: int = 4, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    base = rng.standard_normal((groups, DIM), dtype=np.float32)
+    return np.repeat(base, per_group, axis=0) + 0.01 * rng.standard_normal((groups * per_group, DIM), dtype=np.float32)
+
+
+@pytest.fixture
+def collection():
+    client = QdrantClient(":memory:")
+    create_db_collection(client, "documents", DIM)
+    vectors = _groups_of_duplicates(10)
+    client.upload_collection(
+        "documents",
+        vectors=vectors,
+        payload=[{"content": f"chunk {index}", "group": index // 4} for index in range(len(vectors))],
+        ids=[str(uuid.uuid4()) for _ in vectors],
+        wait=True,
+    )
+    return client, vectors
+
+
+def test_mmr_skips_near_duplicates():
+    vectors = _groups_of_duplicates(3)
+    query = vectors[0]
+    relevance_only = mmr(query, vectors, k=3, lambda_mult=1.0, duplicate_threshold=None)
+    assert [index // 4 for index in relevance_only] == [0, 0, 0]
+    selected = mmr(query, vectors, k=3)
+    assert sorted(index // 4 for index in selected) == [0, 1, 2]
+
+
+def test_diversify_considers_all_candidates_by_default():
+    # the first 40 candidates are near-duplicates of 2 chunks, only the last ones differ
+    vectors = np.concatenate([_groups_of_duplicates(2, per_group=20), _groups_of_duplicates(3, seed=1)])
+    points = [
+        ScoredPoint(id=index, version=0, score=1 - index / len(vectors), payload={}, vector=vector.tolist())
+        for index, vector in enumerate(vectors)
+    ]
+    selected = diversify(points, vectors[0].tolist(), k=5)
+    assert len(selected) == 5
+    assert diversify(points, vectors[0].tolist(), k=5, max_candidates=40) == selected[:2]
+
+
+def test_drop_near_duplicates_keeps_the_first_of_each_group():
+    vectors = _groups_of_duplicates(2, per_group=2)
+    points = [ScoredPoint(id=index, version=0, score=0, vector=vector.tolist()) for index, vector in enumerate(vectors)]
+    assert [point.id for point in drop_near_duplicates(points, 0.95)] == [0, 2]
+    assert drop_near_duplicates(points, None) == points
+
+
+def test_diversified_search_in_local_mode(collection):
+    client, vectors = collection
+    points = diversified_search(client, "documents", vectors[0].tolist(), k=5, candidates=40)
+    assert len(points) == 5
+    assert len({point.payload["group"] for point in points}) == 5
+    assert points[0].payload["group"] == 0
+
+
+def test_search_documents_with_mmr(collection):
+    client, vectors = collection
+    plain = search_documents(client, "documents", vectors[0].tolist(), limit=5)
+    assert len({point.payload["group"] for point in plain}) < 5
+
+    points = search_documents(
+        client, "documents", vectors[0].tolist(), limit=5, mmr=Mmr(diversity=0.9, candidates_limit=40)
+    )
+    assert len({point.payload["group"] for point in points}) == 5
+    # the scores are still the similarities to the question
+    assert points[0].score == pytest.approx(plain[0].score)
+
+
+def test_diversified_search_on_a_server_runs_mmr_there(collection, monkeypatch):
+    client, vectors = collection
+    searches = []
+
+    def search(*args, **kwargs):
+        searches.append(kwargs)
+        return search_documents(*args, **kwargs)
+
+    monkeypatch.setattr(diversify_module, "is_local", lambda q_client: False)
+    monkeypatch.setattr(diversify_module, "search_documents", search)
+    points = diversified_search(client, "documents", vectors[0].tolist(), k=5, candidates=40, lambda_mult=0.1)
+
+    assert [(kwargs["limit"], kwargs["mmr"].candidates_limit) for kwargs in searches] == [(5, 40)]
+    assert len({point.payload["group"] for point in points}) == len(points) == 5
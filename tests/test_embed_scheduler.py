@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from etl.progress import IngestionCancelled
+from llm.embed_scheduler import EmbeddingBatchError, EmbeddingScheduler, RateLimiter, is_retryable, make_batches
+
+
+class StubEmbedder:
+    """Embeds each text as [len(text)], failing for the texts in fail (a number of times, or always)"""
+
+    def __init__(self, fail: dict[str, Exception] | None = None, failures: int | None = None, delay: float = 0.0):
+        self.fail = fail or {}
+        self.failures = failures
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self._lock:
+            self.calls.append(list(texts))
+            failing = [text for text in texts if text in self.fail]
+            if failing and (self.failures is None or self.failures > 0):
+                if self.failures is not None:
+                    self.failures -= 1
+                raise self.fail[failing[0]]
+        time.sleep(self.delay)
+        return [[float(len(text))] for text in texts]
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def _scheduler(embedder: StubEmbedder, **kwargs) -> EmbeddingScheduler:
+    kwargs = {"requests_per_minute": None, "tokens_per_minute": None, "backoff_base": 0.0, **kwargs}
+    return EmbeddingScheduler(embedder, **kwargs)
+
+
+def test_make_batches_by_tokens_and_size():
+    assert make_batches([3, 3, 3, 3], max_batch_tokens=6, max_batch_size=10) == [[0, 1], [2, 3]]
+    assert make_batches([1, 1, 1, 1, 1], max_batch_tokens=100, max_batch_size=2) == [[0, 1], [2, 3], [4]]
+    # a text above the budget gets a batch of its own
+    assert make_batches([2, 10, 2], max_batch_tokens=5, max_batch_size=10) == [[0], [1], [2]]
+    assert make_batches([], max_batch_tokens=5, max_batch_size=10) == []
+
+
+def test_embed_batches_by_tokens_and_size_and_keeps_the_order():
+    embedder = StubEmbedder()
+    texts = [f"text {'x' * index}" for index in range(7)]
+    done = []
+
+    embeddings = _scheduler(embedder, max_batch_tokens=4, max_batch_size=3).embed(
+        texts, on_batch_done=lambda batch, batch_embeddings: done.append(batch), token_counts=[1, 1, 1, 1, 3, 3, 1]
+    )
+
+    assert embeddings == [[float(len(text))] for text in texts]
+    assert sorted(embedder.calls) == sorted([texts[0:3], texts[3:5], texts[5:7]])
+    assert sorted(done) == [[0, 1, 2], [3, 4], [5, 6]]
+
+
+def test_retryable_errors_are_retried():
+    embedder = StubEmbedder(fail={"b": StatusError(429)}, failures=2)
+    embeddings = _scheduler(embedder, max_batch_size=1, max_retries=2).embed(["a", "b"], token_counts=[1, 1])
+
+    assert embeddings == [[1.0], [1.0]]
+    assert embedder.calls.count(["b"]) == 3
+
+
+def test_retries_are_limited():
+    embedder = StubEmbedder(fail={"b": ConnectionError("reset")})
+    with pytest.raises(EmbeddingBatchError):
+        _scheduler(embedder, max_batch_size=1, max_retries=2).embed(["a", "b"], token_counts=[1, 1])
+    assert embedder.calls.count(["b"]) == 3
+
+
+def test_batch_error_carries_only_the_failed_batches():
+    error = ValueError("input too long")
+    embedder = StubEmbedder(fail={"c": error, "e": StatusError(400)})
+    done = []
+
+    with pytest.raises(EmbeddingBatchError) as raised:
+        _scheduler(embedder, max_batch_size=2).embed(
+            list("abcdef"), on_batch_done=lambda batch, batch_embeddings: done.append(batch), token_counts=[1] * 6
+        )
+
+    assert set(raised.value.failed_batches) == {1, 2}
+    assert raised.value.failed_batches[1] is error
+    # not retryable: each failing batch was only sent once, the other batch is done
+    assert embedder.calls.count(["c", "d"]) == embedder.calls.count(["e", "f"]) == 1
+    assert done == [[0, 1]]
+
+
+def test_remaining_batches_are_cancelled_when_on_batch_done_raises():
+    embedder = StubEmbedder(delay=0.05)
+
+    def on_batch_done(batch, batch_embeddings):
+        raise IngestionCancelled("Ingestion was cancelled")
+
+    with pytest.raises(IngestionCancelled):
+        _scheduler(embedder, max_batch_size=1, max_concurrency=1).embed(
+            [f"text {index}" for index in range(20)], on_batch_done=on_batch_done, token_counts=[1] * 20
+        )
+    # the batch that was running when the first one finished, but none of the queued ones
+    assert len(embedder.calls) <= 2
+
+
+def test_is_retryable():
+    assert is_retryable(StatusError(429)) and is_retryable(StatusError(503)) and is_retryable(TimeoutError())
+    assert not is_retryable(StatusError(400)) and not is_retryable(ValueError())
+
+
+def test_rate_limiter_waits_for_the_window():
+    rate_limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=None, window=0.2)
+    start = time.monotonic()
+    for _ in range(3):
+        rate_limiter.acquire(1)
+    assert time.monotonic() - start >= 0.2
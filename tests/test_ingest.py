@@ -0,0 +1,88 @@
+import pytest
+from qdrant_client import QdrantClient
+
+from etl import ingest
+from etl.model import Document
+from etl.profiles import CollectionProfile
+from llm.embedders import HashingEmbedder
+
+
+class CountingEmbedder(HashingEmbedder):
+    hits = misses = 0
+
+
+@pytest.fixture
+def config(tmp_path):
+    data = tmp_path / "data"
+    for directory in ("raw", "preprocessed", "embedded"):
+        (data / directory).mkdir(parents=True)
+    return {
+        "paths": {
+            "data": {directory: str(data / directory) for directory in ("raw", "preprocessed", "embedded")},
+            "manifest": data / "manifest.json",
+            "work_queue": data / "work_queue",
+        },
+        "qdrant": {"document_collection": "documents"},
+        "ingest": {},
+    }
+
+
+@pytest.fixture
+def client(monkeypatch):
+    def parse_pdf(raw_document, text_splitter, page_cache_path=None):
+        # one chunk per line of the "PDF", a line that says "broken" fails
+        lines = raw_document.read_text().splitlines()
+        if "broken" in lines:
+            raise ValueError("broken PDF")
+        return [Document(content=line, source=str(raw_document), page=page) for page, line in enumerate(lines)]
+
+    monkeypatch.setattr(ingest, "_parse_pdf", parse_pdf)
+    monkeypatch.setattr(
+        ingest, "_embedding_setup", lambda config: (CollectionProfile(), CountingEmbedder(dim=8), None, "hashing")
+    )
+    return QdrantClient(":memory:")
+
+
+def _contents(client: QdrantClient) -> set[str]:
+    points, _ = client.scroll("documents", limit=100)
+    return {point.payload["content"] for point in points}
+
+
+def test_changed_pdf_is_replaced_after_its_new_chunks_are_uploaded(config, client, monkeypatch):
+    raw = ingest.Path(config["paths"]["data"]["raw"])
+    (raw / "a.pdf").write_text("alpha one\nalpha two\nalpha three")
+    (raw / "b.pdf").write_text("beta one")
+    ingest._ingest(config, ingest.default_text_splitter(), client, None)
+    assert _contents(client) == {"alpha one", "alpha two", "alpha three", "beta one"}
+
+    searchable_while_uploading = []
+    upload = ingest.upload_document_shards_to_qdrant
+
+    def upload_and_check(*args, **kwargs):
+        searchable_while_uploading.append(_contents(client))
+        return upload(*args, **kwargs)
+
+    monkeypatch.setattr(ingest, "upload_document_shards_to_qdrant", upload_and_check)
+    (raw / "a.pdf").write_text("alpha one, revised")
+    ingest._ingest(config, ingest.default_text_splitter(), client, None)
+
+    # the old chunks were still there during the upload, only the ones without a new chunk of the same id are gone
+    assert searchable_while_uploading == [{"alpha one", "alpha two", "alpha three", "beta one"}]
+    assert _contents(client) == {"alpha one, revised", "beta one"}
+
+
+def test_pdf_that_fails_to_parse_keeps_its_old_chunks(config, client):
+    raw = ingest.Path(config["paths"]["data"]["raw"])
+    (raw / "a.pdf").write_text("alpha one\nalpha two")
+    (raw / "b.pdf").write_text("beta one")
+    ingest._ingest(config, ingest.default_text_splitter(), client, None)
+
+    (raw / "a.pdf").write_text("broken")
+    (raw / "b.pdf").unlink()
+    ingest._ingest(config, ingest.default_text_splitter(), client, None)
+    assert _contents(client) == {"alpha one", "alpha two"}
+
+    # the next run tries again
+    (raw / "a.pdf").write_text("alpha one")
+    ingest._ingest(config, ingest.default_text_splitter(), client, None)
+    assert _contents(client) == {"alpha one"}
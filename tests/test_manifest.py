@@ -0,0 +1,20 @@
+import pytest
+from langchain.text_splitter import CharacterTextSplitter, RecursiveCharacterTextSplitter
+
+from etl.manifest import splitter_fingerprint, text_splitter_from_fingerprint
+
+
+def test_text_splitter_is_rebuilt_from_its_fingerprint():
+    # the splitter of the extended UI, see ui/resources.py
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100, add_start_index=True)
+    fingerprint = splitter_fingerprint(text_splitter)
+
+    rebuilt = text_splitter_from_fingerprint(fingerprint)
+    assert splitter_fingerprint(rebuilt) == fingerprint
+    text = "word " * 500
+    assert rebuilt.create_documents([text]) == text_splitter.create_documents([text])
+
+
+def test_other_text_splitters_are_not_rebuilt():
+    with pytest.raises(ValueError):
+        text_splitter_from_fingerprint(splitter_fingerprint(CharacterTextSplitter()))
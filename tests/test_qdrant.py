@@ -0,0 +1,106 @@
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import BinaryQuantization, BinaryQuantizationConfig, PointStruct, SparseVector
+
+from etl import qdrant
+from etl.model import Document
+from etl.profiles import CollectionProfile
+from etl.qdrant import (
+    DocumentFilter,
+    _same_quantization,
+    backfill_document_names,
+    create_db_collection,
+    ensure_db_collection,
+    search_documents,
+    upsert_embeddings,
+)
+from etl.sparse import SPARSE_VECTOR_NAME
+from util.tracing import Tracer
+
+DIM = 4
+
+
+def test_ensure_db_collection_backfills_document_names():
+    client = QdrantClient(":memory:")
+    create_db_collection(client, "documents", DIM)
+    documents = [
+        Document(content=f"chunk {page}", source=f"pdfs/{name}.pdf", page=page)
+        for name in ("a", "b")
+        for page in range(3)
+    ]
+    points = []
+    for index, document in enumerate(documents):
+        payload = document.payload
+        # uploaded before the name was part of the payload
+        payload.pop("name")
+        points.append(PointStruct(id=document.point_id, vector=[1.0, index, 0.0, 0.0], payload=payload))
+    client.upsert("documents", points)
+    new_document = Document(content="new chunk", source="pdfs/c.pdf", page=0)
+    new_point = PointStruct(id=new_document.point_id, vector=[1.0] * DIM, payload=new_document.payload)
+    client.upsert("documents", [new_point])
+
+    ensure_db_collection(client, "documents", DIM)
+
+    found = search_documents(client, "documents", [1.0] * DIM, document_filter=DocumentFilter(names=["b"]), limit=10)
+    assert sorted(point.payload["page"] for point in found) == [0, 1, 2]
+    assert {point.payload["source"] for point in found} == {"pdfs/b.pdf"}
+    assert backfill_document_names(client, "documents") == 0
+
+
+def test_upsert_embeddings_streams_hybrid_vectors_from_a_memmap(tmp_path):
+    client = QdrantClient(":memory:")
+    create_db_collection(client, "documents", DIM, sparse=True)
+    embeddings = np.lib.format.open_memmap(tmp_path / "embeddings.npy", mode="w+", dtype=np.float32, shape=(5, DIM))
+    embeddings[:] = np.arange(5 * DIM, dtype=np.float32).reshape(5, DIM) + 1
+    sparse_vectors = [SparseVector(indices=[index], values=[1.0]) for index in range(5)]
+    documents = [Document(content=f"chunk {page}", source="pdfs/a.pdf", page=page) for page in range(5)]
+
+    ids = upsert_embeddings(
+        client,
+        "documents",
+        [document.payload for document in documents],
+        embeddings,
+        ids=[document.point_id for document in documents],
+        sparse_vectors=sparse_vectors,
+        batch_size=2,
+    )
+
+    points = {point.id: point for point in client.retrieve("documents", ids, with_vectors=True)}
+    for point_id, embedding, sparse_vector in zip(ids, embeddings, sparse_vectors):
+        vector = points[point_id].vector
+        np.testing.assert_allclose(vector[""], embedding / np.linalg.norm(embedding), rtol=1e-6)
+        assert vector[SPARSE_VECTOR_NAME].indices == sparse_vector.indices
+
+
+def test_upsert_span_counts_the_vector_bytes(monkeypatch):
+    tracer = Tracer()
+    tracer.configure(True)
+    monkeypatch.setattr(qdrant, "tracer", tracer)
+    client = QdrantClient(":memory:")
+    create_db_collection(client, "documents", DIM)
+
+    upsert_embeddings(client, "documents", [{}] * 3, np.ones((3, DIM), dtype=np.float32))
+    upsert_embeddings(client, "documents", [{}] * 2, [[1.0] * DIM] * 2)
+    assert tracer.summary()["upsert"]["bytes"] == 5 * DIM * 4
+
+
+def test_ensure_db_collection_leaves_the_profile_alone_in_local_mode(monkeypatch):
+    client = QdrantClient(":memory:")
+    profile = CollectionProfile(quantization="scalar", m=32)
+    create_db_collection(client, "documents", DIM, profile)
+    updates = []
+    monkeypatch.setattr(client, "update_collection", lambda *args, **kwargs: updates.append(kwargs))
+
+    ensure_db_collection(client, "documents", DIM, profile)
+    assert updates == []
+
+
+def test_same_quantization_ignores_fields_filled_in_by_the_server():
+    binary = CollectionProfile(quantization="binary").quantization_config()
+    stored = BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True, encoding="one_bit"))
+    assert _same_quantization(binary, stored)
+    on_disk = CollectionProfile(quantization="binary", always_ram=False).quantization_config()
+    assert not _same_quantization(on_disk, stored)
+    assert not _same_quantization(CollectionProfile(quantization="scalar").quantization_config(), stored)
+    assert not _same_quantization(None, stored)
+    assert _same_quantization(None, None)
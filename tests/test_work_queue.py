@@ -0,0 +1,180 @@
+import time
+
+import pytest
+from qdrant_client import QdrantClient
+
+from etl import ingest
+from etl.model import Document
+from etl.qdrant import create_db_collection
+from etl.work_queue import CLAIMED, DONE, FAILED, PENDING, LeaseLost, WorkQueue, run_worker
+from llm.embedders import HashingEmbedder
+
+LEASE_SECONDS = 0.2
+
+
+@pytest.fixture
+def pdf_files(tmp_path):
+    files = []
+    for name in ("a.pdf", "b.pdf"):
+        path = tmp_path / "pdfs" / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(name.encode())
+        files.append(path)
+    return files
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(tmp_path / "work_queue", lease_seconds=LEASE_SECONDS, max_attempts=2)
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def run(queue, pdf_files):
+    run = queue.create_run("documents", "documents_v1", "splitter", "embedder")
+    queue.sync_units(run.id, pdf_files)
+    return run
+
+
+def test_claims_each_unit_once(queue, run):
+    first, second = queue.claim(run.id, "w1"), queue.claim(run.id, "w2")
+    assert (first.worker, first.attempts, second.worker, second.attempts) == ("w1", 1, "w2", 1)
+    assert first.source != second.source
+    assert queue.claim(run.id, "w3") is None
+
+
+def test_expired_lease_is_taken_over(queue, run):
+    unit = queue.claim(run.id, "w1")
+    queue.claim(run.id, "w1")
+    time.sleep(LEASE_SECONDS * 1.5)
+
+    taken_over = queue.claim(run.id, "w2")
+    assert (taken_over.id, taken_over.worker, taken_over.attempts) == (unit.id, "w2", 2)
+    # the first worker notices at its next checkpoint
+    with pytest.raises(LeaseLost):
+        queue.checkpoint(unit, "parse")
+    with pytest.raises(LeaseLost):
+        queue.complete(unit, ["chunk"])
+
+
+def test_heartbeat_keeps_the_lease(queue, run):
+    queue.claim(run.id, "w1")
+    queue.claim(run.id, "w1")
+    for _ in range(3):
+        time.sleep(LEASE_SECONDS / 2)
+        queue.heartbeat("w1")
+    assert queue.claim(run.id, "w2") is None
+
+
+def test_unit_fails_after_max_attempts_of_expired_leases(queue, run):
+    source = queue.claim(run.id, "w1").source
+    queue.claim(run.id, "w1")
+    time.sleep(LEASE_SECONDS * 1.5)
+    assert queue.claim(run.id, "w2").source == source
+    queue.claim(run.id, "w2")
+    time.sleep(LEASE_SECONDS * 1.5)
+
+    assert queue.claim(run.id, "w3") is None
+    failed = {unit.source: unit for unit in queue.units(run.id, FAILED)}
+    assert failed[source].error == "Lease expired 2 times"
+    assert queue.open_units(run.id) == 0
+
+    assert queue.retry_failed(run.id) == 2
+    assert queue.claim(run.id, "w4").attempts == 1
+
+
+def test_unit_fails_after_max_attempts_of_errors(queue, run):
+    attempts = []
+
+    def process_unit(unit, checkpoint):
+        attempts.append(unit.source)
+        raise RuntimeError("broken PDF")
+
+    assert run_worker(queue, run.id, process_unit, worker="w1") == 0
+    assert len(attempts) == 4
+    units = queue.units(run.id)
+    assert {unit.status for unit in units} == {FAILED}
+    assert {unit.error for unit in units} == {"RuntimeError: broken PDF"}
+
+
+def test_run_worker_leaves_a_lost_unit_to_its_new_worker(queue, run):
+    def process_unit(unit, checkpoint):
+        checkpoint("parse")
+        # another worker took over while this one was stuck
+        queue._connection.execute("UPDATE units SET worker = 'w2' WHERE id = ?", (unit.id,))
+        checkpoint("embed")
+        return ["chunk"]
+
+    assert run_worker(queue, run.id, process_unit, worker="w1") == 0
+    assert {unit.status for unit in queue.units(run.id)} == {CLAIMED}
+
+
+def test_unit_resumes_after_its_last_finished_stage(queue, run):
+    started_at = []
+
+    def process_unit(unit, checkpoint):
+        started_at.append(unit.stage)
+        if unit.stage is None:
+            checkpoint("parse")
+        if unit.stage == "parse":
+            checkpoint("embed")
+            if len(started_at) == 1:
+                raise ConnectionError("Qdrant is gone")
+        return [f"{unit.source}-chunk"]
+
+    first = queue.claim(run.id, "w1")
+    with pytest.raises(ConnectionError):
+        process_unit(first, lambda stage: queue.checkpoint(first, stage))
+    queue.fail(first, "ConnectionError")
+
+    assert run_worker(queue, run.id, process_unit, worker="w2") == 2
+    # the unit that failed after embedding only had to be uploaded again
+    assert started_at == [None, "embed", None]
+    assert {unit.status for unit in queue.units(run.id)} == {DONE}
+
+
+def test_sync_units_starts_over_with_changed_files(queue, run, pdf_files):
+    changed, _ = pdf_files
+    for _ in pdf_files:
+        unit = queue.claim(run.id, "w1")
+        queue.checkpoint(unit, "parse")
+        queue.complete(unit, [f"{unit.source}-chunk"])
+    changed.write_bytes(b"new content")
+
+    obsolete = queue.sync_units(run.id, [changed])
+    assert sorted(obsolete) == sorted(f"{pdf_file}-chunk" for pdf_file in pdf_files)
+    (unit,) = queue.units(run.id)
+    assert (unit.source, unit.status, unit.stage, unit.chunk_ids) == (str(changed), PENDING, None, [])
+    assert queue.sync_units(run.id, [changed]) == []
+
+
+def test_work_unit_processor_skips_finished_stages(queue, run, monkeypatch):
+    parsed = []
+
+    def parse_pdf(raw_document, text_splitter, page_cache_path=None):
+        parsed.append(raw_document.name)
+        return [Document(content=f"text of {raw_document.name}", source=str(raw_document), page=0)]
+
+    def upload_fails(*args, **kwargs):
+        raise ConnectionError("Qdrant is gone")
+
+    monkeypatch.setattr(ingest, "_parse_pdf", parse_pdf)
+    embedder = HashingEmbedder(dim=8)
+    client = QdrantClient(":memory:")
+    create_db_collection(client, "documents_v1", embedder.dimension)
+    config = {"ingest": {"page_cache": False}, "qdrant": {}}
+    process_unit = ingest._work_unit_processor(config, queue, None, embedder, client, "documents_v1")
+
+    unit = queue.claim(run.id, "w1")
+    with monkeypatch.context() as patch:
+        patch.setattr(ingest, "upload_document_shards_to_qdrant", upload_fails)
+        with pytest.raises(ConnectionError):
+            process_unit(unit, lambda stage: queue.checkpoint(unit, stage))
+    queue.fail(unit, "ConnectionError")
+    assert queue.units(run.id)[0].stage == "embed"
+
+    assert run_worker(queue, run.id, process_unit, worker="w2") == 2
+    assert sorted(parsed) == ["a.pdf", "b.pdf"]
+    assert client.count("documents_v1").count == 2
+    assert [len(unit.chunk_ids) for unit in queue.units(run.id, DONE)] == [1, 1]